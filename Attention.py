@@ -0,0 +1,136 @@
+import collections
+import math
+import time
+
+import face_recognition
+import numpy as np
+
+# Average face proportions, as fractions of the distance between the eye centers.
+# The 5 point model's nose point sits under the nose, this far below the line through the eyes when facing the camera
+FRONTAL_NOSE_DROP = 0.75
+# and this far in front of the plane of the eyes, which is what moves it sideways when the head turns
+NOSE_DEPTH = 0.55
+
+
+class HeadPose:
+    """
+    Rough head orientation of one face, in degrees. Zero yaw and pitch is facing the camera.
+    """
+
+    def __init__(self, yaw: float, pitch: float, roll: float, attentive: bool):
+        self.yaw = yaw
+        self.pitch = pitch
+        self.roll = roll
+        self.attentive = attentive
+
+    def __repr__(self):
+        return f"HeadPose(yaw={self.yaw:.0f}, pitch={self.pitch:.0f}, roll={self.roll:.0f}, attentive={self.attentive})"
+
+
+def head_pose(landmarks: dict, max_yaw: float = 30.0, max_pitch: float = 25.0) -> HeadPose:
+    """
+    Estimates where a face is pointing from the eyes and nose of the 5 point landmark model
+
+    :param landmarks: face_recognition landmark dict with left_eye, right_eye and nose_tip
+    :param max_yaw: largest left or right turn in degrees that still counts as looking at the mirror
+    :param max_pitch: largest up or down tilt in degrees that still counts as looking at the mirror
+    :return: HeadPose of the face
+    """
+    eyes = sorted([np.mean(landmarks['left_eye'], axis=0), np.mean(landmarks['right_eye'], axis=0)],
+                  key=lambda eye: eye[0])
+    nose = np.mean(landmarks['nose_tip'], axis=0)
+    axis = eyes[1] - eyes[0]
+    eye_distance = math.hypot(axis[0], axis[1])
+    if eye_distance == 0:
+        return HeadPose(0.0, 0.0, 0.0, False)
+    axis = axis / eye_distance
+    # nose position relative to the point between the eyes, along and across the line through them
+    offset = (nose - (eyes[0] + eyes[1]) / 2) / eye_distance
+    along = offset[0] * axis[0] + offset[1] * axis[1]
+    across = offset[1] * axis[0] - offset[0] * axis[1]
+    yaw = math.degrees(math.asin(max(-1.0, min(1.0, along / NOSE_DEPTH))))
+    pitch = math.degrees(math.asin(max(-1.0, min(1.0, (FRONTAL_NOSE_DROP - across) / NOSE_DEPTH))))
+    roll = math.degrees(math.atan2(axis[1], axis[0]))
+    return HeadPose(yaw, pitch, roll, abs(yaw) <= max_yaw and abs(pitch) <= max_pitch)
+
+
+class AttentionEstimator:
+    """
+    Decides whether anyone is looking at the mirror from the head pose of each detected face.
+    Uses the 5 point landmark model on the face boxes the frame was already searched for, and
+    smooths the answer over the last window seconds so it does not flicker between frames.
+    """
+
+    def __init__(self, window: float = 3.0, threshold: float = 0.5, max_yaw: float = 30.0, max_pitch: float = 25.0):
+        """
+        :param window: seconds of frames the answer is smoothed over
+        :param threshold: fraction of the frames in the window someone has to be looking in
+        :param max_yaw: largest left or right turn in degrees that still counts as looking
+        :param max_pitch: largest up or down tilt in degrees that still counts as looking
+        """
+        self.window = window
+        self.threshold = threshold
+        self.max_yaw = max_yaw
+        self.max_pitch = max_pitch
+        self.looking = False
+        self._history = collections.deque()  # (time, anyone attentive) per frame
+
+    def estimate(self, image, locations: list) -> tuple:
+        """
+        :param image: RGB numpy array
+        :param locations: face boxes already found in the image
+        :return: (5 point landmark dicts, HeadPose of each face)
+        """
+        if not locations:
+            return [], []
+        landmarks = face_recognition.face_landmarks(image, face_locations=locations, model='small')
+        return landmarks, [head_pose(face, self.max_yaw, self.max_pitch) for face in landmarks]
+
+    def update(self, poses: list, now: float = None) -> bool:
+        """
+        Adds one frame's head poses and returns the smoothed answer
+
+        :param poses: HeadPose of every face in the frame
+        :param now: time of the frame in seconds, defaults to time.monotonic()
+        :return: whether someone has been looking for at least threshold of the window
+        """
+        now = time.monotonic() if now is None else now
+        self._history.append((now, any(pose.attentive for pose in poses)))
+        while self._history[0][0] < now - self.window:
+            self._history.popleft()
+        self.looking = sum(attentive for _, attentive in self._history) >= self.threshold * len(self._history)
+        return self.looking
+
+
+if __name__ == "__main__":
+    import sys
+
+    # Compares the 68 point landmark pass are_they_looking used to run with the 5 point head pose estimate
+    # Usage: python3 Attention.py [image] [repeats]
+    image = face_recognition.load_image_file(sys.argv[1] if len(sys.argv) > 1 else 'unknown.png')
+    repeats = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+    locations = face_recognition.face_locations(image)
+    print(f"{len(locations)} faces found")
+
+    start = time.perf_counter()
+    for _ in range(repeats):
+        face_recognition.face_landmarks(image)
+    detect_and_large = (time.perf_counter() - start) / repeats
+
+    start = time.perf_counter()
+    for _ in range(repeats):
+        face_recognition.face_landmarks(image, face_locations=locations)
+    large = (time.perf_counter() - start) / repeats
+
+    estimator = AttentionEstimator()
+    start = time.perf_counter()
+    for _ in range(repeats):
+        _, poses = estimator.estimate(image, locations)
+        estimator.update(poses)
+    small = (time.perf_counter() - start) / repeats
+
+    print(f"68 point landmarks with their own detection {detect_and_large * 1000:8.2f} ms")
+    print(f"68 point landmarks on the detected boxes     {large * 1000:8.2f} ms")
+    print(f"5 point head pose on the detected boxes      {small * 1000:8.2f} ms")
+    for pose in poses:
+        print(pose)
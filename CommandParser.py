@@ -1,46 +1,56 @@
-import json
-import os
-import time
+import asyncio
 import subprocess
 import re
-import picamera
 
-from FileSettings import INPUT_STRING_FILE, OUTPUT_STRING_FILE, WEATHER_FILE
-from WeatherJSON import weather_hook
+from FileSettings import WEATHER_FILE
+from FileWatcher import watch_files
+from IntentRegistry import Cost, IntentRegistry
+from MessageBus import BusClient, Topic
+from TranscriptLog import TranscriptLog
+from WeatherSnapshot import SnapshotReader
+from WeatherState import WeatherStateReader
 
 
-def count(words: list, string: str) -> int:
-    """
-    Counts how many of the words in words is in the string
+class SettingsParser:
+    name = 'settings'
+    cost = Cost.EXTERNAL
+    side_effects = True
+    settingsWords = ["volume down", "volume up", "volume level", "mute", "add new user", "shut down"]
 
-    :param words:
-    :param string:
-    """
-    count = 0
-    for word in words:
-        if word in string:
-            count += 1
-    return count
+    def __init__(self):
+        # every setting is its own group so the hits tell which settings were asked for
+        self.phrases = {word: [word] for word in self.settingsWords}
 
+    def score(self, hits) -> int:
+        """
+        :param hits: Counter of group -> phrases found in the line
+        :return: how well the line matches, 0 if it is not a settings command
+        """
+        return sum(hits.values())
 
-class SettingsParser:
-    settingsWords = ["volume down", "volume up", "volume level", "mute", "add new user", "shut down"]
-    def parse(self, string: str):
-        if count(self.settingsWords, string > 1):
+    def parse(self, string: str, hits):
+        """
+        :param string: normalized line
+        :param hits: Counter of group -> phrases found in the line
+        :return: reply to say, every setting that ran replies so the line is never tried again
+        """
+        if sum(hits.values()) > 1:
             return "You may only change one setting at a time"
-        elif "volume down" in string.lower():
+        elif hits["volume down"]:
             command = "amixer -q sset Master 10%-"
             process = subprocess.Popen(command.split(), stdout = subprocess.PIPE)
             #method to decrease volume by ten notches
-        elif "volume up" in string.lower():
+            return "turning the volume down"
+        elif hits["volume up"]:
             command = "amixer -q sset Master 10%+"
             process = subprocess.Popen(command.split(), stdout = subprocess.PIPE)
             #method to increase volume by ten notches
-        elif "volume level" in string.lower():
+            return "turning the volume up"
+        elif hits["volume level"]:
             #regex to find every number in string
-            arr = re.findall(r'[0-9]+', str)
+            arr = re.findall(r'[0-9]+', string)
             #makes most sense to use the first number for desired volume
-            newLevel = arr[0]
+            newLevel = int(arr[0]) if arr else -1
             if newLevel < 0 or newLevel > 100:
                 #fail if volume is out of bounds
                 return "invalid volume"
@@ -48,18 +58,24 @@ class SettingsParser:
                 command = "amixer sset Master {}%".format(str(newLevel))
                 process = subprocess.Popen(command.split(), stdout = subprocess.PIPE)
                 #Set speaker volume to newLevel value
-        elif "mute" in string.lower():
+                return "volume set to {}".format(newLevel)
+        elif hits["mute"]:
             command = "amixer sset Master 0%"
             process = subprocess.Popen(command.split(), stdout = subprocess.PIPE)
-        elif "shut down" in string.lower():
+            return "muted"
+        elif hits["add new user"]:
+            #new users are enrolled from photos, there is no way to take them by voice yet
+            return "new users can not be added by voice yet, enroll their photos with Enrollment.py"
+        elif hits["shut down"]:
             #Try changing the command contents if this doesn't work. 
             command = "sudo shutdown"
             process = subprocess.Popen(command.split(), stdout = subprocess.PIPE)
             return "shutting down"
-        
-            
+
 
 class WeatherParser:
+    name = 'weather'
+    cost = Cost.LOCAL
     # The word that must be in the string for weather parser to parse
     weather_file = WEATHER_FILE
     activation_string = "weather"
@@ -69,94 +85,204 @@ class WeatherParser:
 
     def __init__(self):
         super().__init__()
+        self.phrases = {'activation': [self.activation_string], 'current': self.current_weather_strings,
+                        'tomorrow': self.tomorrow_weather_strings, 'week': self.week_weather_strings}
+        self.state = WeatherStateReader.open()
+        self.snapshot = SnapshotReader(self.weather_file)
 
-    def parse(self, string: str):
+    def score(self, hits) -> int:
+        """
+        :param hits: Counter of group -> phrases found in the line
+        :return: how well the line matches, 0 if it is not a weather question this parser can answer
+        """
+        if not hits['activation']:
+            return 0
+        asked = hits['current'] + hits['tomorrow'] + hits['week']
+        return hits['activation'] + asked if asked else 0
+
+    def summaries(self) -> tuple:
+        """
+        :return: (current, tomorrow's, week's) weather summary, from the shared weather state when WeatherApi
+                 shares it, else from the weather file, which is parsed again only when a new forecast was published
+        """
+        if self.state is None:
+            self.state = WeatherStateReader.open()
+        if self.state is not None:
+            try:
+                weather = self.state.read()
+                if weather.version:
+                    return weather.current.summary, weather.forecast[0].summary, weather.week_summary
+            except TimeoutError as e:
+                print(f"{e}, reading the weather file instead")
+        weather = self.snapshot.latest()
+        return weather['current']['summary'], weather['forecast'][0]['summary'], weather['week_summary']
+
+    def parse(self, string: str, hits):
+        """
+        :param string: normalized line
+        :param hits: Counter of group -> phrases found in the line
+        """
         TOLERANCE = 1
-        if self.activation_string in string.lower():
-            with open(self.weather_file, 'r') as fin:
-                weather = json.load(fin, object_hook=weather_hook)
-            if count(self.current_weather_strings, string) >= TOLERANCE:
-                return weather['current']['summary']
-            elif count(self.tomorrow_weather_strings, string) >= TOLERANCE:
-                return weather['forecast'][0]['summary']
-            elif count(self.week_weather_strings, string) >= TOLERANCE:
-                return weather['week_summary']
+        if hits['activation']:
+            current, tomorrow, week = self.summaries()
+            if hits['current'] >= TOLERANCE:
+                return current
+            elif hits['tomorrow'] >= TOLERANCE:
+                return tomorrow
+            elif hits['week'] >= TOLERANCE:
+                return week
             else:
                 return None
 
 
 class FactParser:
+    name = 'fact'
+    cost = Cost.MEMORY
     capital_of_france_strings = ["capital", "france"]
     colorado_state_rock_strings = ["colorado", "state", "rock"]
     tiger_woods_strings = ['who', 'tiger', 'woods']
 
     def __init__(self):
         super().__init__()
+        # group -> (phrases, how many of them must be heard, answer)
+        self.facts = {'france': (self.capital_of_france_strings, 2, 'The capital of france is paris'),
+                      'colorado': (self.colorado_state_rock_strings, 3, 'The state rock for colorado is basalite'),
+                      'tiger': (self.tiger_woods_strings, 3, 'Tiger Woods is a professional golfer.')}
+        self.phrases = {group: phrases for group, (phrases, _, _) in self.facts.items()}
 
-    def parse(self, string: str):
-        if count(self.capital_of_france_strings, string) >= 2:
-            return 'The capital of france is paris'
-        elif count(self.colorado_state_rock_strings, string) >= 3:
-            return 'The state rock for colorado is basalite'
-        elif count(self.tiger_woods_strings, string) >= 3:
-            return 'Tiger Woods is a professional golfer.'
-        else:
-            return None
+    def score(self, hits) -> int:
+        """
+        :param hits: Counter of group -> phrases found in the line
+        :return: how well the line matches, 0 if it asks for none of the facts
+        """
+        return max((hits[group] for group, (_, needed, _) in self.facts.items() if hits[group] >= needed), default=0)
 
+    def parse(self, string: str, hits):
+        """
+        :param string: normalized line
+        :param hits: Counter of group -> phrases found in the line
+        """
+        for group, (_, needed, answer) in self.facts.items():
+            if hits[group] >= needed:
+                return answer
+        return None
 
-def line_prepender(filename, line):
-    with open(filename, 'r+') as f:
-        content = f.read()
-        f.seek(0, 0)
-        f.write(line.rstrip('\r\n') + '\n' + content)
+
+activation_string = "mirror"
+# new capabilities register a parser here, see IntentRegistry
+registry = IntentRegistry()
+weather_parser = registry.register(WeatherParser())
+fact_parser = registry.register(FactParser())
+settings_parser = registry.register(SettingsParser())
+bus = None  # BusClient the answers are published on, connected by listen()
 
 
 def parse_string(line):
-    result = None
-    weather_result = weather_parser.parse(line)
-    fact_result = fact_parser.parse(line)
-    settings_result = settings_parser.parse(line)
-    if weather_result is not None:
-        result = weather_result
-    elif fact_result is not None:
-        result = fact_result
-    elif settings_result is not None:
-        result = settings_result
-    if result is not None:
-        with open(OUTPUT_STRING_FILE, "a") as fout:
-            fout.write(result + "\n")
-            return True
-    return False
+    answered = registry.dispatch(line)
+    if answered is None:
+        return False
+    if answered[1] is not None:
+        # falls back to appending to the output file when the message bus is not running
+        bus.publish(Topic.SAY, answered[1])
+    return True
+
+
+def parse_transcript(line, previous=None):
+    """
+    Parses one line as soon as it is heard
+
+    :param line: newly heard line
+    :param previous: line before it that had the activation word but could not be parsed on its own
+    :return: line to retry together with the next line, or None
+    """
+    if previous is not None:
+        parse_string(previous + " " + line)
+    if activation_string in line and not parse_string(line):
+        return line
+    return None
+
+
+def listen(delay: float = 10, stop=None):
+    """
+    Answers every line SpeechToText adds to the transcript log until stop is set
+
+    :param delay: seconds between attempts to reach the message bus while it is not running
+    :param stop: threading.Event to end the loop, checked at least every delay seconds
+    """
+    global bus
+    # SpeechToText appends what it hears to the log, this reader's offset survives restarts
+    transcripts = TranscriptLog()
+    reader = transcripts.reader('CommandParser')
+    bus = BusClient(topics=[Topic.TRANSCRIPTS])
+    # wakes the parser as soon as a line is appended to the log while the bus is down
+    watcher = watch_files([transcripts.directory])
+    previous = None
+    try:
+        while stop is None or not stop.is_set():
+            # parse every line heard since the last pass
+            for heard in reader.read():
+                previous = parse_transcript(heard.rstrip(), previous)
+            reader.commit()
+            # SpeechToText announces each new line on the bus, without it wait for the log to change
+            if bus.connected or bus.connect():
+                try:
+                    bus.receive(timeout=delay)
+                except ConnectionError:
+                    pass
+            else:
+                watcher.wait(timeout=delay)
+    finally:
+        watcher.close()
+        bus.close()
+        print_report()
+
+
+async def listen_async(stopping: asyncio.Event, delay: float = 10):
+    """
+    listen() for an asyncio event loop such as the Supervisor's. It waits for the transcript log to
+    change without a thread and returns as soon as stopping is set.
+
+    :param stopping: asyncio.Event to end the loop
+    :param delay: most seconds between passes over the log when no change was noticed
+    """
+    global bus
+    loop = asyncio.get_running_loop()
+    transcripts = TranscriptLog()
+    reader = transcripts.reader('CommandParser')
+    # only used to publish the answers, new lines are noticed through the log itself
+    bus = BusClient()
+    watcher = watch_files([transcripts.directory])
+    changed = asyncio.Event()
+    if watcher.fileno() is not None:
+        loop.add_reader(watcher.fileno(), lambda: watcher.wait(0) and changed.set())
+    else:
+        # polling watcher, look at the log as often as it checks the files
+        delay = min(delay, 0.5)
+    stop = asyncio.ensure_future(stopping.wait())
+    previous = None
+    try:
+        while not stopping.is_set():
+            changed.clear()
+            for heard in reader.read():
+                previous = parse_transcript(heard.rstrip(), previous)
+            reader.commit()
+            woken = asyncio.ensure_future(changed.wait())
+            await asyncio.wait({woken, stop}, timeout=delay, return_when=asyncio.FIRST_COMPLETED)
+            woken.cancel()
+    finally:
+        stop.cancel()
+        if watcher.fileno() is not None:
+            loop.remove_reader(watcher.fileno())
+        watcher.close()
+        bus.close()
+        print_report()
+
+
+def print_report():
+    for name, stats in registry.report().items():
+        print(f"{name}: {stats['hits']} answers of {stats['matches']} matching lines, "
+              f"mean latency {stats['mean_latency'] * 1000:.2f} ms")
 
 
 if __name__ == "__main__":
-    file_name = INPUT_STRING_FILE
-    activation_string = "mirror"
-    delay = 10
-    sentence_lookahead = 1
-    weather_parser = WeatherParser()
-    fact_parser = FactParser()
-    settings_parser = SettingsParser()
-    while True:
-        # read file into list
-        lines = [line.rstrip() for line in open(file_name)]
-        # clear the current file
-        open(file_name, 'w').close()
-        # parse each line
-        for i, line in enumerate(lines):
-            # is the activation word in the string attempt to parse the string
-            if activation_string in line and not parse_string(line):
-                # if the line had the activation but was not parseable try current and next line
-                if i < len(lines) - sentence_lookahead:
-                    for j in range(1, sentence_lookahead + 1):
-                        line += " " + lines[i + j]
-                    parse_string(line)
-                # if a theoretically parseable string is at end of file write that line to the file
-                else:
-                    # if file is empty overwrite with line
-                    if os.stat(file_name).st_size == 0:
-                        with open(file_name, "w") as fout:
-                            fout.write(line)
-                    else:
-                        line_prepender(file_name, line)
-        time.sleep(delay)
+    listen()
@@ -0,0 +1,202 @@
+import numpy as np
+
+from FaceGallery import FaceGallery, ENCODING_DTYPE, ENCODING_SIZE, np_json_read
+from FaceMatcher import FaceMatcher, DEFAULT_TOLERANCE
+
+FLOAT16 = 'float16'
+INT8 = 'int8'
+CHUNK_ROWS = 1024  # rows dequantized at a time, small enough to stay in cache
+INT8_HEADROOM = 1.25  # scales leave room for new encodings slightly outside the range seen so far
+
+
+class CompactGallery:
+    """
+    Compact copy of a FaceGallery's matrix for scoring, either float16 or int8 with one scale
+    factor per dimension. The full precision matrix stays memory mapped and is only read for
+    the few rows that get re-ranked.
+    """
+
+    def __init__(self, gallery: FaceGallery, mode: str = INT8):
+        """
+        :param gallery: gallery to compress
+        :param mode: FLOAT16 or INT8
+        """
+        if mode not in (FLOAT16, INT8):
+            raise ValueError(f"Unknown compact gallery mode {mode}")
+        self.gallery = gallery
+        self.mode = mode
+        self.scale = np.zeros(ENCODING_SIZE, dtype=ENCODING_DTYPE)
+        self.rows = np.empty((0, ENCODING_SIZE), dtype=np.float16 if mode == FLOAT16 else np.int8)
+        self.norms = np.empty(0, dtype=ENCODING_DTYPE)
+        self._generation = gallery.generation
+        self.rebuild()
+
+    def __len__(self):
+        return len(self.rows)
+
+    @property
+    def nbytes(self) -> int:
+        return self.rows.nbytes + self.norms.nbytes + self.scale.nbytes
+
+    def rebuild(self):
+        """
+        Compresses the whole gallery, recomputing the int8 scale factors
+        """
+        if self.mode == INT8 and len(self.gallery):
+            self._fit_scale(np.asarray(self.gallery.matrix))
+        self.rows = np.empty((0, ENCODING_SIZE), dtype=self.rows.dtype)
+        self.norms = np.empty(0, dtype=ENCODING_DTYPE)
+        self.update()
+
+    def _fit_scale(self, matrix: np.ndarray):
+        """
+        :param matrix: encodings to choose the int8 scale factors from
+        """
+        self.scale = (np.abs(matrix).max(axis=0) * INT8_HEADROOM / 127).astype(ENCODING_DTYPE)
+        self.scale[self.scale == 0] = np.finfo(ENCODING_DTYPE).tiny
+
+    def _compress(self, rows: np.ndarray) -> np.ndarray:
+        if self.mode == FLOAT16:
+            return rows.astype(np.float16)
+        return np.clip(np.rint(rows / self.scale), -127, 127).astype(np.int8)
+
+    def _decompress(self, rows: np.ndarray) -> np.ndarray:
+        if self.mode == FLOAT16:
+            return rows.astype(ENCODING_DTYPE)
+        return rows.astype(ENCODING_DTYPE) * self.scale
+
+    def update(self):
+        """
+        Compresses gallery rows added since the last update. If a new row falls outside the range the
+        int8 scale factors cover, the scales are refit to the whole gallery and every row is compressed again.
+        """
+        count = len(self.gallery)
+        if self._generation != self.gallery.generation:
+            # the gallery was reloaded from scratch
+            self._generation = self.gallery.generation
+            self.rebuild()
+            return
+        if count == len(self.rows):
+            return
+        rows = np.asarray(self.gallery.matrix[len(self.rows):count])
+        if self.mode == INT8 and np.any(np.abs(rows) > self.scale * 127):
+            # outside the range the scales were fit to, refit on the whole gallery and start over
+            self._fit_scale(np.asarray(self.gallery.matrix[:count]))
+            self.rows = self.rows[:0]
+            self.norms = self.norms[:0]
+            rows = np.asarray(self.gallery.matrix[:count])
+        new = self._compress(rows)
+        restored = self._decompress(new)
+        self.rows = np.concatenate([self.rows, new])
+        self.norms = np.concatenate([self.norms, np.einsum('ij,ij->i', restored, restored)])
+
+    def squared_distances(self, faces: np.ndarray) -> np.ndarray:
+        """
+        Approximate squared distances, dequantizing CHUNK_ROWS rows at a time
+
+        :param faces: F x 128 float32 face encodings
+        :return: F x N approximate squared distances to every gallery row
+        """
+        self.update()
+        dots = np.empty((len(faces), len(self.rows)), dtype=ENCODING_DTYPE)
+        if self.mode == INT8:
+            # fold the scales into the faces once instead of into every row
+            scaled = faces * self.scale
+            for start in range(0, len(self.rows), CHUNK_ROWS):
+                chunk = self.rows[start:start + CHUNK_ROWS].astype(ENCODING_DTYPE)
+                dots[:, start:start + len(chunk)] = scaled @ chunk.T
+        else:
+            for start in range(0, len(self.rows), CHUNK_ROWS):
+                chunk = self.rows[start:start + CHUNK_ROWS].astype(ENCODING_DTYPE)
+                dots[:, start:start + len(chunk)] = faces @ chunk.T
+        dots *= -2
+        dots += np.einsum('ij,ij->i', faces, faces)[:, np.newaxis]
+        dots += self.norms[np.newaxis, :]
+        return dots
+
+
+class CompactMatcher(FaceMatcher):
+    """
+    FaceMatcher that scores against a CompactGallery and re-ranks the closest rerank rows of
+    each face at full precision, so reported distances and the tolerance check stay exact
+    """
+
+    def __init__(self, gallery: FaceGallery, tolerance: float = DEFAULT_TOLERANCE, top_k: int = 1,
+                 mode: str = INT8, rerank: int = 8):
+        """
+        :param gallery: gallery to match against
+        :param tolerance: largest face distance that still counts as a match
+        :param top_k: how many candidates to report per face
+        :param mode: CompactGallery mode, FLOAT16 or INT8
+        :param rerank: rows per face re-scored at full precision
+        """
+        super().__init__(gallery, tolerance=tolerance, top_k=top_k)
+        self.compact = CompactGallery(gallery, mode)
+        self.rerank = rerank
+
+    def match(self, encodings, top_k: int = None) -> list:
+        top_k = self.top_k if top_k is None else top_k
+        faces = np.asarray(encodings, dtype=ENCODING_DTYPE).reshape(-1, ENCODING_SIZE)
+        if len(self.gallery) == 0 or len(faces) == 0:
+            return super().match(faces, top_k)
+        approximate = self.compact.squared_distances(faces)
+        # removed people would otherwise take rerank slots and hide the real match
+        removed = self.gallery.removed
+        if len(removed):
+            approximate[:, removed] = np.inf
+        k = min(max(self.rerank, top_k), approximate.shape[1])
+        rows = np.unique(np.argpartition(approximate, k - 1, axis=1)[:, :k])
+        return self._matches_from_distances(self.distances(faces, rows), rows, top_k)
+
+
+if __name__ == "__main__":
+    import os
+    import sys
+    import tempfile
+    import time
+
+    # Memory, latency and accuracy of the compact galleries against full precision matching.
+    # Synthetic identities are drawn with the per dimension spread of the encodings in known_faces.
+    # Usage: python3 CompactGallery.py [gallery size] [queries]
+    GALLERY_SIZE = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    QUERIES = int(sys.argv[2]) if len(sys.argv) > 2 else 300
+    known = FaceGallery('known_faces')
+    if len(known):
+        real = np.array(known.matrix)
+    else:
+        # not migrated yet, read the json encodings listed in the conversion file
+        with open(os.path.join('known_faces', 'pictureNames.conv')) as file:
+            real = np.array([np_json_read(os.path.join('known_faces', line.split(':')[0].strip()))
+                             for line in file if ':' in line])
+    rng = np.random.default_rng(2)
+    spread = real.std(axis=0) if len(real) > 1 else np.full(ENCODING_SIZE, 0.09)
+    spread = np.maximum(spread, 0.05)
+    center = real.mean(axis=0) if len(real) else np.zeros(ENCODING_SIZE)
+    identities = (center + rng.normal(0, 1, (GALLERY_SIZE - len(real), ENCODING_SIZE)) * spread)
+    identities = np.concatenate([real, identities]).astype(ENCODING_DTYPE)
+    truth = rng.choice(len(identities), size=QUERIES)
+    # a new photo of an enrolled person lands about 0.3 to 0.4 from their enrolled encoding
+    queries = identities[truth] + rng.normal(0, 0.03, (QUERIES, ENCODING_SIZE))
+
+    with tempfile.TemporaryDirectory() as location:
+        gallery = FaceGallery(location)
+        gallery.add_many(identities, [str(i) for i in range(len(identities))])
+        legacy = [np.array(row, dtype=np.float64) for row in identities]
+
+        # the matching path before the binary gallery, a python list of float64 rows through face_distance
+        start = time.perf_counter()
+        found = [int(np.argmin(np.linalg.norm(np.array(legacy) - query, axis=1))) for query in queries[:20]]
+        legacy_time = (time.perf_counter() - start) / 20
+        print(f"{'float64 list':<14} {len(legacy) * ENCODING_SIZE * 8 / 2 ** 20:8.2f} MiB "
+              f"{legacy_time * 1000:8.3f} ms per face  accuracy {np.mean(np.array(found) == truth[:20]):.3f}")
+
+        matchers = [('float32', FaceMatcher(gallery), gallery.matrix.nbytes),
+                    ('float16', CompactMatcher(gallery, mode=FLOAT16), None),
+                    ('int8', CompactMatcher(gallery, mode=INT8), None)]
+        for label, matcher, nbytes in matchers:
+            nbytes = nbytes if nbytes is not None else matcher.compact.nbytes
+            start = time.perf_counter()
+            found = [matcher.match(query)[0].index for query in queries]
+            elapsed = (time.perf_counter() - start) / QUERIES
+            print(f"{label:<14} {nbytes / 2 ** 20:8.2f} MiB {elapsed * 1000:8.3f} ms per face  "
+                  f"accuracy {np.mean(np.array(found) == truth):.3f}")
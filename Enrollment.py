@@ -0,0 +1,263 @@
+import heapq
+import math
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from FaceGallery import FaceGallery
+from FileSettings import RECOGNITION_SOCKET
+from FrameSource import IMAGE_EXTENSIONS, FrameSource, ReplaySource
+
+SHARPNESS_HALF = 100.0  # variance of the Laplacian that scores half, blurry faces score well below it
+GOOD_FACE_HEIGHT = 150  # face height in pixels past which a bigger face scores no better
+DUPLICATE_DISTANCE = 0.1  # encodings of one clip closer than this add nothing to the gallery
+SERVICE_BATCH = 16  # photos sent to a RecognitionService in one add_people request
+
+
+def encode_face(image):
+    """
+    Encodes the one face in an enrollment photo
+
+    :param image: path to image file or RGB numpy array
+    :return: (encoding, None) or (None, reason the photo was rejected)
+    """
+    # imported here so enrolling through a RecognitionService does not load the models
+    import face_recognition
+
+    if isinstance(image, str):
+        image = face_recognition.load_image_file(image)
+    locations = face_recognition.face_locations(image)
+    if len(locations) == 0:
+        return None, 'no face found'
+    if len(locations) > 1:
+        return None, f'{len(locations)} faces found'
+    return face_recognition.face_encodings(image, known_face_locations=locations)[0], None
+
+
+def _encode_file(path: str):
+    """
+    Process pool worker, kept at module level so it can be pickled
+
+    :param path: path to image file
+    :return: (path, encoding, reason) from encode_face
+    """
+    try:
+        return (path,) + encode_face(path)
+    except (OSError, ValueError) as e:
+        return path, None, f'could not read image: {e}'
+
+
+def scan_directory(root: str) -> list:
+    """
+    Finds enrollment photos laid out as root/name/*.jpg
+
+    :param root: directory with one sub directory of photos per person
+    :return: list of (name, path) tuples
+    """
+    photos = []
+    for name in sorted(os.listdir(root)):
+        person = os.path.join(root, name)
+        if not os.path.isdir(person):
+            continue
+        for file in sorted(os.listdir(person)):
+            if file.lower().endswith(IMAGE_EXTENSIONS):
+                photos.append((name, os.path.join(person, file)))
+    return photos
+
+
+def laplacian_variance(gray: np.ndarray) -> float:
+    """
+    Sharpness of an image as the variance of its 4 neighbour Laplacian, low when the image is blurred
+
+    :param gray: 2d grayscale image
+    :return: variance of the Laplacian
+    """
+    gray = gray.astype(np.float32)
+    laplacian = (gray[:-2, 1:-1] + gray[2:, 1:-1] + gray[1:-1, :-2] + gray[1:-1, 2:] - 4 * gray[1:-1, 1:-1])
+    return float(laplacian.var()) if laplacian.size else 0.0
+
+
+def frame_quality(image: np.ndarray, downscale: int = 2) -> tuple:
+    """
+    Cheap enrollment score of a frame, from the sharpness, size and pose of its one face.
+    The face is found and posed on a downscaled copy, only the sharpness is measured at full size.
+
+    :param image: RGB numpy array
+    :param downscale: factor the frame is shrunk by for detection and landmarks
+    :return: (score between 0 and 1, full size face location) or (None, reason the frame was rejected)
+    """
+    import face_recognition
+
+    from Attention import head_pose
+
+    # dlib needs a contiguous buffer, a strided view would be copied again on every call
+    small = np.ascontiguousarray(image[::downscale, ::downscale])
+    locations = face_recognition.face_locations(small)
+    if len(locations) != 1:
+        return None, 'no face found' if not locations else f'{len(locations)} faces found'
+    top, right, bottom, left = (value * downscale for value in locations[0])
+    face = image[max(0, top):bottom, max(0, left):right]
+    sharpness = laplacian_variance(face.mean(axis=2))
+    pose = head_pose(face_recognition.face_landmarks(small, face_locations=locations, model='small')[0])
+    frontal = max(0.0, math.cos(math.radians(pose.yaw)) * math.cos(math.radians(pose.pitch)))
+    score = sharpness / (sharpness + SHARPNESS_HALF) * min(1.0, (bottom - top) / GOOD_FACE_HEIGHT) * frontal
+    return score, (top, right, bottom, left)
+
+
+def drop_duplicates(encodings: list, distance: float = DUPLICATE_DISTANCE) -> list:
+    """
+    :param encodings: face encodings, best first
+    :param distance: encodings closer than this to one already kept are dropped
+    :return: indices of the encodings kept
+    """
+    kept = []
+    for i, encoding in enumerate(encodings):
+        if all(np.linalg.norm(encoding - encodings[j]) >= distance for j in kept):
+            kept.append(i)
+    return kept
+
+
+class EnrollmentReport:
+    """
+    Outcome of a batch enrollment
+    """
+
+    def __init__(self):
+        self.added = []  # (name, path, gallery id)
+        self.rejected = []  # (name, path, reason)
+        self.seconds = 0.0
+
+    @property
+    def images_per_second(self) -> float:
+        total = len(self.added) + len(self.rejected)
+        return total / self.seconds if self.seconds > 0 else 0.0
+
+    def __str__(self):
+        lines = [f"Enrolled {len(self.added)} photos, rejected {len(self.rejected)}, "
+                 f"{self.images_per_second:.2f} images per second"]
+        lines.extend(f"  rejected {path}: {reason}" for _, path, reason in self.rejected)
+        return '\n'.join(lines)
+
+
+def enroll_directory(gallery: FaceGallery, root: str, workers: int = None) -> EnrollmentReport:
+    """
+    Encodes every photo under root/name/ across a process pool and adds the accepted
+    encodings to the gallery in a single append
+
+    :param gallery: gallery to add the people to
+    :param root: directory with one sub directory of photos per person
+    :param workers: number of processes, defaults to the number of CPUs
+    :return: EnrollmentReport of what was added and rejected
+    """
+    report = EnrollmentReport()
+    start = time.perf_counter()
+    photos = scan_directory(root)
+    names = {path: name for name, path in photos}
+    encodings = []
+    accepted = []
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        # a few photos per task keeps the pool busy without pickling one task per image
+        chunksize = max(1, len(photos) // (4 * (workers or os.cpu_count() or 1)))
+        for path, encoding, reason in pool.map(_encode_file, [path for _, path in photos], chunksize=chunksize):
+            if encoding is None:
+                report.rejected.append((names[path], path, reason))
+            else:
+                encodings.append(encoding)
+                accepted.append(path)
+    ids = gallery.add_many(encodings, [names[path] for path in accepted])
+    report.added = [(names[path], path, i) for path, i in zip(accepted, ids)]
+    report.seconds = time.perf_counter() - start
+    return report
+
+
+def enroll_clip(gallery: FaceGallery, source, name: str, best: int = 5, step: int = 1,
+                duplicate_distance: float = DUPLICATE_DISTANCE) -> EnrollmentReport:
+    """
+    Enrolls a person from a short video or a burst of photos. Every frame is scored with
+    frame_quality, only the best frames are encoded and encodings that nearly repeat a better
+    one are dropped, so the expensive encoding runs on a few good frames.
+
+    :param gallery: gallery to add the person to
+    :param source: video file, directory of burst photos or FrameSource
+    :param name: name of the individual in the clip
+    :param best: most frames encoded
+    :param step: only score every step-th frame, consecutive video frames are nearly identical
+    :param duplicate_distance: encodings closer than this to a better one are not stored
+    :return: EnrollmentReport of the frames added and rejected
+    """
+    import face_recognition
+
+    report = EnrollmentReport()
+    start = time.perf_counter()
+    if not isinstance(source, FrameSource):
+        source = ReplaySource(source)
+    candidates = []  # min heap of (score, frame number, frame, location) holding the best frames so far
+    with source:
+        for number, frame in enumerate(source.frames()):
+            if number % step:
+                continue
+            score, location = frame_quality(frame)
+            if score is None:
+                report.rejected.append((name, f'frame {number}', location))
+            elif len(candidates) < best:
+                heapq.heappush(candidates, (score, number, frame, location))
+            elif score > candidates[0][0]:
+                heapq.heapreplace(candidates, (score, number, frame, location))
+    candidates.sort(reverse=True, key=lambda candidate: candidate[0])
+    encodings = [face_recognition.face_encodings(frame, known_face_locations=[location])[0]
+                 for _, _, frame, location in candidates]
+    kept = drop_duplicates(encodings, duplicate_distance)
+    for i in sorted(set(range(len(candidates))) - set(kept)):
+        report.rejected.append((name, f'frame {candidates[i][1]}', 'near duplicate of a better frame'))
+    ids = gallery.add_many([encodings[i] for i in kept], [name] * len(kept))
+    report.added = [(name, f'frame {candidates[i][1]}', gallery_id) for i, gallery_id in zip(kept, ids)]
+    report.seconds = time.perf_counter() - start
+    return report
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Enroll a directory of photos laid out as name/*.jpg, '
+                                                 'or one person from a video or burst of photos')
+    parser.add_argument('photos', help='directory with one sub directory of photos per person, '
+                                       'or the video file or burst directory with --clip')
+    parser.add_argument('--known', default='known_faces', help='face gallery directory')
+    parser.add_argument('--conversion', default='pictureNames.conv', help='legacy name conversion file to migrate')
+    parser.add_argument('--workers', type=int, default=None, help='number of encoding processes')
+    parser.add_argument('--service', nargs='?', const=RECOGNITION_SOCKET, default=None, metavar='SOCKET',
+                        help='add the photos through a running RecognitionService instead of loading the models')
+    parser.add_argument('--clip', metavar='NAME', help='enroll NAME from the best frames of a video or burst')
+    parser.add_argument('--best', type=int, default=5, help='most frames of a clip encoded')
+    args = parser.parse_args()
+
+    if args.clip:
+        from FacialRecognition import FaceRecognizer
+
+        recognizer = FaceRecognizer(enc_location=args.known, name_conv_location=args.conversion)
+        print(recognizer.add_clip(args.photos, args.clip, args.best))
+    elif args.service:
+        from RecognitionClient import RecognitionClient
+
+        report = EnrollmentReport()
+        start = time.perf_counter()
+        photos = scan_directory(args.photos)
+        # a batch is encoded before the daemon answers, so allow far longer than a single lookup
+        with RecognitionClient(args.service, timeout=300.0) as client:
+            for first in range(0, len(photos), SERVICE_BATCH):
+                batch = photos[first:first + SERVICE_BATCH]
+                added = client.add_people([path for _, path in batch], [name for name, _ in batch])
+                for (name, path), ok in zip(batch, added):
+                    if ok:
+                        report.added.append((name, path, None))
+                    else:
+                        report.rejected.append((name, path, 'rejected by the recognition service'))
+        report.seconds = time.perf_counter() - start
+        print(report)
+    else:
+        from FacialRecognition import FaceRecognizer
+
+        recognizer = FaceRecognizer(enc_location=args.known, name_conv_location=args.conversion)
+        print(recognizer.add_directory(args.photos, args.workers))
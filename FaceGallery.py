@@ -0,0 +1,237 @@
+import codecs
+import json
+import os
+
+import numpy as np
+
+from FileSettings import GALLERY_MATRIX_FILE, GALLERY_NAMES_FILE
+
+ENCODING_SIZE = 128  # length of a face_recognition face encoding
+ENCODING_DTYPE = np.float32
+ROW_BYTES = ENCODING_SIZE * np.dtype(ENCODING_DTYPE).itemsize
+MIN_CAPACITY = 16
+
+
+# read in numpy array from json dump
+def np_json_read(path: str) -> np.ndarray:
+    """
+    Reads in a file where json dumped a numpy ndarray
+
+    :param path: path to file where numpy array was dumped by json
+    :return: numpy ndarray from the file
+    """
+    with codecs.open(path, 'r', encoding='utf-8') as fin:
+        return np.array(json.loads(fin.read()))
+
+
+class FaceGallery:
+    """
+    Stores every known face encoding as one contiguous float32 N x 128 matrix on disk
+    with a matching id:name table. The matrix file is loaded with a single mmap and
+    new people are appended to the end of both files.
+
+    Removing a person appends a -id line to the table instead of rewriting the files, so
+    ids stay stable. The rows stay in the matrix and are listed in removed.
+    """
+
+    def __init__(self, location: str, matrix_file: str = GALLERY_MATRIX_FILE, names_file: str = GALLERY_NAMES_FILE):
+        self.location = location
+        self.matrix_path = os.path.join(location, matrix_file)
+        self.names_path = os.path.join(location, names_file)
+        self.generation = -1
+        self.load()
+
+    def __len__(self):
+        return self._count
+
+    @property
+    def matrix(self) -> np.ndarray:
+        """
+        :return: N x 128 float32 view of the known encodings, one row per id
+        """
+        return self._buffer[:self._count]
+
+    def exists(self) -> bool:
+        """
+        :return: whether the gallery files have been created on disk
+        """
+        return os.path.exists(self.matrix_path) and os.path.exists(self.names_path)
+
+    def load(self):
+        """
+        Maps the matrix file into memory and reads in the id:name table
+        """
+        # bumped every time the gallery is read from scratch, so caches built from the old rows can tell
+        self.generation += 1
+        self.names = []
+        self.removed = np.empty(0, dtype=np.int64)
+        self._buffer = np.empty((0, ENCODING_SIZE), dtype=ENCODING_DTYPE)
+        self._count = 0
+        self._names_offset = 0
+        self.refresh()
+
+    def refresh(self) -> tuple:
+        """
+        Applies the lines appended to the id:name table since it was last read, by this or another process
+
+        :return: (list of added ids, list of removed ids)
+        """
+        if not self.exists():
+            return [], []
+        if os.path.getsize(self.names_path) < self._names_offset:
+            # the table was rewritten rather than appended to, start over
+            count = len(self)
+            self.load()
+            return list(range(len(self))), list(range(count))
+        with open(self.names_path, 'rb') as fin:
+            fin.seek(self._names_offset)
+            data = fin.read()
+        rows = os.path.getsize(self.matrix_path) // ROW_BYTES
+        names = []
+        removed = []
+        consumed = 0
+        for line in data.splitlines(keepends=True):
+            # a line without its newline is still being written, and an interrupted append can leave a
+            # name without its matrix row, leave both for the next refresh
+            if not line.endswith(b'\n'):
+                break
+            text = line.decode('utf-8').rstrip('\n')
+            if text.startswith('-'):
+                removed.append(int(text[1:]))
+            elif text:
+                if self._count + len(names) >= rows:
+                    break
+                names.append(text.split(sep=':', maxsplit=1)[1])
+            consumed += len(line)
+        self._names_offset += consumed
+        count = self._count + len(names)
+        if names and self._count == 0:
+            self._buffer = np.memmap(self.matrix_path, dtype=ENCODING_DTYPE, mode='r', shape=(count, ENCODING_SIZE))
+            self._count = count
+        elif names:
+            self._append_rows(np.fromfile(self.matrix_path, dtype=ENCODING_DTYPE, count=len(names) * ENCODING_SIZE,
+                                          offset=self._count * ROW_BYTES).reshape(-1, ENCODING_SIZE))
+        added = list(range(len(self.names), count))
+        self.names.extend(names)
+        if removed:
+            self.removed = np.union1d(self.removed, removed)
+        return added, removed
+
+    def name(self, index: int) -> str:
+        """
+        :param index: row of the encoding in the matrix
+        :return: name of the person the row belongs to
+        """
+        return self.names[index]
+
+    def add(self, encoding, name: str) -> int:
+        """
+        Appends a face encoding and its name to the gallery files and the in memory matrix
+
+        :param encoding: 128 value face encoding
+        :param name: name of the individual the encoding belongs to
+        :return: id (matrix row) of the new encoding
+        """
+        return self.add_many([encoding], [name])[0]
+
+    def add_many(self, encodings, names: list) -> list:
+        """
+        Appends several face encodings to the gallery with one write per file
+
+        :param encodings: iterable of 128 value face encodings
+        :param names: name of the individual for each encoding
+        :return: list of ids (matrix rows) of the new encodings
+        """
+        rows = np.asarray(encodings, dtype=ENCODING_DTYPE).reshape(-1, ENCODING_SIZE)
+        if len(rows) != len(names):
+            raise ValueError(f"Got {len(rows)} encodings for {len(names)} names")
+        if len(rows) == 0:
+            return []
+        os.makedirs(self.location, exist_ok=True)
+        # catch up with anything another process appended so the new ids follow it
+        self.refresh()
+        ids = list(range(self._count, self._count + len(rows)))
+        # write the matrix first, refresh() ignores rows that do not have a name yet
+        with open(self.matrix_path, 'ab') as fout:
+            fout.seek(self._count * ROW_BYTES)
+            fout.truncate()
+            fout.write(rows.tobytes())
+        self._append_lines([f"{i}:{name}" for i, name in zip(ids, names)])
+        self._append_rows(rows)
+        self.names.extend(names)
+        return ids
+
+    def remove(self, name: str) -> list:
+        """
+        Removes every encoding of a person
+
+        :param name: name of the individual to forget
+        :return: list of ids that were removed
+        """
+        self.refresh()
+        ids = [i for i, other in enumerate(self.names) if other == name and i not in self.removed]
+        if ids:
+            self._append_lines([f"-{i}" for i in ids])
+            self.removed = np.union1d(self.removed, ids)
+        return ids
+
+    def _append_lines(self, lines: list):
+        """
+        Appends lines to the id:name table and moves the read offset past them
+
+        :param lines: lines without their newline
+        """
+        data = ''.join(f"{line}\n" for line in lines).encode('utf-8')
+        with open(self.names_path, 'ab') as fout:
+            fout.write(data)
+        self._names_offset += len(data)
+
+    def _append_rows(self, rows: np.ndarray):
+        """
+        Copies rows into the in memory matrix, doubling its capacity when full so appends are amortized O(1)
+
+        :param rows: k x 128 float32 array
+        """
+        needed = self._count + len(rows)
+        if isinstance(self._buffer, np.memmap) or needed > len(self._buffer):
+            capacity = max(MIN_CAPACITY, needed, 2 * len(self._buffer))
+            buffer = np.empty((capacity, ENCODING_SIZE), dtype=ENCODING_DTYPE)
+            buffer[:self._count] = self._buffer[:self._count]
+            self._buffer = buffer
+        self._buffer[self._count:needed] = rows
+        self._count = needed
+
+    def migrate_legacy(self, name_conv_location: str) -> int:
+        """
+        One shot conversion of the old known_faces layout, a conversion file of #.enc:name lines
+        and one json dumped encoding per #.enc file, into the gallery
+
+        :param name_conv_location: name of the conversion file inside the gallery location
+        :return: number of encodings migrated
+        """
+        conversion_file = os.path.join(self.location, name_conv_location)
+        encodings = []
+        names = []
+        with open(conversion_file) as file:
+            for line in file:
+                if ':' not in line:
+                    continue
+                enc_file, name = line.split(sep=':', maxsplit=1)
+                encodings.append(np_json_read(os.path.join(self.location, enc_file.strip())))
+                names.append(name.strip())
+        self.add_many(encodings, names)
+        print(f"Migrated {len(names)} known faces from {conversion_file}")
+        return len(names)
+
+
+if __name__ == "__main__":
+    import sys
+
+    # Usage: python3 FaceGallery.py [known_faces] [pictureNames.conv]
+    location = sys.argv[1] if len(sys.argv) > 1 else 'known_faces'
+    conversion = sys.argv[2] if len(sys.argv) > 2 else 'pictureNames.conv'
+    gallery = FaceGallery(location)
+    if gallery.exists():
+        print(f"{gallery.matrix_path} already exists with {len(gallery)} encodings")
+    else:
+        gallery.migrate_legacy(conversion)
@@ -0,0 +1,211 @@
+import os
+import time
+
+import numpy as np
+
+from FaceGallery import FaceGallery, ENCODING_DTYPE, ENCODING_SIZE
+
+CENTROIDS_FILE = "gallery.ivf.npy"
+ASSIGNMENTS_FILE = "gallery.ivf.i32"
+ASSIGNMENT_DTYPE = np.int32
+MIN_TRAIN_SIZE = 1024  # below this many encodings exact search is already fast enough
+KMEANS_ITERATIONS = 10
+KMEANS_SAMPLES_PER_LIST = 64
+
+
+def squared_distances(a: np.ndarray, b: np.ndarray) -> np.ndarray:
+    """
+    :param a: n x d array
+    :param b: m x d array
+    :return: n x m squared euclidean distances between the rows of a and b
+    """
+    squared = a @ b.T
+    squared *= -2
+    squared += np.einsum('ij,ij->i', a, a)[:, np.newaxis]
+    squared += np.einsum('ij,ij->i', b, b)[np.newaxis, :]
+    return np.maximum(squared, 0, out=squared)
+
+
+def kmeans(data: np.ndarray, k: int, iterations: int = KMEANS_ITERATIONS, seed: int = 0) -> np.ndarray:
+    """
+    Lloyd's k-means seeded with k random rows of data
+
+    :param data: n x d array to cluster
+    :param k: number of clusters
+    :param iterations: number of assignment/update rounds
+    :param seed: random seed for choosing the initial centroids
+    :return: k x d array of centroids
+    """
+    rng = np.random.default_rng(seed)
+    centroids = data[rng.choice(len(data), size=k, replace=False)].copy()
+    for _ in range(iterations):
+        assignment = np.argmin(squared_distances(data, centroids), axis=1)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assignment, data)
+        counts = np.bincount(assignment, minlength=k)
+        filled = counts > 0
+        centroids[filled] = sums[filled] / counts[filled, np.newaxis]
+        # restart empty clusters on random points so every list gets used
+        centroids[~filled] = data[rng.choice(len(data), size=int((~filled).sum()), replace=False)]
+    return centroids
+
+
+class IVFIndex:
+    """
+    Inverted file index over a FaceGallery. The gallery is partitioned by k-means into lists
+    and a search only compares against the rows in the n_probe lists closest to each face.
+
+    The centroids are saved next to the gallery when the index is trained and the list every
+    gallery row was assigned to is appended to a raw int32 file, mirroring the gallery layout,
+    so new people are inserted without retraining.
+    """
+
+    def __init__(self, gallery: FaceGallery, n_lists: int = None, n_probe: int = 8, min_train_size: int = MIN_TRAIN_SIZE):
+        """
+        :param gallery: gallery to index
+        :param n_lists: number of k-means partitions, defaults to sqrt of the gallery size when trained
+        :param n_probe: number of partitions searched per face
+        :param min_train_size: the index will not train itself until the gallery has this many encodings
+        """
+        self.gallery = gallery
+        self.n_lists = n_lists
+        self.n_probe = n_probe
+        self.min_train_size = min_train_size
+        self.centroids_path = os.path.join(gallery.location, CENTROIDS_FILE)
+        self.assignments_path = os.path.join(gallery.location, ASSIGNMENTS_FILE)
+        self.centroids = None
+        self.lists = []
+        self._indexed = 0
+        self.load()
+
+    @property
+    def trained(self) -> bool:
+        return self.centroids is not None
+
+    def load(self):
+        """
+        Reads the centroids and row assignments from disk and indexes any gallery rows added since
+        """
+        self.centroids = None
+        self.lists = []
+        self._indexed = 0
+        self._generation = self.gallery.generation
+        if os.path.exists(self.centroids_path):
+            self.centroids = np.load(self.centroids_path)
+            assignments = np.empty(0, dtype=ASSIGNMENT_DTYPE)
+            if os.path.exists(self.assignments_path):
+                assignments = np.fromfile(self.assignments_path, dtype=ASSIGNMENT_DTYPE)[:len(self.gallery)]
+            self._build_lists(assignments)
+        self.update()
+
+    def _build_lists(self, assignments: np.ndarray):
+        """
+        Groups gallery row ids by the list they were assigned to
+
+        :param assignments: list id of each gallery row, in row order
+        """
+        order = np.argsort(assignments, kind='stable').astype(ASSIGNMENT_DTYPE)
+        bounds = np.searchsorted(assignments[order], np.arange(len(self.centroids) + 1))
+        self.lists = [order[bounds[i]:bounds[i + 1]] for i in range(len(self.centroids))]
+        self._indexed = len(assignments)
+
+    def train(self):
+        """
+        Partitions the current gallery with k-means and rewrites the index files
+        """
+        matrix = np.asarray(self.gallery.matrix)
+        n_lists = self.n_lists or max(1, int(np.sqrt(len(matrix))))
+        n_lists = min(n_lists, len(matrix))
+        rng = np.random.default_rng(0)
+        sample_size = min(len(matrix), n_lists * KMEANS_SAMPLES_PER_LIST)
+        sample = matrix[rng.choice(len(matrix), size=sample_size, replace=False)]
+        self.centroids = kmeans(sample, n_lists).astype(ENCODING_DTYPE)
+        assignments = self._assign(matrix)
+        np.save(self.centroids_path, self.centroids)
+        assignments.tofile(self.assignments_path)
+        self._build_lists(assignments)
+
+    def _assign(self, rows: np.ndarray) -> np.ndarray:
+        """
+        :param rows: k x 128 encodings
+        :return: nearest list id for each row
+        """
+        return np.argmin(squared_distances(rows, self.centroids), axis=1).astype(ASSIGNMENT_DTYPE)
+
+    def update(self):
+        """
+        Inserts gallery rows added since the last update into their nearest list, training the
+        index first if the gallery has grown past min_train_size
+        """
+        if self._generation != self.gallery.generation:
+            # the gallery was reloaded from scratch, so were the row ids
+            self.load()
+            return
+        count = len(self.gallery)
+        if not self.trained:
+            if count >= self.min_train_size:
+                self.train()
+            return
+        if count <= self._indexed:
+            return
+        assignments = self._assign(np.asarray(self.gallery.matrix[self._indexed:count]))
+        with open(self.assignments_path, 'ab') as fout:
+            fout.seek(self._indexed * np.dtype(ASSIGNMENT_DTYPE).itemsize)
+            fout.truncate()
+            fout.write(assignments.tobytes())
+        for row, list_id in zip(range(self._indexed, count), assignments):
+            self.lists[list_id] = np.append(self.lists[list_id], ASSIGNMENT_DTYPE(row))
+        self._indexed = count
+
+    def candidates(self, encodings) -> np.ndarray:
+        """
+        Gallery rows worth comparing against for a batch of faces, the union of the n_probe
+        closest lists of each face
+
+        :param encodings: F x 128 face encodings
+        :return: sorted array of gallery row ids, or None if the index is not trained yet
+        """
+        self.update()
+        if not self.trained:
+            return None
+        faces = np.asarray(encodings, dtype=ENCODING_DTYPE).reshape(-1, ENCODING_SIZE)
+        n_probe = min(self.n_probe, len(self.centroids))
+        probes = np.argpartition(squared_distances(faces, self.centroids), n_probe - 1, axis=1)[:, :n_probe]
+        return np.unique(np.concatenate([self.lists[i] for i in np.unique(probes)]))
+
+
+if __name__ == "__main__":
+    import sys
+    import tempfile
+
+    from FaceMatcher import FaceMatcher
+
+    # Recall and latency benchmark of the IVF index against exact search on synthetic encodings
+    # Usage: python3 FaceIndex.py [gallery size] [queries]
+    GALLERY_SIZE = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    QUERIES = int(sys.argv[2]) if len(sys.argv) > 2 else 500
+    rng = np.random.default_rng(1)
+    # face encodings of different people sit roughly 0.8 to 1.0 apart, photos of one person within 0.4
+    identities = rng.normal(0, 0.065, size=(GALLERY_SIZE, ENCODING_SIZE)).astype(ENCODING_DTYPE)
+    queries = identities[rng.choice(GALLERY_SIZE, size=QUERIES)] + rng.normal(0, 0.02, size=(QUERIES, ENCODING_SIZE))
+    with tempfile.TemporaryDirectory() as location:
+        gallery = FaceGallery(location)
+        gallery.add_many(identities, [str(i) for i in range(GALLERY_SIZE)])
+        exact = FaceMatcher(gallery)
+        start = time.perf_counter()
+        exact_rows = [exact.match(query)[0].index for query in queries]
+        exact_time = (time.perf_counter() - start) / QUERIES
+        print(f"exact: {exact_time * 1000:.3f} ms per face")
+
+        start = time.perf_counter()
+        index = IVFIndex(gallery)
+        print(f"trained {len(index.centroids)} lists in {time.perf_counter() - start:.2f} s")
+        for n_probe in (1, 2, 4, 8, 16, 32):
+            index.n_probe = n_probe
+            approximate = FaceMatcher(gallery, index=index)
+            start = time.perf_counter()
+            rows = [approximate.match(query)[0].index for query in queries]
+            ivf_time = (time.perf_counter() - start) / QUERIES
+            recall = np.mean(np.array(rows) == np.array(exact_rows))
+            print(f"n_probe={n_probe:<3} recall@1={recall:.3f} {ivf_time * 1000:.3f} ms per face "
+                  f"({exact_time / ivf_time:.1f}x)")
@@ -0,0 +1,138 @@
+import numpy as np
+
+from FaceGallery import FaceGallery, ENCODING_DTYPE, ENCODING_SIZE
+
+DEFAULT_TOLERANCE = 0.6  # same default face distance cut off as face_recognition.compare_faces
+
+
+class FaceMatch:
+    """
+    Result of matching one face encoding against the gallery
+    """
+
+    def __init__(self, name, index: int, distance: float, candidates: list = None):
+        """
+        :param name: name of the closest known person or None if nobody was within tolerance
+        :param index: gallery row of the closest encoding, -1 if the gallery is empty
+        :param distance: euclidean face distance to the closest encoding
+        :param candidates: list of (name, index, distance) tuples for the top k closest rows, closest first
+        """
+        self.name = name
+        self.index = index
+        self.distance = distance
+        self.candidates = candidates if candidates is not None else []
+
+    def __repr__(self):
+        return f"FaceMatch(name={self.name!r}, index={self.index}, distance={self.distance:.3f})"
+
+
+class FaceMatcher:
+    """
+    Compares every face in a frame against every gallery row with one matrix product,
+    using |a - b|^2 = |a|^2 + |b|^2 - 2a.b and cached squared norms of the gallery rows.
+    If an index such as FaceIndex.IVFIndex is given only the rows it proposes are compared.
+    """
+
+    def __init__(self, gallery: FaceGallery, tolerance: float = DEFAULT_TOLERANCE, top_k: int = 1, index=None):
+        self.gallery = gallery
+        self.tolerance = tolerance
+        self.top_k = top_k
+        self.index = index
+        self._norms = np.empty(0, dtype=ENCODING_DTYPE)
+        self._normed = 0
+        self._generation = gallery.generation
+
+    def _gallery_norms(self) -> np.ndarray:
+        """
+        Squared norms of the gallery rows, only rows added since the last call are computed
+
+        :return: N length array of squared norms
+        """
+        count = len(self.gallery)
+        if self._generation != self.gallery.generation:
+            # the gallery was reloaded from scratch, start over
+            self._generation = self.gallery.generation
+            self._normed = 0
+        if count > len(self._norms):
+            norms = np.empty(max(count, 2 * len(self._norms)), dtype=ENCODING_DTYPE)
+            norms[:self._normed] = self._norms[:self._normed]
+            self._norms = norms
+        if count > self._normed:
+            rows = self.gallery.matrix[self._normed:count]
+            self._norms[self._normed:count] = np.einsum('ij,ij->i', rows, rows)
+            self._normed = count
+        return self._norms[:count]
+
+    def distances(self, encodings, rows: np.ndarray = None) -> np.ndarray:
+        """
+        :param encodings: F x 128 face encodings
+        :param rows: gallery row ids to compare against, defaults to every row
+        :return: F x N matrix of euclidean distances between each face and each gallery row, inf for removed rows
+        """
+        faces = np.asarray(encodings, dtype=ENCODING_DTYPE).reshape(-1, ENCODING_SIZE)
+        matrix = self.gallery.matrix
+        norms = self._gallery_norms()
+        if rows is not None:
+            matrix = matrix[rows]
+            norms = norms[rows]
+        squared = faces @ matrix.T
+        squared *= -2
+        squared += np.einsum('ij,ij->i', faces, faces)[:, np.newaxis]
+        squared += norms[np.newaxis, :]
+        # rounding can push identical encodings slightly below zero
+        np.maximum(squared, 0, out=squared)
+        np.sqrt(squared, out=squared)
+        # removed people stay in the matrix, keep them from ever being the closest
+        removed = self.gallery.removed
+        if len(removed):
+            squared[:, removed if rows is None else np.isin(rows, removed)] = np.inf
+        return squared
+
+    def match(self, encodings, top_k: int = None) -> list:
+        """
+        Finds the closest known person for each face encoding
+
+        :param encodings: F x 128 face encodings
+        :param top_k: how many candidates to report per face, defaults to self.top_k
+        :return: list of FaceMatch, one per encoding in the same order
+        """
+        top_k = self.top_k if top_k is None else top_k
+        faces = np.asarray(encodings, dtype=ENCODING_DTYPE).reshape(-1, ENCODING_SIZE)
+        if len(self.gallery) == 0:
+            return [FaceMatch(None, -1, float('inf')) for _ in range(len(faces))]
+        if len(faces) == 0:
+            return []
+        rows = self.index.candidates(faces) if self.index is not None else None
+        if rows is not None and len(rows) == 0:
+            return [FaceMatch(None, -1, float('inf')) for _ in range(len(faces))]
+        distances = self.distances(faces, rows)
+        if rows is None:
+            rows = np.arange(distances.shape[1])
+        return self._matches_from_distances(distances, rows, top_k)
+
+    def _matches_from_distances(self, distances: np.ndarray, rows: np.ndarray, top_k: int) -> list:
+        """
+        Turns a distance matrix into FaceMatch results, applying the tolerance once to every face
+
+        :param distances: F x M distances between each face and the gallery rows in rows
+        :param rows: M gallery row ids the distance columns belong to
+        :param top_k: how many candidates to report per face
+        :return: list of FaceMatch, one per face
+        """
+        k = max(1, min(top_k, distances.shape[1]))
+        faces = np.arange(len(distances))[:, np.newaxis]
+        # argpartition finds the k smallest per face without sorting the whole row
+        nearest = np.argpartition(distances, k - 1, axis=1)[:, :k]
+        nearest = nearest[faces, np.argsort(distances[faces, nearest], axis=1)]
+        nearest_distances = distances[faces, nearest]
+        within = nearest_distances[:, 0] <= self.tolerance
+        matches = []
+        for face, columns in enumerate(nearest):
+            candidates = [(self.gallery.name(rows[column]), int(rows[column]), float(distance))
+                          for column, distance in zip(columns, nearest_distances[face]) if np.isfinite(distance)]
+            if not candidates:
+                matches.append(FaceMatch(None, -1, float('inf')))
+                continue
+            name = candidates[0][0] if within[face] else None
+            matches.append(FaceMatch(name, candidates[0][1], candidates[0][2], candidates))
+        return matches
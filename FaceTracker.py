@@ -0,0 +1,156 @@
+import itertools
+
+import numpy as np
+
+
+def iou(a: tuple, b: tuple) -> float:
+    """
+    Intersection over union of two face_recognition (top, right, bottom, left) boxes
+
+    :param a: first box
+    :param b: second box
+    :return: overlap between 0 and 1
+    """
+    top, right = max(a[0], b[0]), min(a[1], b[1])
+    bottom, left = min(a[2], b[2]), max(a[3], b[3])
+    intersection = max(0, bottom - top) * max(0, right - left)
+    area_a = (a[2] - a[0]) * (a[1] - a[3])
+    area_b = (b[2] - b[0]) * (b[1] - b[3])
+    union = area_a + area_b - intersection
+    return intersection / union if union > 0 else 0.0
+
+
+class Track:
+    """
+    One face followed across frames
+    """
+
+    def __init__(self, track_id: int, location: tuple, now: float):
+        self.id = track_id
+        self.location = location
+        self.name = None
+        self.match = None
+        self.first_seen = now
+        self.last_seen = now
+        self.last_verified = None
+        # UnknownClusters id the face was counted under, a track is one sighting however often it is verified
+        self.cluster = None
+        self.misses = 0
+
+    def needs_verification(self, now: float, interval: float) -> bool:
+        """
+        :param now: current time in seconds
+        :param interval: seconds between re-verifying the identity of a track
+        :return: True if the track is new or its identity is older than interval
+        """
+        return self.last_verified is None or now - self.last_verified >= interval
+
+    def __repr__(self):
+        return f"Track(id={self.id}, name={self.name!r}, location={self.location})"
+
+
+class FaceTracker:
+    """
+    Links face boxes across frames by IoU so each person keeps a stable track id and identity.
+    Between full frame detections faces are only searched for in a downscaled region around
+    each track, and only new or stale tracks need a fresh encoding.
+    """
+
+    def __init__(self, iou_threshold: float = 0.3, reverify_interval: float = 3.0, detect_interval: float = 1.0,
+                 max_misses: int = 2, roi_margin: float = 0.5, roi_scale: int = 2):
+        """
+        :param iou_threshold: smallest overlap for a box to continue an existing track
+        :param reverify_interval: seconds before a track's identity is encoded and matched again
+        :param detect_interval: seconds between full frame detections, which find people who just walked in
+        :param max_misses: frames a track can go undetected before it is dropped
+        :param roi_margin: region searched around a track, as a fraction of the face size on each side
+        :param roi_scale: the region of interest is shrunk by this factor before detection
+        """
+        self.iou_threshold = iou_threshold
+        self.reverify_interval = reverify_interval
+        self.detect_interval = detect_interval
+        self.max_misses = max_misses
+        self.roi_margin = roi_margin
+        self.roi_scale = roi_scale
+        self.tracks = []
+        self.last_detection = None
+        self._ids = itertools.count()
+
+    def needs_full_detection(self, now: float) -> bool:
+        """
+        :param now: current time in seconds
+        :return: True if the whole frame should be searched for faces rather than the track regions
+        """
+        return not self.tracks or self.last_detection is None or now - self.last_detection >= self.detect_interval
+
+    def search_regions(self, image: np.ndarray, detect) -> list:
+        """
+        Looks for faces only around the current tracks, in a downscaled crop of the frame
+
+        :param image: RGB numpy frame
+        :param detect: function taking an RGB array and returning (top, right, bottom, left) boxes
+        :return: boxes found, in full frame coordinates
+        """
+        height, width = image.shape[:2]
+        found = []
+        for track in self.tracks:
+            top, right, bottom, left = track.location
+            margin_y = int((bottom - top) * self.roi_margin)
+            margin_x = int((right - left) * self.roi_margin)
+            y0, y1 = max(0, top - margin_y), min(height, bottom + margin_y)
+            x0, x1 = max(0, left - margin_x), min(width, right + margin_x)
+            crop = np.ascontiguousarray(image[y0:y1:self.roi_scale, x0:x1:self.roi_scale])
+            for t, r, b, l in detect(crop):
+                box = (y0 + t * self.roi_scale, x0 + r * self.roi_scale,
+                       y0 + b * self.roi_scale, x0 + l * self.roi_scale)
+                # neighbouring regions can overlap, keep one box per face
+                if all(iou(box, other) < self.iou_threshold for other in found):
+                    found.append(box)
+        return found
+
+    def update(self, locations: list, now: float, full_detection: bool = True) -> list:
+        """
+        Associates this frame's face boxes with the existing tracks, greedily by highest IoU
+
+        :param locations: (top, right, bottom, left) boxes detected in the frame
+        :param now: current time in seconds
+        :param full_detection: whether locations came from the whole frame rather than the track regions
+        :return: the track for each box, in the same order as locations
+        """
+        if full_detection:
+            self.last_detection = now
+        previous = len(self.tracks)
+        pairs = sorted(((iou(track.location, box), t, b) for t, track in enumerate(self.tracks)
+                        for b, box in enumerate(locations)), reverse=True)
+        assigned = [None] * len(locations)
+        used = set()
+        for overlap, t, b in pairs:
+            if overlap < self.iou_threshold:
+                break
+            if t in used or assigned[b] is not None:
+                continue
+            used.add(t)
+            assigned[b] = self.tracks[t]
+        for t, track in enumerate(self.tracks):
+            if t not in used:
+                track.misses += 1
+        for b, box in enumerate(locations):
+            if assigned[b] is None:
+                assigned[b] = Track(next(self._ids), box, now)
+                self.tracks.append(assigned[b])
+            assigned[b].location = box
+            assigned[b].last_seen = now
+            assigned[b].misses = 0
+        self.tracks = [track for track in self.tracks if track.misses <= self.max_misses]
+        if not full_detection and len(used) < previous:
+            # a track was lost in its region, look at the whole frame next time
+            self.last_detection = None
+        return assigned
+
+    def to_verify(self, tracks: list, now: float) -> list:
+        """
+        :param tracks: tracks seen in the current frame
+        :param now: current time in seconds
+        :return: indices of the tracks that need a new encoding and match
+        """
+        return [i for i, track in enumerate(tracks) if track.needs_verification(now, self.reverify_interval)]
@@ -1,107 +1,197 @@
-import codecs
-import json
 import os
-import random
 import time
 
 import face_recognition
-import numpy as np
 
-from FileSettings import OUTPUT_STRING_FILE, CAMERA_OUTPUT_FILE
-
-
-# turn numpy array into a json dumpable form
-def np_json_dump(path: str, a: np.ndarray):
-    """
-    Creates a file where json dumps a numpy ndarray then dumps the array using utf-8 encoding
-
-    :param path: path to file where numpy array will be dumped
-    :param a: Numpy Array to json dump
-    """
-    json.dump(a.tolist(), codecs.open(path, 'w', encoding='utf-8'), separators=(',', ':'), sort_keys=True,
-              indent=4)  # this saves the array in .json format
-
-
-# read in numpy array from json dump
-def np_json_read(path: str) -> np.ndarray:
-    """
-    Reads in a file where json dumped a numpy ndarray
-
-    :param path: path to file where numpy array was dumped by json
-    :return: numpy ndarray from the file
-    """
-    return np.array(json.loads(codecs.open(path, 'r', encoding='utf-8').read()))
+from Attention import AttentionEstimator
+from CompactGallery import CompactMatcher
+from Enrollment import EnrollmentReport, encode_face, enroll_clip, enroll_directory
+from FaceGallery import FaceGallery
+from FaceIndex import IVFIndex
+from FaceMatcher import FaceMatcher, DEFAULT_TOLERANCE
+from FaceTracker import FaceTracker
+from FileWatcher import watch_files
+from FrameSource import CaptureThread, PiCameraSource, ReplaySource
+from Greetings import greeting
+from MessageBus import BusClient, Topic
+from MotionGate import MotionGate
+from Presence import PresenceEvent, PresenceTracker, sleep_until
+from RateScheduler import RateScheduler
+from RecognitionClient import FrameResult
+from UnknownClusters import UnknownClusters
 
 
 class FaceRecognizer:
-    def __init__(self, enc_location: str, name_conv_location: str):
+    def __init__(self, enc_location: str, name_conv_location: str, tolerance: float = DEFAULT_TOLERANCE,
+                 use_index: bool = False, tracker: FaceTracker = None, compact: str = None,
+                 unknowns: UnknownClusters = None, attention: AttentionEstimator = None, gallery=None):
+        """
+        :param enc_location: directory holding the face gallery
+        :param name_conv_location: legacy #.enc:name conversion file inside enc_location
+        :param tolerance: largest face distance that still counts as a match
+        :param use_index: search an IVFIndex saved next to the gallery instead of comparing every row,
+                          for galleries with tens of thousands of encodings
+        :param tracker: follow faces across frames so a person is only encoded when their track is new
+                        or due for re-verification
+        :param compact: score against a CompactGallery in this mode, CompactGallery.FLOAT16 or INT8,
+                        and re-rank the closest rows at full precision. Not combined with use_index.
+        :param unknowns: collects the encodings of faces nobody matched so they can be enrolled later
+        :param attention: decides from head pose whether anyone is looking, defaults to AttentionEstimator()
+        :param gallery: gallery to match against instead of loading the one in enc_location, such as a
+                        MultiCamera.SharedGallery. Not combined with use_index.
+        """
+        if use_index and compact is not None:
+            # CompactMatcher scores every row itself and would silently ignore the index
+            raise ValueError("use_index can not be combined with a compact gallery")
+        if use_index and gallery is not None:
+            # the index is saved next to a gallery on disk, a shared gallery has no location to load it from
+            raise ValueError("use_index can not be combined with a gallery passed in")
         self.known = enc_location
         self.name_converter = name_conv_location
-        self.columnToName = dict()
-        self.knownMatrix = []
+        self.gallery = FaceGallery(self.known) if gallery is None else gallery
+        self.index = None
+        if compact is not None:
+            self.matcher = CompactMatcher(self.gallery, tolerance=tolerance, mode=compact)
+        else:
+            self.matcher = FaceMatcher(self.gallery, tolerance=tolerance)
+        self.use_index = use_index
+        self.tracker = tracker
+        self.unknowns = unknowns
+        self.attention = AttentionEstimator() if attention is None else attention
+        self.gallery_watcher = None
         self.who = None
+        self.matches = []
         self.looking = False
         self.load_known()
 
-    # Json dump face encoding in known_faces
-    def create_enc_file(self, encoding, name: str) -> str:
+    @property
+    def knownMatrix(self):
+        """
+        :return: N x 128 matrix of every known face encoding
+        """
+        return self.gallery.matrix
+
+    @property
+    def columnToName(self):
+        """
+        :return: list mapping each knownMatrix row to a name
+        """
+        return self.gallery.names
+
+    def create_enc_file(self, encoding, name: str) -> int:
         """
-        Creates a file and outputs the facial features encoding
+        Appends the facial features encoding to the gallery
 
-        :param loaded_image: a face_recognition loaded file
+        :param encoding: a face_recognition face encoding
         :param name: name of the individual in the loaded image
-        :return: name of file where encoding was outputted
-        """
-        # Creates a file by generating a file of form #.enc
-        # Will continue to attempt different encoding names until it finds a new path
-        i = 0
-        while os.path.exists(os.path.join(self.known, f"{i}.enc")):
-            i += 1
-        # save the encoding using np_json_dump encoding in directory self.known
+        :return: gallery id of the encoding or None if the encoding was empty
+        """
         if len(encoding) > 0:
-            np_json_dump(os.path.join(self.known, f"{i}.enc"), encoding)
-        else:
-            return None
-        # save the encoding file to the name of the face
-        with open(os.path.join(self.known, self.name_converter), 'a') as n:
-            n.write(f"\n{i}.enc:{name}")
-        return f"{i}.enc"
+            index = self.gallery.add(encoding, name)
+            if self.index is not None:
+                self.index.update()
+            return index
+        return None
+
+    def watch_gallery(self, interval: float = 0.5):
+        """
+        Picks up people added to or removed from the gallery by other processes, such as the
+        Enrollment or UnknownClusters command line tools, without restarting the recognizer.
+        Changes are applied between frames so a frame is always matched against one whole gallery.
+
+        :param interval: seconds between checks where inotify is not available
+        """
+        os.makedirs(self.known, exist_ok=True)
+        self.gallery_watcher = watch_files([self.gallery.matrix_path, self.gallery.names_path], interval)
+
+    def use_gallery(self, gallery):
+        """
+        Switches to a new copy of the gallery between frames, such as a SharedGallery published again
+        after people were added, and re-identifies every tracked face against it
+
+        :param gallery: FaceGallery or anything with the same matrix, names, removed and generation
+        """
+        self.gallery = gallery
+        self.matcher.gallery = gallery
+        if isinstance(self.matcher, CompactMatcher):
+            self.matcher.compact.gallery = gallery
+        if self.tracker is not None:
+            for track in self.tracker.tracks:
+                track.last_verified = None
+
+    def _apply_gallery_changes(self):
+        """
+        Applies any gallery changes the watcher has seen since the last frame
+        """
+        if self.gallery_watcher is None or not self.gallery_watcher.wait(0):
+            return
+        added, removed = self.gallery.refresh()
+        if self.index is not None:
+            self.index.update()
+        if self.tracker is not None:
+            # re-identify anyone who was matched to a removed encoding, or who might be one of the new people
+            for track in self.tracker.tracks:
+                if (added and track.name is None) or (track.match is not None and track.match.index in removed):
+                    track.last_verified = None
+        if added or removed:
+            print(f"Gallery changed, {len(added)} encodings added and {len(removed)} removed")
 
     def load_known(self):
         """
-        Loads in all face encodings and names of people to recognize from the self.known file path
+        Loads in all face encodings and names of people to recognize from the self.known file path,
+        migrating the old per person .enc files into the gallery the first time it runs
         """
-        conversion_file = os.path.join(self.known, self.name_converter)
-        with open(conversion_file) as file:
-            for i, line in enumerate(file):
-                # Adds the encoding to the knownMatrix as a row for effecient mass comparison Least Squares
-                self.knownMatrix.append(np_json_read(os.path.join(self.known, line.split(sep=':')[0].strip())))
-                # Generates a dictionary of rows to names
-                self.columnToName[i] = line.split(sep=':')[1].strip()
+        self.gallery.load()
+        if not self.gallery.exists() and os.path.exists(os.path.join(self.known, self.name_converter)):
+            self.gallery.migrate_legacy(self.name_converter)
+        if self.use_index:
+            self.index = IVFIndex(self.gallery)
+            self.matcher.index = self.index
         print("Loaded all known faces")
 
     # add person to known_faces
-    def add_person(self, image: str, name: str) -> bool:
+    def add_person(self, image, name: str) -> bool:
         """
         Adds a person to the set of known people to recognize
 
-        :param image: path to image file
+        :param image: path to image file or RGB numpy array
         :param name: output of identifying that individual
         :return: boolean as to whether the person was successfully added
         """
-        # begin facial recognition on image
-        loaded_image = face_recognition.load_image_file(image)
-        # Run facial recognition on loaded image
-        encoding = face_recognition.face_encodings(loaded_image)[0]
-        # passes the first encoding as a parameter to create the encoding file
-        enc = self.create_enc_file(encoding, name)
-        # Add the new user to the current knownMatrix and add mapping
-        if enc is not None:
-            self.knownMatrix.append(np_json_read(os.path.join(self.known, enc)))
-            self.columnToName[len(list(self.knownMatrix)) - 1] = self.who.clear()
-            return True
-        else:
+        # Run facial recognition on the image, photos without exactly one face are rejected
+        encoding, reason = encode_face(image)
+        if encoding is None:
+            print(f"Could not add {name} from {image}: {reason}")
             return False
+        # passes the encoding as a parameter to append to the gallery
+        return self.create_enc_file(encoding, name) is not None
+
+    def add_directory(self, root: str, workers: int = None) -> EnrollmentReport:
+        """
+        Adds every photo under root/name/*.jpg to the set of known people, encoding them across a process pool
+
+        :param root: directory with one sub directory of photos per person
+        :param workers: number of encoding processes, defaults to the number of CPUs
+        :return: EnrollmentReport of the photos added and rejected
+        """
+        report = enroll_directory(self.gallery, root, workers)
+        if self.index is not None:
+            self.index.update()
+        return report
+
+    def add_clip(self, source, name: str, best: int = 5) -> EnrollmentReport:
+        """
+        Adds a person from the best few frames of a short video or burst of photos
+
+        :param source: video file, directory of burst photos or FrameSource
+        :param name: name of the individual in the clip
+        :param best: most frames encoded
+        :return: EnrollmentReport of the frames added and rejected
+        """
+        report = enroll_clip(self.gallery, source, name, best)
+        if self.index is not None:
+            self.index.update()
+        return report
 
     def who_is_it(self, unknown_file_name: str):
         """
@@ -111,20 +201,25 @@ class FaceRecognizer:
         """
         # Get encodings of faces
         unknown_picture = face_recognition.load_image_file(unknown_file_name)
-        unknown_face_encoding = face_recognition.face_encodings(unknown_picture)
-        # Clear old users
-        self.who = []
-        # If no encodings set current user to unknown
-        if len(unknown_face_encoding) < 1:
+        self._identify(face_recognition.face_encodings(unknown_picture))
+
+    def _identify(self, encodings: list, record_unknowns: bool = True):
+        """
+        Sets self.who and self.matches from the face encodings of a frame
+
+        :param encodings: face encodings of every face in the frame
+        :param record_unknowns: add the faces nobody matched to self.unknowns, the caller counts them otherwise
+        """
+        # Compare every face against every knownMatrix row at once
+        self.matches = self.matcher.match(encodings)
+        if self.unknowns is not None and record_unknowns:
+            for encoding, match in zip(encodings, self.matches):
+                if match.name is None:
+                    self.unknowns.add(encoding)
+        # Set the current users to the best match of each face, unknown if no face matched
+        self.who = [match.name for match in self.matches if match.name is not None]
+        if not self.who:
             self.who = ['unknown']
-        else:
-            for face in unknown_face_encoding:
-                # Compare the faces in unknown face encoding to the knownMatrix rows
-                comparison = face_recognition.compare_faces(self.knownMatrix, face)
-                # if face matches a known face, add the names of each user to currently identified
-                self.who.extend([self.columnToName[i] for i, index in enumerate(comparison) if index])
-            if not self.who:
-                self.who = ['unknown']
 
     def are_they_looking(self, unknown_file_name: str):
         """
@@ -132,70 +227,234 @@ class FaceRecognizer:
         the unknown_file_name
         :param unknown_file_name:
         """
-        # run face landmarks on image
+        # estimate the head pose of every face in the image
         image = face_recognition.load_image_file(unknown_file_name)
-        landmarks = face_recognition.face_landmarks(image)
-        # return if any of the people in the image had distinctly found left and right eyes
-        for index in landmarks:
-            if 'left_eye' in index and 'right_eye' in index:
-                self.looking = True
-                return
-        self.looking = False
+        _, poses = self.attention.estimate(image, face_recognition.face_locations(image))
+        self.looking = self.attention.update(poses)
+
+    def _analyze_image(self, image, now: float = None) -> tuple:
+        """
+        Decodes the image and detects faces once, then feeds the face locations to both the landmark
+        and encoding models. Shared by analyze and analyze_batch, matching is left to the caller.
+
+        :param image: path to an image file or an RGB numpy array
+        :param now: time.monotonic() of a camera frame, which is tracked and whose head poses are smoothed
+                    into self.looking. None for an unrelated image, every face of which is encoded.
+        :return: (FrameResult without matches, the faces' tracks or None if they are not tracked)
+        """
+        result = FrameResult()
+        start = time.perf_counter()
+        if isinstance(image, str):
+            image = face_recognition.load_image_file(image)
+        result.image = image
+        result.timings['decode'] = time.perf_counter() - start
+
+        tracking = now is not None and self.tracker is not None
+        start = time.perf_counter()
+        full_detection = not tracking or self.tracker.needs_full_detection(now)
+        if full_detection:
+            result.locations = face_recognition.face_locations(image)
+        else:
+            result.locations = self.tracker.search_regions(image, face_recognition.face_locations)
+        result.timings['detect'] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        result.landmarks, result.poses = self.attention.estimate(image, result.locations)
+        if now is not None:
+            self.looking = result.looking = self.attention.update(result.poses, now)
+        else:
+            # unrelated images, so the head poses are not smoothed
+            result.looking = any(pose.attentive for pose in result.poses)
+        result.timings['landmarks'] = time.perf_counter() - start
+
+        # Without a tracker every face is encoded, with one only new tracks and tracks due for re-verification
+        tracks = None
+        result.encoded = list(range(len(result.locations)))
+        if tracking:
+            tracks = self.tracker.update(result.locations, now, full_detection)
+            result.track_ids = [track.id for track in tracks]
+            result.encoded = self.tracker.to_verify(tracks, now)
+        start = time.perf_counter()
+        if result.encoded:
+            result.encodings = face_recognition.face_encodings(
+                image, known_face_locations=[result.locations[i] for i in result.encoded])
+        result.timings['encode'] = time.perf_counter() - start
+        return result, tracks
+
+    def analyze(self, image) -> FrameResult:
+        """
+        Analyzes one camera frame. Updates self.who, self.looking and self.matches.
+
+        :param image: path to an image file or an RGB numpy array
+        :return: FrameResult for the frame
+        """
+        self._apply_gallery_changes()
+        now = time.monotonic()
+        result, tracks = self._analyze_image(image, now)
+
+        start = time.perf_counter()
+        self._identify(result.encodings, record_unknowns=tracks is None)
+        if tracks is not None:
+            for i, match, encoding in zip(result.encoded, self.matches, result.encodings):
+                tracks[i].name = match.name
+                tracks[i].match = match
+                tracks[i].last_verified = now
+                if match.name is None and tracks[i].cluster is None and self.unknowns is not None:
+                    tracks[i].cluster = self.unknowns.add(encoding)
+            result.names = [track.name for track in tracks]
+            self.who = [name for name in result.names if name is not None] or ['unknown']
+        else:
+            result.names = [match.name for match in self.matches]
+        result.timings['match'] = time.perf_counter() - start
 
-    def update(self, unknown_file_name: str):
+        result.matches = self.matches
+        result.who = self.who
+        return result
+
+    def analyze_batch(self, images: list) -> list:
+        """
+        Analyzes several unrelated images, for example requests from different clients, matching the
+        faces of all of them against the gallery in one pass. The tracker is not used since the images
+        are not frames of one video, and self.who, self.looking and self.matches are left alone.
+
+        :param images: list of paths to image files or RGB numpy arrays
+        :return: FrameResult for each image
+        """
+        self._apply_gallery_changes()
+        results = [self._analyze_image(image)[0] for image in images]
+
+        # one matcher call for every face in every image
+        start = time.perf_counter()
+        encodings = [encoding for result in results for encoding in result.encodings]
+        matches = self.matcher.match(encodings) if encodings else []
+        if self.unknowns is not None:
+            for encoding, match in zip(encodings, matches):
+                if match.name is None:
+                    self.unknowns.add(encoding)
+        match_time = (time.perf_counter() - start) / max(1, len(results))
+        for result in results:
+            result.matches, matches = matches[:len(result.encodings)], matches[len(result.encodings):]
+            result.names = [match.name for match in result.matches]
+            result.who = [name for name in result.names if name is not None] or ['unknown']
+            # the shared match pass is split evenly between the images
+            result.timings['match'] = match_time
+        return results
+
+    def add_people(self, images: list, names: list) -> list:
+        """
+        Adds several people at once, the accepted encodings are appended to the gallery in one write
+
+        :param images: list of paths to image files or RGB numpy arrays, one face per photo
+        :param names: name of the individual in each image
+        :return: list of booleans as to whether each person was successfully added
+        """
+        encodings = []
+        accepted = []
+        added = []
+        for image, name in zip(images, names):
+            try:
+                encoding, reason = encode_face(image)
+            except (OSError, ValueError) as e:
+                # an unreadable photo only rejects itself, like Enrollment's process pool does
+                encoding, reason = None, f'could not read image: {e}'
+            if encoding is None:
+                print(f"Could not add {name} from {image if isinstance(image, str) else 'frame'}: {reason}")
+            else:
+                encodings.append(encoding)
+                accepted.append(name)
+            added.append(encoding is not None)
+        self.gallery.add_many(encodings, accepted)
+        if self.index is not None:
+            self.index.update()
+        return added
+
+    def update(self, image) -> FrameResult:
         """
-            Runs who_is_it() and are_they_looking, which will update
+            Runs the per frame analysis, which will update
             self.who and self.looking
-            :param unknown_file_name: path to image of person
+            :param image: path to image of person or an RGB numpy frame from a FrameSource
+            :return: FrameResult for the frame
         """
-        self.are_they_looking(unknown_file_name)
-        self.who_is_it(unknown_file_name)
+        return self.analyze(image)
 
 
 if __name__ == "__main__":
+    import argparse
+
+    from Supervisor import Heartbeat
+
+    parser = argparse.ArgumentParser(description='Greet the people the camera recognizes')
+    parser.add_argument('--no-greet', action='store_true',
+                        help='only publish arrivals on the message bus, the Supervisor greets them')
+    args = parser.parse_args()
+
     PYCAMERA = False
+    TEST_IMAGE = 'unknown.png'  # replayed in place of the camera when PYCAMERA is False
     SAY_HELLO_TIMER = 60  # seconds since last recogntion before removing them
-    SLEEP = 0.25  # Seconds between photo
-    POSSIBLE_GREETINGS = ['You look wonderful', 'Hello', 'Nice to see you', 'Whats the haps', 'Hows it hanging',
-                          'Welcome', 'Welcome to your doom', 'You are crushing it today', 'Good morning',
-                          ' Good afternoon', 'Good evening', 'Hi', 'Hey', 'Good to see you', "It's great to see you"]
-    # Take a photo every second and if the user is identified ask the mirror to say hello to the user
-    last_run = time.time()
-    users = {}  # hold the user and their last recognition time
+    MOTION_REFRESH = 5  # Seconds between recognitions when nothing in front of the mirror moves
+    USE_SERVICE = False  # send frames to a running RecognitionService instead of loading the models here
+    # Take a photo at the rate chosen by the scheduler and if a new user is identified ask the mirror to say hello
+    presence = PresenceTracker(timeout=SAY_HELLO_TIMER)
+    # falls back to appending greetings to the output file when the message bus is not running
+    bus = BusClient()
+
+
+    def greet(event: PresenceEvent, user: str, now: float):
+        if event != PresenceEvent.PRESENT:
+            bus.publish(Topic.PRESENCE, {'event': event.name, 'name': user})
+        if event == PresenceEvent.ENTERED and not args.no_greet:
+            bus.publish(Topic.SAY, greeting(user))
+
+
+    presence.add_listener(greet)
     if PYCAMERA:
-        import picamera
+        source = PiCameraSource()
+    else:
+        # replay at the scheduler's burst rate, the capture queue drops frames the loop does not need
+        source = ReplaySource(TEST_IMAGE, rate=4, loop=True)
+    if USE_SERVICE:
+        from RecognitionClient import RecognitionClient
 
-        camera = picamera.PiCamera()
-    rec = FaceRecognizer(enc_location='known_faces', name_conv_location='pictureNames.conv')
+        rec = RecognitionClient()
+    else:
+        rec = FaceRecognizer(enc_location='known_faces', name_conv_location='pictureNames.conv',
+                             tracker=FaceTracker(), unknowns=UnknownClusters('known_faces'))
+        rec.watch_gallery()
+    gate = MotionGate(refresh_interval=MOTION_REFRESH)
+    scheduler = RateScheduler()
+    next_run = time.monotonic()
+    # tells a Supervisor running this process that the loop has not hung
+    heartbeat = Heartbeat.from_environment()
     try:
-        while True:
-            # Wait until sleep timer is done
-            while time.time() < last_run + SLEEP:
-                time.sleep(SLEEP / 10)
-            last_run = time.time()  # Update the last run timer
-            if PYCAMERA:
-                # Take a picture and run recogntion
-                camera.capture(CAMERA_OUTPUT_FILE)
-            rec.update('unknown.png')  # CAMERA_OUTPUT_FILE)
-            print('Finished running facial recognition on image')
-            # Say hello if new user recognition
-            for user in rec.who:
-                if user not in users:
-                    users[user] = time.time()
-                    with open(OUTPUT_STRING_FILE, "a") as fout:
-                        # Select a random greeting
-                        fout.write(f'\n{POSSIBLE_GREETINGS[random.randrange(len(POSSIBLE_GREETINGS))]}, {user}')
-                # Update last seen timer if recognized again
-                else:
-                    users[user] = time.time()
-            # Remove old users
-            for key, value in users.items():
-                if value > time.time() + SAY_HELLO_TIMER:
-                    del users[key]
-
+        with CaptureThread(source) as capture:
+            while capture.alive:
+                heartbeat.beat()
+                # Sleep until the next photo or the next time someone could leave, whichever is first
+                deadline = presence.next_deadline()
+                sleep_until(next_run if deadline is None else min(next_run, deadline))
+                presence.expire()
+                if time.monotonic() < next_run:
+                    continue
+                next_run = time.monotonic() + scheduler.next_interval()
+                # Run recognition on the newest frame, older frames are dropped by the capture queue
+                frame = capture.read(timeout=scheduler.interval)
+                if frame is None:
+                    continue
+                # Skip detection while the scene has not changed
+                if not gate.should_analyze(frame):
+                    scheduler.record(motion=False)
+                    continue
+                result = rec.update(frame)
+                scheduler.record(motion=gate.change >= gate.sensitivity, faces=len(result.locations),
+                                 analysis_time=result.total_time())
+                print(f'Finished running facial recognition on image, {gate}, {scheduler}')
+                # Say hello to new users and update the last seen time of the others
+                presence.seen(rec.who)
     except KeyboardInterrupt:
-        if PYCAMERA:
-            camera.close()
+        pass
     finally:
-        if PYCAMERA:
-            camera.close()
+        if USE_SERVICE:
+            rec.close()
+        else:
+            # keep the unknown faces seen so far for enrollment
+            rec.unknowns.save()
@@ -3,3 +3,9 @@ OUTPUT_STRING_FILE = "say.txt"
 INPUT_STRING_FILE = "microphone.txt"
 CAMERA_OUTPUT_FILE = "unknown.jpg"
 SPEAKER_FILE = "speech.wav"
+GALLERY_MATRIX_FILE = "gallery.f32"
+GALLERY_NAMES_FILE = "gallery.names"
+RECOGNITION_SOCKET = "recognition.sock"
+BUS_SOCKET = "bus.sock"
+TRANSCRIPT_LOG = "transcripts"
+WEATHER_STATE = "smartmirror-weather"
@@ -0,0 +1,165 @@
+import ctypes
+import ctypes.util
+import os
+import select
+import struct
+import time
+
+# inotify event masks from <sys/inotify.h>
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+WATCH_MASK = IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+EVENT_HEADER = struct.Struct('iIII')  # wd, mask, cookie, len
+
+
+class PollingWatcher:
+    """
+    Detects changes to a set of files by comparing their modification time and size every interval seconds.
+    A directory changes when any file in it is created, removed or changed.
+    """
+
+    def __init__(self, paths, interval: float = 0.5):
+        """
+        :param paths: files or directories to watch, files do not have to exist yet
+        :param interval: seconds between checks
+        """
+        self.paths = [os.path.abspath(path) for path in paths]
+        self.interval = interval
+        self._stats = {path: self._stat(path) for path in self.paths}
+        self._next_check = time.monotonic() + interval
+
+    @staticmethod
+    def _stat(path: str):
+        try:
+            if os.path.isdir(path):
+                return tuple(sorted((entry.name, entry.stat().st_mtime_ns, entry.stat().st_size)
+                                    for entry in os.scandir(path) if entry.is_file()))
+            stat = os.stat(path)
+            return stat.st_mtime_ns, stat.st_size, stat.st_ino
+        except FileNotFoundError:
+            return None
+
+    def _check(self) -> set:
+        changed = set()
+        for path in self.paths:
+            stat = self._stat(path)
+            if stat != self._stats[path]:
+                self._stats[path] = stat
+                changed.add(path)
+        self._next_check = time.monotonic() + self.interval
+        return changed
+
+    def wait(self, timeout: float = None) -> set:
+        """
+        Blocks until at least one file changed or the timeout passed
+
+        :param timeout: seconds to wait, 0 to only check, None to wait forever
+        :return: set of absolute paths that changed
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            now = time.monotonic()
+            if now >= self._next_check:
+                changed = self._check()
+                if changed:
+                    return changed
+            if deadline is not None and now >= deadline:
+                return set()
+            wake = self._next_check if deadline is None else min(self._next_check, deadline)
+            time.sleep(max(0.0, wake - time.monotonic()))
+
+    def fileno(self):
+        return None
+
+    def close(self):
+        pass
+
+
+class InotifyWatcher:
+    """
+    Linux inotify watch on the directories holding a set of files. Watching the directory rather
+    than the file also catches files that are replaced by renaming a new file over them.
+    A watched directory is reported whenever any file in it changes.
+    """
+
+    def __init__(self, paths):
+        """
+        :param paths: files to watch, their directories must exist, or directories to watch
+        """
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self.paths = set(os.path.abspath(path) for path in paths)
+        self.fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        self._directories = {}
+        for directory in set(path if os.path.isdir(path) else os.path.dirname(path) for path in self.paths):
+            wd = libc.inotify_add_watch(self.fd, os.fsencode(directory), WATCH_MASK)
+            if wd < 0:
+                os.close(self.fd)
+                raise OSError(ctypes.get_errno(), f'inotify_add_watch failed on {directory}')
+            self._directories[wd] = directory
+
+    def _read(self) -> set:
+        changed = set()
+        try:
+            data = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return changed
+        offset = 0
+        while offset < len(data):
+            wd, mask, cookie, length = EVENT_HEADER.unpack_from(data, offset)
+            offset += EVENT_HEADER.size
+            name = data[offset:offset + length].rstrip(b'\0')
+            offset += length
+            directory = self._directories.get(wd, '')
+            path = os.path.join(directory, os.fsdecode(name))
+            if path in self.paths:
+                changed.add(path)
+            if directory in self.paths:
+                changed.add(directory)
+        return changed
+
+    def wait(self, timeout: float = None) -> set:
+        """
+        Blocks until at least one file changed or the timeout passed
+
+        :param timeout: seconds to wait, 0 to only check, None to wait forever
+        :return: set of absolute paths that changed
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            remaining = None if deadline is None else max(0.0, deadline - time.monotonic())
+            ready, _, _ = select.select([self.fd], [], [], remaining)
+            if ready:
+                changed = self._read()
+                if changed:
+                    return changed
+            elif deadline is not None:
+                return set()
+
+    def fileno(self):
+        return self.fd
+
+    def close(self):
+        if self.fd >= 0:
+            os.close(self.fd)
+            self.fd = -1
+
+
+def watch_files(paths, interval: float = 0.5):
+    """
+    Watches files with inotify on Linux and falls back to polling their modification times elsewhere
+
+    :param paths: files or directories to watch
+    :param interval: seconds between checks when polling
+    :return: InotifyWatcher or PollingWatcher, both provide wait(timeout) and close()
+    """
+    try:
+        return InotifyWatcher(paths)
+    except (OSError, AttributeError, TypeError):
+        return PollingWatcher(paths, interval)
@@ -0,0 +1,196 @@
+import os
+import threading
+import time
+from abc import ABC, abstractmethod
+from collections import deque
+
+import numpy as np
+from PIL import Image
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.bmp')
+VIDEO_EXTENSIONS = ('.mp4', '.avi', '.h264', '.mov', '.mkv')
+
+
+class FrameSource(ABC):
+    """
+    Produces RGB numpy frames (height x width x 3, uint8) for FaceRecognizer
+    """
+
+    @abstractmethod
+    def frames(self):
+        """
+        :return: generator of RGB numpy arrays, ends when the source runs out of frames
+        """
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class PiCameraSource(FrameSource):
+    """
+    Continuous capture from the Raspberry Pi camera straight into numpy arrays using the video port
+    """
+
+    def __init__(self, resolution=(640, 480), framerate: int = 10):
+        import picamera
+        import picamera.array
+
+        self._array = picamera.array
+        self.camera = picamera.PiCamera(resolution=resolution, framerate=framerate)
+
+    def frames(self):
+        with self._array.PiRGBArray(self.camera) as output:
+            for _ in self.camera.capture_continuous(output, format='rgb', use_video_port=True):
+                yield output.array.copy()
+                output.truncate(0)
+
+    def close(self):
+        self.camera.close()
+
+
+class ReplaySource(FrameSource):
+    """
+    Replays an image, a directory of images or a video file so recognition can be tested without a camera
+    """
+
+    def __init__(self, path: str, rate: float = None, loop: bool = False):
+        """
+        :param path: image file, directory of image files (played in name order) or video file
+        :param rate: frames per second to play at, None plays as fast as frames are read
+        :param loop: start over at the first frame after the last one
+        """
+        self.path = path
+        self.rate = rate
+        self.loop = loop
+
+    def _files(self) -> list:
+        if os.path.isdir(self.path):
+            return [os.path.join(self.path, name) for name in sorted(os.listdir(self.path))
+                    if name.lower().endswith(IMAGE_EXTENSIONS)]
+        return [self.path]
+
+    def _read_video(self):
+        import cv2
+
+        capture = cv2.VideoCapture(self.path)
+        try:
+            while True:
+                grabbed, frame = capture.read()
+                if not grabbed:
+                    return
+                yield cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
+        finally:
+            capture.release()
+
+    def _read_once(self):
+        if self.path.lower().endswith(VIDEO_EXTENSIONS):
+            yield from self._read_video()
+        else:
+            for file in self._files():
+                yield np.array(Image.open(file).convert('RGB'))
+
+    def frames(self):
+        next_frame = time.monotonic()
+        while True:
+            played = False
+            for frame in self._read_once():
+                played = True
+                if self.rate:
+                    time.sleep(max(0.0, next_frame - time.monotonic()))
+                    next_frame = max(next_frame + 1 / self.rate, time.monotonic())
+                yield frame
+            if not self.loop or not played:
+                return
+
+
+class LatestFrameQueue:
+    """
+    Bounded queue between a capture thread and the recognizer. When it is full the oldest frame is
+    dropped and get() always hands out the newest frame, discarding any older ones still waiting.
+    """
+
+    def __init__(self, maxsize: int = 1):
+        self._frames = deque(maxlen=maxsize)
+        self._condition = threading.Condition()
+        self.closed = False
+        self.received = 0
+        self.dropped = 0
+
+    def put(self, frame: np.ndarray):
+        with self._condition:
+            if len(self._frames) == self._frames.maxlen:
+                self.dropped += 1
+            self._frames.append(frame)
+            self.received += 1
+            self._condition.notify()
+
+    def get(self, timeout: float = None):
+        """
+        :param timeout: seconds to wait for a frame, None waits forever
+        :return: the newest frame or None if the timeout passed or the queue was closed
+        """
+        with self._condition:
+            if not self._condition.wait_for(lambda: self._frames or self.closed, timeout):
+                return None
+            if not self._frames:
+                return None
+            frame = self._frames.pop()
+            self.dropped += len(self._frames)
+            self._frames.clear()
+            return frame
+
+    def close(self):
+        with self._condition:
+            self.closed = True
+            self._condition.notify_all()
+
+
+class CaptureThread:
+    """
+    Reads a FrameSource on a background thread into a LatestFrameQueue so the recognizer
+    always works on the freshest frame instead of a backlog
+    """
+
+    def __init__(self, source: FrameSource, maxsize: int = 1):
+        self.source = source
+        self.queue = LatestFrameQueue(maxsize)
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='CaptureThread', daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        try:
+            for frame in self.source.frames():
+                if self._stop.is_set():
+                    break
+                self.queue.put(frame)
+        finally:
+            self.queue.close()
+
+    def read(self, timeout: float = None):
+        """
+        :param timeout: seconds to wait for a frame, None waits forever
+        :return: newest RGB frame or None if none arrived in time or the source ended
+        """
+        return self.queue.get(timeout)
+
+    @property
+    def alive(self) -> bool:
+        return not self.queue.closed
+
+    def close(self):
+        self._stop.set()
+        self.source.close()
+        self._thread.join(timeout=1)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
@@ -0,0 +1,14 @@
+import random
+
+POSSIBLE_GREETINGS = ['You look wonderful', 'Hello', 'Nice to see you', 'Whats the haps', 'Hows it hanging',
+                      'Welcome', 'Welcome to your doom', 'You are crushing it today', 'Good morning',
+                      ' Good afternoon', 'Good evening', 'Hi', 'Hey', 'Good to see you', "It's great to see you"]
+
+
+def greeting(user: str) -> str:
+    """
+    :param user: name of the person who just arrived
+    :return: a random greeting for them
+    """
+    # Select a random greeting
+    return f'{POSSIBLE_GREETINGS[random.randrange(len(POSSIBLE_GREETINGS))]}, {user}'
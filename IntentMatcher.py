@@ -0,0 +1,171 @@
+from collections import Counter, deque
+
+
+def normalize(text: str) -> str:
+    """
+    :return: text in lower case with runs of whitespace collapsed to single spaces
+    """
+    return ' '.join(text.lower().split())
+
+
+class AhoCorasick:
+    """
+    Finds every occurrence of a fixed set of phrases in one pass over the text, so the time taken grows
+    with the length of the text rather than with the number of phrases. Occurrences may overlap, like
+    separate substring checks for each phrase.
+    """
+
+    def __init__(self, phrases: list):
+        """
+        :param phrases: strings to find
+        """
+        self.phrases = list(phrases)
+        goto = [{}]
+        outputs = [set()]
+        for index, phrase in enumerate(self.phrases):
+            state = 0
+            for char in phrase:
+                if char not in goto[state]:
+                    goto.append({})
+                    outputs.append(set())
+                    goto[state][char] = len(goto) - 1
+                state = goto[state][char]
+            outputs[state].add(index)
+        # breadth first so every state's failure state is finished before the state itself
+        fail = [0] * len(goto)
+        order = []
+        queue = deque(goto[0].values())
+        while queue:
+            state = queue.popleft()
+            order.append(state)
+            for char, child in goto[state].items():
+                queue.append(child)
+                link = fail[state]
+                while link and char not in goto[link]:
+                    link = fail[link]
+                fail[child] = goto[link].get(char, 0)
+                outputs[child] |= outputs[fail[child]]
+        # fold the failure links into the transitions, matching then takes one lookup per character
+        self._next = [dict(goto[0])] + [None] * (len(goto) - 1)
+        for state in order:
+            transitions = dict(self._next[fail[state]])
+            transitions.update(goto[state])
+            self._next[state] = transitions
+        self._outputs = [tuple(sorted(found)) for found in outputs]
+
+    def find(self, text: str) -> set:
+        """
+        :return: indices of the phrases that occur in text
+        """
+        found = set()
+        state = 0
+        transitions, outputs = self._next, self._outputs
+        for char in text:
+            state = transitions[state].get(char, 0)
+            if outputs[state]:
+                found.update(outputs[state])
+        return found
+
+
+class IntentMatcher:
+    """
+    Compiles the trigger phrases of every intent into one AhoCorasick automaton, so a line is scanned
+    once however many intents there are. An intent's phrases are split into named groups, such as the
+    activation word and the words choosing what to answer, and matching counts how many distinct
+    phrases of each group were found.
+    """
+
+    def __init__(self):
+        self.groups = {}  # (intent, group) -> phrases
+        self._automaton = None
+        self._targets = []  # phrase index -> (intent, group) of every group holding the phrase
+
+    def add(self, intent: str, group: str, phrases):
+        """
+        :param intent: name of the intent
+        :param group: name of the group within the intent
+        :param phrases: lower case phrases that count for the group
+        """
+        self.groups.setdefault((intent, group), set()).update(phrases)
+        self._automaton = None
+
+    def compile(self):
+        targets = {}
+        for key, phrases in self.groups.items():
+            for phrase in phrases:
+                targets.setdefault(phrase, []).append(key)
+        self._automaton = AhoCorasick(list(targets))
+        self._targets = list(targets.values())
+
+    def match(self, text: str) -> dict:
+        """
+        :param text: normalize()d line
+        :return: intent -> Counter of group -> number of the group's phrases found, only intents with a phrase found
+        """
+        if self._automaton is None:
+            self.compile()
+        hits = {}
+        for index in self._automaton.find(text):
+            for intent, group in self._targets[index]:
+                hits.setdefault(intent, Counter())[group] += 1
+        return hits
+
+
+if __name__ == "__main__":
+    import argparse
+    import random
+    import time
+
+    from TranscriptLog import TranscriptLog
+
+    parser = argparse.ArgumentParser(description='Compare scanning transcript lines for every keyword list with '
+                                                 'one pass of the compiled intent matcher')
+    parser.add_argument('--lines', type=int, default=100000, help='lines in the generated corpus')
+    parser.add_argument('--log', action='store_true', help='use the lines of the transcript log instead')
+    parser.add_argument('--intents', type=int, nargs='*', default=[0, 10, 100],
+                        help='numbers of made up intents to add on top of the parsers\' own')
+    args = parser.parse_args()
+
+    import CommandParser
+
+    if args.log:
+        # read the segments directly, a reader's offset would hold back compaction of the log
+        corpus = []
+        for _, path in TranscriptLog().segments():
+            with open(path, encoding='utf-8') as fin:
+                corpus.extend(fin.read().splitlines())
+    else:
+        random.seed(0)
+        vocabulary = sorted({word for (_, _), phrases in CommandParser.registry.matcher.groups.items()
+                             for phrase in phrases for word in phrase.split()} |
+                            set('mirror what is the how please tell me about it and a to of know snow someone '
+                                'play some music turn lights kitchen'.split()))
+        corpus = [' '.join(random.choice(vocabulary) for _ in range(random.randint(3, 15)))
+                  for _ in range(args.lines)]
+    print(f"{len(corpus)} lines")
+
+    for extra in args.intents:
+        matcher = IntentMatcher()
+        for key, phrases in CommandParser.registry.matcher.groups.items():
+            matcher.add(*key, phrases)
+        random.seed(extra)
+        for i in range(extra):
+            matcher.add(f'made up {i}', 'trigger',
+                        [' '.join(random.choice(corpus).split()[:2]) + f' {i}' for _ in range(3)])
+        matcher.compile()
+        groups = [sorted(phrases) for phrases in matcher.groups.values()]
+
+        # what the parsers did before: a lower() and a substring check per phrase of every list
+        start = time.perf_counter()
+        for line in corpus:
+            for phrases in groups:
+                lowered = line.lower()
+                sum(phrase in lowered for phrase in phrases)
+        scanned = time.perf_counter() - start
+        start = time.perf_counter()
+        for line in corpus:
+            matcher.match(normalize(line))
+        matched = time.perf_counter() - start
+        phrases = sum(len(phrases) for phrases in groups)
+        print(f"{phrases:5d} phrases: keyword scans {scanned / len(corpus) * 1e6:6.2f} us, "
+              f"intent matcher {matched / len(corpus) * 1e6:6.2f} us per line")
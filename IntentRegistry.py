@@ -0,0 +1,125 @@
+import time
+from enum import Enum
+
+from IntentMatcher import IntentMatcher, normalize
+
+
+# How expensive running an intent's parse is, cheaper intents are tried first
+class Cost(Enum):
+    MEMORY = 0  # answers from what it already holds
+    LOCAL = 1  # reads files or shared memory on this machine
+    EXTERNAL = 2  # runs commands or reaches other machines
+
+
+class Intent:
+    """
+    A parser registered with an IntentRegistry, with what it declared and what it has done since
+    """
+
+    def __init__(self, parser, order: int):
+        """
+        :param parser: object with name, phrases (group -> trigger phrases), score(hits) and parse(string, hits),
+                       and optionally priority, cost and side_effects
+        :param order: registration order, the last tie breaker
+        """
+        self.parser = parser
+        self.name = parser.name
+        self.priority = getattr(parser, 'priority', 0)  # higher is tried first among intents of the same cost
+        self.cost = getattr(parser, 'cost', Cost.MEMORY)
+        self.side_effects = getattr(parser, 'side_effects', False)  # once it ran the line counts as handled
+        self.order = order
+        self.matches = 0  # lines it scored above 0 on
+        self.calls = 0  # times its parse ran
+        self.hits = 0  # times its parse answered
+        self.total_time = 0.0
+        self.max_time = 0.0
+
+    def sort_key(self) -> tuple:
+        return self.cost.value, -self.priority, self.order
+
+    def run(self, text: str, hits):
+        start = time.perf_counter()
+        try:
+            return self.parser.parse(text, hits)
+        finally:
+            elapsed = time.perf_counter() - start
+            self.calls += 1
+            self.total_time += elapsed
+            self.max_time = max(self.max_time, elapsed)
+
+
+class IntentRegistry:
+    """
+    Parsers register here with their trigger phrases, priority, cost and whether they have side effects,
+    instead of being chained by hand. Every line is matched against all trigger phrases in one pass, then
+    the matching intents are tried cheapest and highest priority first and dispatch stops at the first
+    one that answers. An intent with side effects ends dispatch as soon as it has run, answer or not,
+    so its command is never carried out twice.
+    """
+
+    def __init__(self):
+        self.intents = {}
+        self.matcher = IntentMatcher()
+        self._order = []
+
+    def register(self, parser):
+        """
+        :param parser: see Intent, its name must not be registered yet
+        :return: the parser, so a module can register one as it creates it
+        """
+        if parser.name in self.intents:
+            raise ValueError(f'An intent named {parser.name} is already registered')
+        intent = Intent(parser, len(self.intents))
+        self.intents[intent.name] = intent
+        for group, phrases in parser.phrases.items():
+            self.matcher.add(intent.name, group, phrases)
+        self._order = sorted(self.intents.values(), key=Intent.sort_key)
+        return parser
+
+    def dispatch(self, line: str) -> tuple:
+        """
+        :param line: heard line
+        :return: (name of the intent that answered, answer), or None if no intent answered. The answer is None
+                 when an intent with side effects ran without replying.
+        """
+        text = normalize(line)
+        hits = self.matcher.match(text)
+        for intent in self._order:
+            intent_hits = hits.get(intent.name)
+            if intent_hits is None:
+                continue
+            score = intent.parser.score(intent_hits)
+            if score <= 0:
+                continue
+            intent.matches += 1
+            answer = intent.run(text, intent_hits)
+            if answer is not None:
+                intent.hits += 1
+            if answer is not None or intent.side_effects:
+                return intent.name, answer
+        return None
+
+    def report(self) -> dict:
+        """
+        :return: intent -> lines matched, parse calls, answers and parse latency
+        """
+        return {name: {'matches': intent.matches, 'calls': intent.calls, 'hits': intent.hits,
+                       'mean_latency': intent.total_time / intent.calls if intent.calls else 0.0,
+                       'max_latency': intent.max_time}
+                for name, intent in self.intents.items()}
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Show which intent answers each line and the per intent statistics')
+    parser.add_argument('lines', nargs='+', help='lines to dispatch')
+    args = parser.parse_args()
+
+    import CommandParser
+
+    for line in args.lines:
+        print(f"{line!r}: {CommandParser.registry.dispatch(line)}")
+    for name, stats in CommandParser.registry.report().items():
+        print(f"{name}: {stats['matches']} matches, {stats['hits']} answers of {stats['calls']} calls, "
+              f"mean latency {stats['mean_latency'] * 1000:.2f} ms, max {stats['max_latency'] * 1000:.2f} ms")
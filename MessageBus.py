@@ -0,0 +1,389 @@
+import json
+import os
+import selectors
+import socket
+import time
+from collections import deque
+from enum import Enum
+
+from FileSettings import BUS_SOCKET, OUTPUT_STRING_FILE, WEATHER_FILE
+from SocketMessages import pack_message, send_message, unpack_messages
+from WeatherSnapshot import WeatherSnapshot
+
+MAX_BUFFER = 4 << 20  # bytes a subscriber may fall behind by before it is disconnected
+PERSIST_MAX_BYTES = 1 << 20  # a topic's log is rotated to .1 past this size
+
+
+# Topics messages are published on
+class Topic(Enum):
+    TRANSCRIPTS = 'transcripts'  # text heard by SpeechToText, also appended to the TranscriptLog
+    SAY = 'say'  # text for the mirror to speak
+    WEATHER = 'weather'  # whole weather snapshot from WeatherApi
+    PRESENCE = 'presence'  # people arriving at and leaving the mirror
+
+
+# the last message of these topics is kept and sent to every new subscriber
+RETAINED_TOPICS = {Topic.WEATHER}
+# the text files the processes used to talk through before the bus, transcripts are kept in a TranscriptLog
+MIRROR_FILES = {Topic.SAY: OUTPUT_STRING_FILE, Topic.WEATHER: WEATHER_FILE}
+
+
+def mirror_to_file(topic: Topic, data, cls=None):
+    """
+    Writes a message to the text file its topic used before the bus, so older readers keep working.
+    Text topics are appended as a line, the weather file is published as a new versioned WeatherSnapshot.
+
+    :param topic: topic of the message
+    :param data: message data
+    :param cls: json.JSONEncoder subclass for the weather snapshot
+    """
+    path = MIRROR_FILES.get(topic)
+    if path is None:
+        return
+    if topic == Topic.WEATHER:
+        WeatherSnapshot(path).publish(data, cls)
+    else:
+        with open(path, 'a') as fout:
+            fout.write(f'{data}\n')
+
+
+class _Connection:
+    def __init__(self, sock: socket.socket):
+        self.sock = sock
+        self.received = bytearray()
+        self.pending = bytearray()
+        self.topics = set()
+
+
+class MessageBus:
+    """
+    Local publish/subscribe broker on a Unix socket. Publishers send a message to a topic and the
+    broker forwards it straight away to every connection subscribed to the topic, so nobody has to
+    poll. Runs on one thread with non blocking sockets, a slow subscriber only grows its own send
+    buffer until it reaches MAX_BUFFER and is dropped.
+    """
+
+    def __init__(self, socket_path: str = BUS_SOCKET, persist_dir: str = None, mirror_files: bool = False):
+        """
+        :param socket_path: path of the Unix socket to listen on
+        :param persist_dir: directory every message is appended to, one json lines log per topic, None to not keep them.
+                            Retained messages are read back from it when the broker starts.
+        :param mirror_files: also write messages to the text files of MIRROR_FILES for readers not on the bus
+        """
+        self.socket_path = socket_path
+        self.persist_dir = persist_dir
+        self.mirror_files = mirror_files
+        self.retained = {}  # topic -> last message sent on it
+        self.sequence = 0
+        self.connections = {}
+        self.selector = selectors.DefaultSelector()
+        self._running = False
+        # written to by shutdown() to wake the selector
+        self._wake_read, self._wake_write = socket.socketpair()
+        if persist_dir is not None:
+            os.makedirs(persist_dir, exist_ok=True)
+            self._load_retained()
+
+    def _log_path(self, topic: Topic) -> str:
+        return os.path.join(self.persist_dir, f'{topic.value}.log')
+
+    def _load_retained(self):
+        for topic in RETAINED_TOPICS:
+            path = self._log_path(topic)
+            if os.path.exists(path) and os.path.getsize(path):
+                with open(path, 'rb') as fin:
+                    # the last line of the log is the latest message
+                    fin.seek(max(0, os.path.getsize(path) - MAX_BUFFER))
+                    lines = fin.read().splitlines()
+                if lines:
+                    message = json.loads(lines[-1])
+                    self.retained[topic] = message
+                    self.sequence = max(self.sequence, message['seq'])
+
+    def _persist(self, topic: Topic, message: dict):
+        path = self._log_path(topic)
+        if os.path.exists(path) and os.path.getsize(path) > PERSIST_MAX_BYTES:
+            os.replace(path, path + '.1')
+        with open(path, 'a') as fout:
+            fout.write(json.dumps(message, separators=(',', ':')) + '\n')
+
+    def serve_forever(self):
+        """
+        Forwards messages until shutdown() is called
+        """
+        if os.path.exists(self.socket_path):
+            # left behind by a broker that did not shut down cleanly
+            os.remove(self.socket_path)
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        server.bind(self.socket_path)
+        server.listen()
+        server.setblocking(False)
+        self.selector.register(server, selectors.EVENT_READ)
+        self.selector.register(self._wake_read, selectors.EVENT_READ)
+        self._running = True
+        print(f"Message bus listening on {self.socket_path}")
+        try:
+            while self._running:
+                for key, events in self.selector.select():
+                    if key.fileobj is server:
+                        self._accept(server)
+                    elif key.fileobj is self._wake_read:
+                        self._wake_read.recv(64)
+                    else:
+                        # forwarding an earlier event of this batch may have closed the connection
+                        connection = key.data
+                        if events & selectors.EVENT_READ and self._is_open(connection):
+                            self._read(connection)
+                        if events & selectors.EVENT_WRITE and self._is_open(connection):
+                            self._write(connection)
+        finally:
+            for connection in list(self.connections.values()):
+                self._close(connection)
+            self.selector.unregister(server)
+            server.close()
+            os.remove(self.socket_path)
+
+    def shutdown(self):
+        self._running = False
+        self._wake_write.send(b'\0')
+
+    def _accept(self, server: socket.socket):
+        sock, _ = server.accept()
+        sock.setblocking(False)
+        connection = _Connection(sock)
+        self.connections[sock] = connection
+        self.selector.register(sock, selectors.EVENT_READ, connection)
+
+    def _is_open(self, connection: _Connection) -> bool:
+        return self.connections.get(connection.sock) is connection
+
+    def _close(self, connection: _Connection):
+        if not self._is_open(connection):
+            # already closed by an earlier failure
+            return
+        self.selector.unregister(connection.sock)
+        del self.connections[connection.sock]
+        connection.sock.close()
+
+    def _read(self, connection: _Connection):
+        try:
+            data = connection.sock.recv(1 << 16)
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError:
+            data = b''
+        if not data:
+            self._close(connection)
+            return
+        connection.received += data
+        try:
+            messages = unpack_messages(connection.received)
+        except (ConnectionError, ValueError) as e:
+            print(f"Dropping bus client that sent a bad message: {e}")
+            self._close(connection)
+            return
+        for message, _ in messages:
+            if not self._is_open(connection):
+                # answering an earlier message dropped it
+                return
+            try:
+                self._handle(connection, message)
+            except (ValueError, KeyError) as e:
+                print(f"Ignoring bad bus message {message}: {e}")
+
+    def _handle(self, connection: _Connection, message: dict):
+        op = message.get('op')
+        if op == 'subscribe':
+            topics = {Topic(name) for name in message.get('topics', [])}
+            connection.topics |= topics
+            for topic in topics & set(self.retained):
+                self._send(connection, self.retained[topic])
+        elif op == 'publish':
+            self.publish(Topic(message['topic']), message.get('data'))
+
+    def publish(self, topic: Topic, data):
+        """
+        Sends a message to every subscriber of the topic
+
+        :param topic: topic to publish on
+        :param data: json serializable message data
+        """
+        self.sequence += 1
+        message = {'op': 'message', 'topic': topic.value, 'data': data, 'seq': self.sequence, 'time': time.time()}
+        if topic in RETAINED_TOPICS:
+            self.retained[topic] = message
+        if self.persist_dir is not None:
+            self._persist(topic, message)
+        if self.mirror_files:
+            mirror_to_file(topic, data)
+        for connection in list(self.connections.values()):
+            if topic in connection.topics:
+                self._send(connection, message)
+
+    def _send(self, connection: _Connection, message: dict):
+        was_empty = not connection.pending
+        connection.pending += pack_message(message)
+        if len(connection.pending) > MAX_BUFFER:
+            print("Dropping bus subscriber that stopped reading")
+            self._close(connection)
+            return
+        self._write(connection)
+        if not self._is_open(connection):
+            return
+        if was_empty and connection.pending:
+            self.selector.modify(connection.sock, selectors.EVENT_READ | selectors.EVENT_WRITE, connection)
+
+    def _write(self, connection: _Connection):
+        try:
+            sent = connection.sock.send(connection.pending)
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError:
+            self._close(connection)
+            return
+        del connection.pending[:sent]
+        if not connection.pending:
+            self.selector.modify(connection.sock, selectors.EVENT_READ, connection)
+
+
+class BusClient:
+    """
+    Connection to the MessageBus for publishing and subscribing. When the broker is not running,
+    published messages fall back to the text files of MIRROR_FILES so the mirror still works.
+    """
+
+    def __init__(self, socket_path: str = BUS_SOCKET, topics=(), object_hook=None, fallback: bool = True):
+        """
+        :param socket_path: path of the broker's Unix socket
+        :param topics: Topics to subscribe to
+        :param object_hook: json object hook applied to received messages, such as WeatherJSON.weather_hook
+        :param fallback: write published messages to the old text files while the broker can not be reached
+        """
+        self.socket_path = socket_path
+        self.topics = set(topics)
+        self.object_hook = object_hook
+        self.fallback = fallback
+        self.sock = None
+        # kept between receive calls, a timeout may fall in the middle of a message
+        self._received = bytearray()
+        self._messages = deque()
+        self.connect()
+
+    @property
+    def connected(self) -> bool:
+        return self.sock is not None
+
+    def connect(self) -> bool:
+        """
+        (Re)connects to the broker and subscribes to self.topics
+
+        :return: whether the broker could be reached
+        """
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.connect(self.socket_path)
+        except OSError:
+            sock.close()
+            self.sock = None
+            return False
+        self.sock = sock
+        self._received = bytearray()
+        self._messages.clear()
+        if self.topics:
+            send_message(self.sock, {'op': 'subscribe', 'topics': [topic.value for topic in self.topics]})
+        return True
+
+    def publish(self, topic: Topic, data, cls=None):
+        """
+        :param topic: topic to publish on
+        :param data: message data
+        :param cls: json.JSONEncoder subclass for values json can not encode itself, such as WeatherJSON.WeatherEncoder
+        """
+        for _ in range(2):
+            if self.sock is None and not self.connect():
+                break
+            try:
+                send_message(self.sock, {'op': 'publish', 'topic': topic.value, 'data': data}, cls=cls)
+                return
+            except OSError:
+                # the broker restarted, try a new connection once
+                self.close()
+        if self.fallback:
+            mirror_to_file(topic, data, cls)
+
+    def subscribe(self, topics):
+        """
+        :param topics: more Topics to receive
+        """
+        topics = set(topics) - self.topics
+        self.topics |= topics
+        if self.sock is not None and topics:
+            send_message(self.sock, {'op': 'subscribe', 'topics': [topic.value for topic in topics]})
+
+    def receive(self, timeout: float = None) -> tuple:
+        """
+        Waits for the next message on a subscribed topic
+
+        :param timeout: seconds to wait, None waits forever
+        :return: (Topic, data), or None if the timeout passed
+        """
+        if self.sock is None:
+            raise ConnectionError(f'Message bus at {self.socket_path} is not running')
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while not self._messages:
+            remaining = None if deadline is None else deadline - time.monotonic()
+            if remaining is not None and remaining <= 0:
+                return None
+            self.sock.settimeout(remaining)
+            try:
+                data = self.sock.recv(1 << 16)
+            except socket.timeout:
+                return None
+            if not data:
+                self.close()
+                raise ConnectionError('Message bus closed the connection')
+            self._received += data
+            self._messages.extend(unpack_messages(self._received, self.object_hook))
+        message, _ = self._messages.popleft()
+        return Topic(message['topic']), message['data']
+
+    def fileno(self) -> int:
+        return self.sock.fileno()
+
+    def close(self):
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+if __name__ == "__main__":
+    import argparse
+    import signal
+
+    parser = argparse.ArgumentParser(description='Publish/subscribe message bus between the mirror processes')
+    parser.add_argument('--socket', default=BUS_SOCKET, help='path of the Unix socket')
+    parser.add_argument('--persist', metavar='DIR', help='keep every message in a json lines log per topic in DIR')
+    parser.add_argument('--mirror', action='store_true', help='also write messages to the old text files')
+    parser.add_argument('--listen', nargs='*', metavar='TOPIC', help='print the messages of these topics, '
+                                                                      'all of them if none are given, from a running bus')
+    args = parser.parse_args()
+
+    if args.listen is not None:
+        with BusClient(args.socket, [Topic(name) for name in args.listen] or list(Topic)) as client:
+            if not client.connected:
+                raise SystemExit(f'No message bus running at {args.socket}')
+            while True:
+                print(*client.receive())
+    else:
+        bus = MessageBus(args.socket, persist_dir=args.persist, mirror_files=args.mirror)
+        signal.signal(signal.SIGTERM, lambda signum, frame: bus.shutdown())
+        try:
+            bus.serve_forever()
+        except KeyboardInterrupt:
+            pass
@@ -0,0 +1,86 @@
+import time
+
+import numpy as np
+
+GRAY_WEIGHTS = np.array([0.299, 0.587, 0.114], dtype=np.float32)  # ITU-R 601 luma
+
+
+class MotionGate:
+    """
+    Cheap pre-stage for FaceRecognizer.update. Each frame is shrunk to a small grayscale image and
+    compared against a running average background. Face detection only needs to run when enough
+    of the scene changed, or when refresh_interval seconds passed since the last analysis.
+    """
+
+    def __init__(self, sensitivity: float = 0.01, pixel_threshold: float = 12, refresh_interval: float = 5.0,
+                 width: int = 64, background_rate: float = 0.1):
+        """
+        :param sensitivity: fraction of the downsampled pixels that must change to count as motion
+        :param pixel_threshold: gray level difference (0-255) for a pixel to count as changed
+        :param refresh_interval: seconds after which a frame is analysed even if nothing moved
+        :param width: approximate width in pixels of the downsampled frame
+        :param background_rate: how quickly the background model takes in the new frame, 0-1
+        """
+        self.sensitivity = sensitivity
+        self.pixel_threshold = pixel_threshold
+        self.refresh_interval = refresh_interval
+        self.width = width
+        self.background_rate = background_rate
+        self.background = None
+        self.last_analysis = None
+        self.change = 0.0
+        self.analysed = 0
+        self.skipped = 0
+        self.forced = 0
+
+    def _small_gray(self, frame: np.ndarray) -> np.ndarray:
+        """
+        :param frame: RGB or grayscale frame
+        :return: downsampled float32 grayscale frame
+        """
+        step = max(1, frame.shape[1] // self.width)
+        small = frame[::step, ::step]
+        if small.ndim == 3:
+            return small[..., :3] @ GRAY_WEIGHTS
+        return small.astype(np.float32)
+
+    def should_analyze(self, frame: np.ndarray, now: float = None) -> bool:
+        """
+        Updates the background model with the frame and decides if it is worth running recognition on
+
+        :param frame: RGB numpy frame
+        :param now: current time in seconds, defaults to time.monotonic()
+        :return: True if the frame should be analysed
+        """
+        now = time.monotonic() if now is None else now
+        gray = self._small_gray(frame)
+        if self.background is None or self.background.shape != gray.shape:
+            self.background = gray
+            self.change = 1.0
+            return self._analyze(now)
+        difference = np.abs(gray - self.background)
+        self.change = float(np.count_nonzero(difference > self.pixel_threshold)) / difference.size
+        self.background += self.background_rate * (gray - self.background)
+        if self.change >= self.sensitivity:
+            return self._analyze(now)
+        if now - self.last_analysis >= self.refresh_interval:
+            self.forced += 1
+            return self._analyze(now)
+        self.skipped += 1
+        return False
+
+    def _analyze(self, now: float) -> bool:
+        self.analysed += 1
+        self.last_analysis = now
+        return True
+
+    def skip_ratio(self) -> float:
+        """
+        :return: fraction of frames for which detection was skipped
+        """
+        total = self.analysed + self.skipped
+        return self.skipped / total if total else 0.0
+
+    def __str__(self):
+        return f"{self.analysed} analysed ({self.forced} forced), {self.skipped} skipped, " \
+               f"{self.skip_ratio() * 100:.0f}% of frames saved"
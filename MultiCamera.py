@@ -0,0 +1,378 @@
+import multiprocessing
+import os
+import queue
+import time
+from multiprocessing import shared_memory
+
+import numpy as np
+
+from FaceGallery import FaceGallery, ENCODING_DTYPE, ENCODING_SIZE
+from FileWatcher import watch_files
+from Presence import PresenceTracker
+
+
+class SharedGallery:
+    """
+    Read only copy of a FaceGallery's matrix in a shared memory block, so every camera worker
+    matches against the same physical pages instead of loading its own copy. It provides the
+    parts of FaceGallery that FaceMatcher and FaceRecognizer use.
+
+    A gallery is never changed in place. When people are added the owner publishes a new block
+    and the workers switch to it between frames. The owner frees an old block only once every
+    worker has acknowledged a newer one.
+    """
+
+    def __init__(self, memory: shared_memory.SharedMemory, count: int, names: list, removed, generation: int,
+                 owner: bool):
+        self.memory = memory
+        self.names = names
+        self.removed = np.asarray(removed, dtype=np.int64)
+        self.generation = generation
+        self.owner = owner
+        self._matrix = np.ndarray((count, ENCODING_SIZE), dtype=ENCODING_DTYPE, buffer=memory.buf)
+
+    @classmethod
+    def publish(cls, gallery: FaceGallery, generation: int = 0):
+        """
+        Copies a gallery into a new shared memory block
+
+        :param gallery: gallery to share
+        :param generation: must differ from the generation of the copy it replaces so matchers drop their caches
+        :return: SharedGallery that owns the block and unlinks it on close()
+        """
+        matrix = np.asarray(gallery.matrix)
+        # a block can not be empty
+        memory = shared_memory.SharedMemory(create=True, size=max(1, matrix.nbytes))
+        shared = cls(memory, len(matrix), list(gallery.names), gallery.removed, generation, owner=True)
+        shared.matrix[:] = matrix
+        return shared
+
+    @classmethod
+    def attach(cls, description: dict):
+        """
+        :param description: output of describe() in the process that published the gallery
+        :return: SharedGallery mapping the same block
+        """
+        memory = shared_memory.SharedMemory(name=description['memory'])
+        return cls(memory, description['count'], description['names'], description['removed'],
+                   description['generation'], owner=False)
+
+    def describe(self) -> dict:
+        """
+        :return: what another process needs to attach() to the block, small enough to send through a queue
+        """
+        return {'memory': self.memory.name, 'count': len(self), 'names': self.names,
+                'removed': self.removed.tolist(), 'generation': self.generation}
+
+    def __len__(self):
+        return len(self._matrix)
+
+    @property
+    def matrix(self) -> np.ndarray:
+        return self._matrix
+
+    def name(self, index: int) -> str:
+        return self.names[index]
+
+    def exists(self) -> bool:
+        return True
+
+    def load(self):
+        pass
+
+    def refresh(self) -> tuple:
+        # changes arrive as a whole new SharedGallery
+        return [], []
+
+    def close(self):
+        """
+        Unmaps the block, and frees it if this process published it. Processes still attached keep their mapping.
+        """
+        self._matrix = None
+        self.memory.close()
+        if self.owner:
+            self.memory.unlink()
+
+
+class CameraResult:
+    """
+    What one camera worker recognized in one frame
+    """
+
+    def __init__(self, camera: str, time: float, names: list, looking: bool, faces: int):
+        self.camera = camera
+        self.time = time  # time.monotonic(), the same clock in every process
+        self.names = names
+        self.looking = looking
+        self.faces = faces
+
+
+def _camera_worker(camera: str, make_source, description: dict, options: dict, control, results, acks):
+    """
+    Worker process for one camera. Runs the same motion gated, rate scheduled and tracked
+    recognition loop as the single camera mirror and sends a CameraResult per analyzed frame.
+
+    :param camera: name of the camera
+    :param make_source: picklable callable returning the FrameSource, the camera is opened in the worker
+    :param description: SharedGallery.describe() of the gallery to start with
+    :param options: FaceRecognizer keyword arguments
+    :param control: queue of SharedGallery descriptions to switch to, None to stop
+    :param results: queue the CameraResults are put on
+    :param acks: queue a (camera, generation) is put on once the worker has attached to a gallery
+    """
+    from FaceTracker import FaceTracker
+    from FacialRecognition import FaceRecognizer
+    from FrameSource import CaptureThread
+    from MotionGate import MotionGate
+    from RateScheduler import RateScheduler
+
+    gallery = SharedGallery.attach(description)
+    acks.put((camera, gallery.generation))
+    rec = FaceRecognizer(gallery=gallery, tracker=FaceTracker(), **options)
+    gate = MotionGate()
+    scheduler = RateScheduler()
+    next_run = time.monotonic()
+    try:
+        with CaptureThread(make_source()) as capture:
+            while capture.alive:
+                # wait for the next frame on the control queue so a new gallery or stop is picked up straight away
+                try:
+                    message = control.get(timeout=max(0.0, next_run - time.monotonic()))
+                except queue.Empty:
+                    message = False
+                # several galleries may have been published since the last frame, only the newest matters
+                while message:
+                    try:
+                        latest = control.get_nowait()
+                    except queue.Empty:
+                        break
+                    message = latest
+                if message is None:
+                    return
+                if message:
+                    shared = SharedGallery.attach(message)
+                    rec.use_gallery(shared)
+                    gallery.close()
+                    gallery = shared
+                    acks.put((camera, gallery.generation))
+                    continue
+                next_run = time.monotonic() + scheduler.next_interval()
+                frame = capture.read(timeout=scheduler.interval)
+                if frame is None:
+                    continue
+                if not gate.should_analyze(frame):
+                    scheduler.record(motion=False)
+                    continue
+                result = rec.update(frame)
+                scheduler.record(motion=gate.change >= gate.sensitivity, faces=len(result.locations),
+                                 analysis_time=result.total_time())
+                results.put(CameraResult(camera, time.monotonic(), [name for name in result.names if name],
+                                         result.looking, len(result.locations)))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        # the recognizer's matcher holds views of the block, drop them before unmapping it
+        rec = None
+        gallery.close()
+
+
+class MultiCameraRecognizer:
+    """
+    Runs one recognition worker process per camera against a single gallery kept in shared memory,
+    and merges what the cameras see into one PresenceTracker. A person seen by several cameras at
+    once is one person: sightings are merged by name, so presence events fire once per person.
+    """
+
+    def __init__(self, sources: dict, enc_location: str = 'known_faces',
+                 name_conv_location: str = 'pictureNames.conv', presence: PresenceTracker = None,
+                 merge_window: float = 2.0, **options):
+        """
+        :param sources: camera name -> picklable callable returning its FrameSource,
+                        for example functools.partial(ReplaySource, 'camera1/', rate=4, loop=True)
+        :param enc_location: directory holding the face gallery
+        :param name_conv_location: legacy #.enc:name conversion file inside enc_location
+        :param presence: tracker the merged sightings are fed to, defaults to a new PresenceTracker
+        :param merge_window: seconds a camera's last sighting of someone still counts as current
+        :param options: further FaceRecognizer keyword arguments for the workers, such as tolerance
+        """
+        if options.get('use_index'):
+            # workers match against the shared gallery, which has no index saved next to it
+            raise ValueError("use_index can not be used with a shared gallery")
+        self.sources = sources
+        self.gallery = FaceGallery(enc_location)
+        if not self.gallery.exists() and os.path.exists(os.path.join(enc_location, name_conv_location)):
+            self.gallery.migrate_legacy(name_conv_location)
+        self.presence = PresenceTracker() if presence is None else presence
+        self.merge_window = merge_window
+        self.options = dict(options, enc_location=enc_location, name_conv_location=name_conv_location)
+        self.shared = None
+        self.retired = []  # earlier SharedGallerys some worker may still be attached to
+        self.attached = {}  # camera -> generation of the gallery its worker last attached to
+        self.workers = {}
+        self.controls = {}
+        self.results = None
+        self.acks = None
+        self.watcher = None
+        self.latest = {}  # camera -> last CameraResult
+        self.sightings = {}  # name -> {camera: time last seen}
+        self._generation = 0
+
+    def start(self):
+        """
+        Shares the gallery and starts a worker process per camera
+        """
+        self.shared = SharedGallery.publish(self.gallery, self._generation)
+        self.results = multiprocessing.Queue()
+        self.acks = multiprocessing.Queue()
+        for camera, make_source in self.sources.items():
+            self.controls[camera] = multiprocessing.Queue()
+            self.attached[camera] = -1
+            worker = multiprocessing.Process(target=_camera_worker, name=f'camera-{camera}', daemon=True,
+                                             args=(camera, make_source, self.shared.describe(), self.options,
+                                                   self.controls[camera], self.results, self.acks))
+            worker.start()
+            self.workers[camera] = worker
+        self.watcher = watch_files([self.gallery.matrix_path, self.gallery.names_path])
+
+    def _republish(self):
+        """
+        Shares a new copy of the gallery after it changed on disk and points every worker at it
+        """
+        added, removed = self.gallery.refresh()
+        if not added and not removed:
+            return
+        self._generation += 1
+        shared = SharedGallery.publish(self.gallery, self._generation)
+        for control in self.controls.values():
+            control.put(shared.describe())
+        # a worker may not have attached to the old block yet, it is freed once every worker acknowledges a newer one
+        self.retired.append(self.shared)
+        self.shared = shared
+        print(f"Gallery changed, {len(added)} encodings added and {len(removed)} removed")
+
+    def _release(self):
+        """
+        Frees the retired blocks that no running worker can still attach to
+        """
+        try:
+            while True:
+                camera, generation = self.acks.get_nowait()
+                self.attached[camera] = generation
+        except queue.Empty:
+            pass
+        running = [self.attached[camera] for camera, worker in self.workers.items() if worker.is_alive()]
+        oldest = min(running, default=self._generation)
+        for shared in [shared for shared in self.retired if shared.generation < oldest]:
+            shared.close()
+            self.retired.remove(shared)
+
+    def _prune(self, now: float):
+        """
+        Forgets sightings older than merge_window, so people seen once do not stay in sightings forever
+        """
+        cutoff = now - self.merge_window
+        for name in list(self.sightings):
+            cameras = {camera: seen for camera, seen in self.sightings[name].items() if seen >= cutoff}
+            if cameras:
+                self.sightings[name] = cameras
+            else:
+                del self.sightings[name]
+
+    def poll(self, timeout: float = 0.5) -> list:
+        """
+        Merges the results the workers have sent into the presence view
+
+        :param timeout: seconds to wait for the first result
+        :return: list of (PresenceEvent, name) raised by the new sightings
+        """
+        if self.watcher.wait(0):
+            self._republish()
+        self._release()
+        events = []
+        try:
+            result = self.results.get(timeout=timeout)
+            while True:
+                events.extend(self._merge(result))
+                result = self.results.get_nowait()
+        except queue.Empty:
+            pass
+        self._prune(time.monotonic())
+        events.extend(self.presence.expire())
+        return events
+
+    def _merge(self, result: CameraResult) -> list:
+        self.latest[result.camera] = result
+        for name in result.names:
+            self.sightings.setdefault(name, {})[result.camera] = result.time
+        # the tracker only raises ENTERED the first time a name is seen, whichever camera saw it
+        return self.presence.seen(result.names, result.time)
+
+    @property
+    def who(self) -> list:
+        """
+        :return: every person a camera has seen within merge_window, each listed once
+        """
+        now = time.monotonic()
+        return sorted(name for name, cameras in self.sightings.items()
+                      if max(cameras.values()) >= now - self.merge_window) or ['unknown']
+
+    @property
+    def looking(self) -> bool:
+        now = time.monotonic()
+        return any(result.looking for result in self.latest.values() if result.time >= now - self.merge_window)
+
+    def cameras(self, name: str) -> list:
+        """
+        :return: cameras that saw the person within merge_window
+        """
+        now = time.monotonic()
+        return sorted(camera for camera, seen in self.sightings.get(name, {}).items()
+                      if seen >= now - self.merge_window)
+
+    def stop(self):
+        for control in self.controls.values():
+            control.put(None)
+        for worker in self.workers.values():
+            worker.join(timeout=5)
+            if worker.is_alive():
+                worker.terminate()
+        if self.watcher is not None:
+            self.watcher.close()
+        for shared in self.retired:
+            shared.close()
+        self.retired = []
+        if self.shared is not None:
+            self.shared.close()
+            self.shared = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stop()
+
+
+if __name__ == "__main__":
+    import argparse
+    import functools
+
+    from FrameSource import ReplaySource
+
+    parser = argparse.ArgumentParser(description='Recognize faces from several cameras, or directories of frames '
+                                                 'replayed in their place, against one shared gallery')
+    parser.add_argument('sources', nargs='+', help='image directory, image or video file per camera')
+    parser.add_argument('--known', default='known_faces', help='face gallery directory')
+    parser.add_argument('--rate', type=float, default=4, help='frames per second each source is replayed at')
+    parser.add_argument('--loop', action='store_true', help='replay the sources forever')
+    args = parser.parse_args()
+
+    sources = {f'camera{i}': functools.partial(ReplaySource, path, rate=args.rate, loop=args.loop)
+               for i, path in enumerate(args.sources)}
+    with MultiCameraRecognizer(sources, enc_location=args.known) as cameras:
+        try:
+            while any(worker.is_alive() for worker in cameras.workers.values()):
+                for event, name in cameras.poll():
+                    print(f"{event.name} {name} on {', '.join(cameras.cameras(name)) or 'no camera'}")
+        except KeyboardInterrupt:
+            pass
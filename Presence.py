@@ -0,0 +1,118 @@
+import heapq
+import time
+from enum import Enum
+
+
+# What happened to a person at the mirror
+class PresenceEvent(Enum):
+    ENTERED = 0
+    PRESENT = 1
+    LEFT = 2
+
+
+class PresenceTracker:
+    """
+    Keeps track of who is at the mirror. A person has left once they have not been seen for
+    timeout seconds. Expiry deadlines are kept in a heap so finding who left only looks at the
+    people whose deadline has passed. Each name has at most one heap entry, which is pushed back
+    with the real deadline when it pops for someone who was seen again in the meantime.
+    """
+
+    def __init__(self, timeout: float = 60, max_people: int = 256):
+        """
+        :param timeout: seconds without a sighting before a person has left
+        :param max_people: most people tracked at once, the least recently seen is dropped beyond it
+        """
+        self.timeout = timeout
+        self.max_people = max_people
+        self.last_seen = {}  # name -> last time seen
+        self._deadlines = []  # heap of (deadline, name)
+        self._queued = {}  # name -> deadline of its one entry in the heap
+        self._listeners = []
+
+    def add_listener(self, callback):
+        """
+        :param callback: function called as callback(event, name, now) for every PresenceEvent
+        """
+        self._listeners.append(callback)
+
+    def _emit(self, event: PresenceEvent, name: str, now: float) -> tuple:
+        for callback in self._listeners:
+            callback(event, name, now)
+        return event, name
+
+    @property
+    def present(self) -> set:
+        return set(self.last_seen)
+
+    def seen(self, names, now: float = None) -> list:
+        """
+        Records a sighting of each name
+
+        :param names: names recognized in the current frame
+        :param now: current time in seconds, defaults to time.monotonic()
+        :return: list of (PresenceEvent, name), ENTERED for new people and PRESENT for people already here
+        """
+        now = time.monotonic() if now is None else now
+        events = []
+        for name in dict.fromkeys(names):
+            if name in self.last_seen:
+                self.last_seen[name] = now
+                events.append(self._emit(PresenceEvent.PRESENT, name, now))
+                continue
+            if len(self.last_seen) >= self.max_people:
+                events.append(self._leave(min(self.last_seen, key=self.last_seen.get), now))
+            self.last_seen[name] = now
+            if name not in self._queued:
+                self._push(name, now + self.timeout)
+            events.append(self._emit(PresenceEvent.ENTERED, name, now))
+        return events
+
+    def _leave(self, name: str, now: float) -> tuple:
+        del self.last_seen[name]
+        return self._emit(PresenceEvent.LEFT, name, now)
+
+    def expire(self, now: float = None) -> list:
+        """
+        Removes everyone who has not been seen within the timeout
+
+        :param now: current time in seconds, defaults to time.monotonic()
+        :return: list of (PresenceEvent.LEFT, name)
+        """
+        now = time.monotonic() if now is None else now
+        events = []
+        while self._deadlines and self._deadlines[0][0] <= now:
+            deadline, name = heapq.heappop(self._deadlines)
+            del self._queued[name]
+            if name not in self.last_seen:
+                # already dropped to stay under max_people
+                continue
+            renewed = self.last_seen[name] + self.timeout
+            if renewed > now:
+                # seen again since the entry was pushed, push its real deadline
+                self._push(name, renewed)
+            else:
+                events.append(self._leave(name, now))
+        return events
+
+    def _push(self, name: str, deadline: float):
+        heapq.heappush(self._deadlines, (deadline, name))
+        self._queued[name] = deadline
+
+    def next_deadline(self) -> float:
+        """
+        :return: earliest time someone could leave, None if nobody is present. Deadlines are checked
+                 lazily so nobody may actually leave then, expire() just has nothing to do before it.
+        """
+        return self._deadlines[0][0] if self._deadlines else None
+
+
+def sleep_until(deadline: float):
+    """
+    Sleeps until time.monotonic() reaches deadline, returning immediately if it already has
+
+    :param deadline: time.monotonic() value to wake up at
+    """
+    remaining = deadline - time.monotonic()
+    if remaining > 0:
+        time.sleep(remaining)
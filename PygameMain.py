@@ -1,4 +1,4 @@
-import json
+import threading
 from enum import Enum
 
 import pygame
@@ -6,8 +6,13 @@ from pygame import Surface, Color, USEREVENT
 
 from Display import WIDTH, HEIGHT, MAX_FRAME_RATE
 from FileSettings import WEATHER_FILE
+from FileWatcher import watch_files
 from GUI import WeatherWidget
+from MessageBus import BusClient, Topic
+from Supervisor import Heartbeat
 from WeatherJSON import weather_hook
+from WeatherSnapshot import SnapshotReader
+from WeatherState import WeatherStateReader
 
 # CONSTANTS
 BACKGROUND_COLOR = Color(0)
@@ -55,6 +60,33 @@ class SmartMirrorApp:
             my_event = pygame.event.Event(event.get_event())
             pygame.event.post(my_event)
 
+        # redraw the weather as soon as a new forecast is published or written, the timer still re-reads the file
+        self.bus = BusClient(topics=[Topic.WEATHER], object_hook=weather_hook)
+        self.weather_watcher = watch_files([self.weather_file])
+        # the timer reads the shared weather state, or the file when WeatherApi is not sharing it,
+        # and only when a new forecast has been published
+        self.state = WeatherStateReader.open()
+        self.snapshot = SnapshotReader(self.weather_file)
+        threading.Thread(target=self.listen_weather, name='weather-listener', daemon=True).start()
+        # tells the Supervisor the drawing loop has not hung
+        self.heartbeat = Heartbeat.from_environment()
+
+    def listen_weather(self):
+        """
+        Posts a GET_WEATHER event carrying each weather snapshot published on the message bus. While the
+        bus is not running it posts one without a snapshot, which re-reads the file, whenever the file changes.
+        """
+        while not self.done:
+            if not self.bus.connected and not self.bus.connect():
+                if self.weather_watcher.wait(timeout=5):
+                    pygame.event.post(pygame.event.Event(EventTimer.GET_WEATHER.get_event()))
+                continue
+            try:
+                _, weather = self.bus.receive()
+            except ConnectionError:
+                continue
+            pygame.event.post(pygame.event.Event(EventTimer.GET_WEATHER.get_event(), weather=weather))
+
     @staticmethod
     def set_timers():
         """
@@ -63,6 +95,29 @@ class SmartMirrorApp:
         for event in EventTimer:
             pygame.time.set_timer(event.get_event(), event.value)
 
+    def read_weather(self):
+        """
+        :return: weather dict if a new forecast was published since the last read, otherwise None
+        """
+        if self.state is None:
+            self.state = WeatherStateReader.open()
+        if self.state is not None:
+            try:
+                if self.state.changed():
+                    weather = self.state.read()
+                    if weather.version:
+                        print("Re-pulling weather data")
+                        return weather.to_dict()
+                if self.state.version:
+                    # the file holds the same forecast
+                    return None
+            except TimeoutError as e:
+                print(f"{e}, reading the weather file instead")
+        if self.snapshot.changed():
+            print("Re-pulling weather data")
+            return self.snapshot.read()
+        return None
+
     def handle_events(self):
         """
         Runs the logic for event processing
@@ -74,15 +129,20 @@ class SmartMirrorApp:
                 if event.key == pygame.K_ESCAPE:
                     self.done = True
             elif event.type == EventTimer.GET_WEATHER.get_event():
+                if hasattr(event, 'weather'):
+                    weather = event.weather
+                    print("Received weather data")
+                else:
+                    weather = self.read_weather()
+                if weather is None:
+                    continue
                 # draw the weather widget on getWeather event
                 self.background.fill(BACKGROUND_COLOR)
                 # clear the screen a few hundred times to make certain that the weather widget updates properly
                 self.weather_widget.clear(self.screen, self.background)
                 self.weather_widget = WeatherWidget()
                 self.weather_widget.clear(self.screen, self.background)
-                with open(self.weather_file, 'r') as fin:
-                    self.weather = json.load(fin, object_hook=weather_hook)
-                    print("Re-pulling weather data")
+                self.weather = weather
                 self.weather_widget.set_weather(self.weather)
                 self.weather_widget.update()
             elif event.type == EventTimer.GET_TIME.get_event():
@@ -93,6 +153,7 @@ class SmartMirrorApp:
         The game drawing loop which is called until an Exit Event is created
         """
         while not self.done:
+            self.heartbeat.beat()
             self.handle_events()
 
             # Update spites
@@ -0,0 +1,100 @@
+import os
+import time
+
+
+class RateScheduler:
+    """
+    Picks how long the recognition loop waits before its next frame. The loop runs slowly while
+    the mirror is idle, bursts when a face first appears, and stays at an active rate while
+    someone is present or the scene is moving. The interval is always long enough that analysis
+    uses at most max_cpu_share of one core, and it is stretched while the system is loaded.
+    """
+
+    def __init__(self, idle_interval: float = 2.0, active_interval: float = 0.5, burst_interval: float = 0.25,
+                 burst_duration: float = 5.0, active_duration: float = 10.0, max_cpu_share: float = 0.5,
+                 max_load: float = 0.8, smoothing: float = 0.2):
+        """
+        :param idle_interval: seconds between frames when nothing has happened for active_duration
+        :param active_interval: seconds between frames while someone is present or the scene moves
+        :param burst_interval: seconds between frames for burst_duration after a new face appears
+        :param burst_duration: seconds the burst rate lasts
+        :param active_duration: seconds of no motion and nobody present before going idle
+        :param max_cpu_share: most of one core the recognizer may use, leaving the rest for rendering
+        :param max_load: 1 minute load average per CPU above which the interval is stretched
+        :param smoothing: weight of the newest analysis time in its moving average, 0-1
+        """
+        self.idle_interval = idle_interval
+        self.active_interval = active_interval
+        self.burst_interval = burst_interval
+        self.burst_duration = burst_duration
+        self.active_duration = active_duration
+        self.max_cpu_share = max_cpu_share
+        self.max_load = max_load
+        self.smoothing = smoothing
+        self.analysis_time = None
+        self.last_activity = None
+        self.burst_until = None
+        self.faces = 0
+        self.interval = burst_interval
+        self.reason = 'starting'
+
+    def record(self, motion: bool, faces: int = None, analysis_time: float = None, now: float = None):
+        """
+        Records what happened on the last frame
+
+        :param motion: whether the scene changed, for example MotionGate.should_analyze
+        :param faces: number of faces found if the frame was analysed, None if it was skipped
+        :param analysis_time: seconds the analysis took, None if the frame was skipped
+        :param now: current time in seconds, defaults to time.monotonic()
+        """
+        now = time.monotonic() if now is None else now
+        if analysis_time is not None:
+            if self.analysis_time is None:
+                self.analysis_time = analysis_time
+            else:
+                self.analysis_time += self.smoothing * (analysis_time - self.analysis_time)
+        if faces is not None:
+            if faces > self.faces:
+                self.burst_until = now + self.burst_duration
+            self.faces = faces
+        if motion or self.faces > 0:
+            self.last_activity = now
+
+    @staticmethod
+    def load() -> float:
+        """
+        :return: 1 minute load average per CPU, 0 where the platform does not report one
+        """
+        try:
+            return os.getloadavg()[0] / (os.cpu_count() or 1)
+        except (AttributeError, OSError):
+            return 0.0
+
+    def next_interval(self, now: float = None) -> float:
+        """
+        Chooses the wait before the next frame and stores it in self.interval along with self.reason
+
+        :param now: current time in seconds, defaults to time.monotonic()
+        :return: seconds to wait before the next frame
+        """
+        now = time.monotonic() if now is None else now
+        if self.burst_until is not None and now < self.burst_until:
+            interval, reason = self.burst_interval, 'burst, new face'
+        elif self.faces > 0:
+            interval, reason = self.active_interval, 'active, face present'
+        elif self.last_activity is not None and now - self.last_activity < self.active_duration:
+            interval, reason = self.active_interval, 'active, recent motion'
+        else:
+            interval, reason = self.idle_interval, 'idle'
+        if self.analysis_time is not None and self.analysis_time / self.max_cpu_share > interval:
+            interval = self.analysis_time / self.max_cpu_share
+            reason += f', capped at {self.max_cpu_share * 100:.0f}% cpu'
+        load = self.load()
+        if load > self.max_load:
+            interval *= load / self.max_load
+            reason += f', system load {load:.2f}'
+        self.interval, self.reason = interval, reason
+        return interval
+
+    def __str__(self):
+        return f"{1 / self.interval:.2f} fps ({self.reason})"
@@ -0,0 +1,146 @@
+import os
+import socket
+
+import numpy as np
+
+from FileSettings import RECOGNITION_SOCKET
+from SocketMessages import recv_message, send_message
+
+
+class FrameResult:
+    """
+    Everything FaceRecognizer.analyze found in one frame
+    """
+
+    def __init__(self):
+        self.image = None
+        # (top, right, bottom, left) box of each face, in the same order as landmarks
+        self.locations = []
+        # 5 point landmarks and HeadPose of each face
+        self.landmarks = []
+        self.poses = []
+        self.encodings = []
+        # indices into locations of the faces encoded and matched this frame, encodings and matches line up with it
+        self.encoded = []
+        self.matches = []
+        # name of each face in locations (None if unknown) and its track id when the recognizer tracks faces
+        self.names = []
+        self.track_ids = []
+        self.who = ['unknown']
+        self.looking = False
+        # seconds spent in each stage: decode, detect, landmarks, encode, match
+        self.timings = {}
+
+    def total_time(self) -> float:
+        return sum(self.timings.values())
+
+
+def encode_image(image):
+    """
+    Splits an image into the fields and payload of a request
+
+    :param image: path to image file or RGB numpy array
+    :return: (request fields, payload bytes)
+    """
+    if isinstance(image, str):
+        # the daemon reads the file itself, relative paths would be resolved against its directory
+        return {'image': os.path.abspath(image)}, b''
+    image = np.ascontiguousarray(image, dtype=np.uint8)
+    return {'shape': list(image.shape)}, image.tobytes()
+
+
+def decode_image(request: dict, payload: bytes):
+    """
+    :return: the path or RGB numpy array sent with a request
+    """
+    if 'image' in request:
+        return request['image']
+    return np.frombuffer(payload, dtype=np.uint8).reshape(request['shape'])
+
+
+class RecognitionClient:
+    """
+    Connection to a running RecognitionService, with the same calls as FaceRecognizer
+    """
+
+    def __init__(self, socket_path: str = RECOGNITION_SOCKET, timeout: float = 30.0):
+        """
+        :param socket_path: path of the daemon's Unix socket
+        :param timeout: seconds to wait for a response
+        """
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(timeout)
+        self.sock.connect(socket_path)
+        self.who = None
+        self.looking = False
+        self.last_latency = None
+        self._next_id = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self.sock.close()
+
+    def call(self, method: str, image=None, **fields) -> dict:
+        """
+        Sends one request and waits for its response
+
+        :param method: analyze, who_is_it, are_they_looking, add_person, add_people or stats
+        :param image: path to image file or RGB numpy array
+        :return: response fields
+        """
+        self._next_id += 1
+        message = {'id': self._next_id, 'method': method}
+        message.update(fields)
+        payload = b''
+        if image is not None:
+            image_fields, payload = encode_image(image)
+            message.update(image_fields)
+        send_message(self.sock, message, payload)
+        response, _ = recv_message(self.sock)
+        if response is None:
+            raise ConnectionError('Recognition service closed the connection')
+        if 'error' in response:
+            raise RuntimeError(f"Recognition service failed {method}: {response['error']}")
+        self.last_latency = response.get('latency')
+        return response
+
+    def who_is_it(self, unknown_file_name):
+        self.who = self.call('who_is_it', unknown_file_name)['who']
+
+    def are_they_looking(self, unknown_file_name):
+        self.looking = self.call('are_they_looking', unknown_file_name)['looking']
+
+    def add_person(self, image, name: str) -> bool:
+        return self.call('add_person', image, name=name)['added']
+
+    def add_people(self, paths: list, names: list) -> list:
+        """
+        Adds several people in one request, the daemon appends them to the gallery in one write
+
+        :param paths: paths to image files, one face per photo
+        :param names: name of the individual in each image
+        :return: list of booleans as to whether each person was successfully added
+        """
+        # the daemon reads the files itself, relative paths would be resolved against its directory
+        return self.call('add_people', images=[os.path.abspath(path) for path in paths], names=list(names))['added']
+
+    def update(self, image) -> FrameResult:
+        """
+        Analyzes a frame in the daemon, sets self.who and self.looking
+
+        :param image: path to image file or RGB numpy array
+        :return: FrameResult without the encodings and match objects, which stay in the daemon
+        """
+        response = self.call('analyze', image)
+        result = FrameResult()
+        result.locations = [tuple(location) for location in response['locations']]
+        result.names = response['names']
+        result.who = self.who = response['who']
+        result.looking = self.looking = response['looking']
+        result.timings = response['timings']
+        return result
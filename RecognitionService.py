@@ -0,0 +1,297 @@
+import os
+import queue
+import socketserver
+import threading
+import time
+
+from FacialRecognition import FaceRecognizer
+from FileSettings import RECOGNITION_SOCKET
+from RecognitionClient import decode_image
+from SocketMessages import recv_message, send_message
+
+ANALYZE_METHODS = ('analyze', 'who_is_it', 'are_they_looking')
+ADD_METHODS = ('add_person', 'add_people')
+METHODS = ANALYZE_METHODS + ADD_METHODS + ('stats',)
+
+
+class Request:
+    """
+    One call waiting in the daemon's queue
+    """
+
+    def __init__(self, message: dict, payload: bytes):
+        self.message = message
+        self.payload = payload
+        self.method = message.get('method')
+        self.image = None  # decoded by RecognitionService.prepare
+        self.received = time.perf_counter()
+        self.started = None
+        self.response = None
+        self.done = threading.Event()
+
+    def finish(self, response: dict, batch_size: int):
+        now = time.perf_counter()
+        response['id'] = self.message.get('id')
+        response['batch'] = batch_size
+        response['queued'] = self.started - self.received
+        response['latency'] = now - self.received
+        self.response = response
+        self.done.set()
+
+
+class RecognitionService:
+    """
+    Resident recognition daemon. Loads the models and the gallery once and serves who_is_it,
+    are_they_looking, analyze, add_person and add_people calls from other processes over a Unix socket.
+
+    Each connection is handled on its own thread, which queues its requests for a single worker.
+    The worker takes everything that arrives within batch_window seconds of the first request,
+    up to max_batch, and matches all the faces of those images in one pass.
+    """
+
+    def __init__(self, recognizer: FaceRecognizer, socket_path: str = RECOGNITION_SOCKET,
+                 batch_window: float = 0.01, max_batch: int = 8):
+        """
+        :param recognizer: warm recognizer every request is served with
+        :param socket_path: path of the Unix socket to listen on
+        :param batch_window: seconds to wait for more requests after the first one of a batch
+        :param max_batch: most requests handled in one batch
+        """
+        self.recognizer = recognizer
+        self.socket_path = socket_path
+        self.batch_window = batch_window
+        self.max_batch = max_batch
+        self.requests = queue.Queue()
+        # per method count, total and largest latency in seconds
+        self.stats = {method: [0, 0.0, 0.0] for method in METHODS}
+        self._stats_lock = threading.Lock()
+        self.batches = 0
+        self.server = None
+        self._running = False
+
+    def serve_forever(self):
+        """
+        Listens on the socket until shutdown() is called
+        """
+        service = self
+
+        class Handler(socketserver.BaseRequestHandler):
+            def handle(self):
+                while True:
+                    message, payload = recv_message(self.request)
+                    if message is None:
+                        return
+                    send_message(self.request, service.submit(message, payload))
+
+        if os.path.exists(self.socket_path):
+            # left behind by a daemon that did not shut down cleanly
+            os.remove(self.socket_path)
+        self.server = socketserver.ThreadingUnixStreamServer(self.socket_path, Handler)
+        self.server.daemon_threads = True
+        self._running = True
+        worker = threading.Thread(target=self._work, name='recognition-batches', daemon=True)
+        worker.start()
+        print(f"Recognition service listening on {self.socket_path}")
+        try:
+            self.server.serve_forever()
+        finally:
+            self._running = False
+            self.requests.put(None)
+            worker.join()
+            self.server.server_close()
+            if os.path.exists(self.socket_path):
+                os.remove(self.socket_path)
+
+    def shutdown(self):
+        if self.server is not None:
+            self.server.shutdown()
+
+    def submit(self, message: dict, payload: bytes = b'') -> dict:
+        """
+        Queues a request for the batch worker and waits for its response
+
+        :param message: request fields, method and the method's arguments
+        :param payload: raw frame bytes when the image was sent as an array
+        :return: response fields, the method's result plus id, batch, queued and latency
+        """
+        request = Request(message, payload)
+        if request.method == 'stats':
+            request.started = request.received
+            request.finish(self.report(), 0)
+        elif request.method not in METHODS:
+            request.started = request.received
+            request.finish({'error': f'unknown method {request.method}'}, 0)
+        elif self.prepare(request):
+            self.requests.put(request)
+            request.done.wait()
+        self._record(request)
+        return request.response
+
+    def prepare(self, request: Request) -> bool:
+        """
+        Decodes and checks a request before it joins a batch, so a malformed one fails on its own
+
+        :param request: request with a queued method
+        :return: True if it can be queued, otherwise it has been finished with an error
+        """
+        message = request.message
+        try:
+            if request.method == 'add_people':
+                images, names = message['images'], message['names']
+                if not isinstance(images, list) or not isinstance(names, list) or len(images) != len(names):
+                    raise ValueError('images and names must be lists of the same length')
+                if not all(isinstance(image, str) for image in images):
+                    raise ValueError('add_people takes image paths')
+                if not all(isinstance(name, str) for name in names):
+                    raise ValueError('names must be strings')
+            else:
+                request.image = decode_image(message, request.payload)
+                if request.method == 'add_person' and not isinstance(message['name'], str):
+                    raise ValueError('name must be a string')
+        except (KeyError, TypeError, ValueError) as e:
+            request.started = request.received
+            request.finish({'error': f'bad {request.method} request: {e!r}'}, 0)
+            return False
+        return True
+
+    def _record(self, request: Request):
+        if request.method not in self.stats:
+            return
+        with self._stats_lock:
+            stats = self.stats[request.method]
+            stats[0] += 1
+            stats[1] += request.response['latency']
+            stats[2] = max(stats[2], request.response['latency'])
+
+    def report(self) -> dict:
+        """
+        :return: number of batches and the request count and latency of each method
+        """
+        return {'batches': self.batches,
+                'methods': {method: {'count': count, 'mean_latency': total / count if count else 0.0,
+                                     'max_latency': largest}
+                            for method, (count, total, largest) in self.stats.items()}}
+
+    def _next_batch(self) -> list:
+        """
+        Blocks for the first request, then collects whatever else arrives within the batch window
+        """
+        first = self.requests.get()
+        if first is None:
+            return []
+        batch = [first]
+        deadline = time.perf_counter() + self.batch_window
+        while len(batch) < self.max_batch:
+            try:
+                request = self.requests.get(timeout=max(0.0, deadline - time.perf_counter()))
+            except queue.Empty:
+                break
+            if request is None:
+                self._running = False
+                break
+            batch.append(request)
+        return batch
+
+    def _work(self):
+        while self._running:
+            batch = self._next_batch()
+            if not batch:
+                return
+            self.batches += 1
+            start = time.perf_counter()
+            for request in batch:
+                request.started = start
+            try:
+                self._handle(batch)
+            except Exception as e:
+                print(f"Recognition batch of {len(batch)} failed: {e}")
+                for request in batch:
+                    if not request.done.is_set():
+                        request.finish({'error': str(e)}, len(batch))
+
+    def _handle(self, batch: list):
+        """
+        Adds the new people first so the lookups in the same batch already see them, then analyzes
+        every lookup image and matches all their faces together
+        """
+        adds = [request for request in batch if request.method in ADD_METHODS]
+        if adds:
+            images = []
+            names = []
+            for request in adds:
+                if request.method == 'add_people':
+                    images.extend(request.message['images'])
+                    names.extend(request.message['names'])
+                else:
+                    images.append(request.image)
+                    names.append(request.message['name'])
+            added = self.recognizer.add_people(images, names)
+            start = 0
+            for request in adds:
+                count = len(request.message['images']) if request.method == 'add_people' else 1
+                ok = added[start:start + count]
+                request.finish({'added': ok if request.method == 'add_people' else ok[0]}, len(batch))
+                start += count
+
+        lookups = [request for request in batch if request.method in ANALYZE_METHODS]
+        if lookups:
+            try:
+                results = self.recognizer.analyze_batch([request.image for request in lookups])
+            except Exception as e:
+                # an unreadable image fails the whole pass, analyze them one at a time so only its request fails
+                print(f"Recognition batch of {len(lookups)} lookups failed, retrying one at a time: {e}")
+                results = []
+                for request in lookups:
+                    try:
+                        results.append(self.recognizer.analyze_batch([request.image])[0])
+                    except Exception as e:
+                        request.finish({'error': str(e)}, len(batch))
+                        results.append(None)
+            for request, result in zip(lookups, results):
+                if result is None:
+                    continue
+                if request.method == 'who_is_it':
+                    response = {'who': result.who}
+                elif request.method == 'are_they_looking':
+                    response = {'looking': result.looking}
+                else:
+                    response = {'who': result.who, 'looking': result.looking,
+                                'locations': [list(location) for location in result.locations],
+                                'names': result.names,
+                                'distances': [float(match.distance) for match in result.matches],
+                                'timings': result.timings}
+                request.finish(response, len(batch))
+
+
+if __name__ == "__main__":
+    import argparse
+    import signal
+
+    from UnknownClusters import UnknownClusters
+
+    parser = argparse.ArgumentParser(description='Keep the face recognition models loaded and serve requests '
+                                                 'over a Unix socket')
+    parser.add_argument('--known', default='known_faces', help='face gallery directory')
+    parser.add_argument('--conversion', default='pictureNames.conv', help='legacy name conversion file to migrate')
+    parser.add_argument('--socket', default=RECOGNITION_SOCKET, help='path of the Unix socket')
+    parser.add_argument('--window', type=float, default=0.01, help='seconds to wait for requests to batch together')
+    parser.add_argument('--max-batch', type=int, default=8, help='most requests handled in one batch')
+    parser.add_argument('--index', action='store_true', help='search an IVF index instead of every encoding')
+    args = parser.parse_args()
+
+    recognizer = FaceRecognizer(enc_location=args.known, name_conv_location=args.conversion, use_index=args.index,
+                                unknowns=UnknownClusters(args.known))
+    recognizer.watch_gallery()
+    service = RecognitionService(recognizer, args.socket, batch_window=args.window, max_batch=args.max_batch)
+    # shutdown() waits for serve_forever to return, so it has to be called from another thread
+    signal.signal(signal.SIGTERM, lambda signum, frame: threading.Thread(target=service.shutdown).start())
+    try:
+        service.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        recognizer.unknowns.save()
+        for method, stats in service.report()['methods'].items():
+            if stats['count']:
+                print(f"{method}: {stats['count']} requests, mean latency {stats['mean_latency'] * 1000:.1f} ms, "
+                      f"max {stats['max_latency'] * 1000:.1f} ms")
@@ -1,5 +1,4 @@
 #!/bin/bash
-python3.5 WeatherApi.py &
-python3.5 PygameMain.py &
-python3.5 FacialRecognition.py &
-python3.5 CommandParser.py &
\ No newline at end of file
+# the Supervisor runs the message bus, weather, commands and greetings itself and keeps
+# face recognition and the display running as child processes, restarting them if they fail
+exec python3 Supervisor.py
@@ -0,0 +1,99 @@
+import json
+import struct
+
+# every message is a header of two lengths, then that many bytes of json and of binary payload
+FRAME_HEADER = struct.Struct('!II')
+MAX_JSON_BYTES = 1 << 20
+
+
+def pack_message(message: dict, payload: bytes = b'', cls=None) -> bytes:
+    """
+    :param message: json serializable dict
+    :param payload: optional binary data sent after the json, for example a raw RGB frame
+    :param cls: json.JSONEncoder subclass for values json can not encode itself
+    :return: the framed message
+    """
+    data = json.dumps(message, separators=(',', ':'), cls=cls).encode('utf-8')
+    return FRAME_HEADER.pack(len(data), len(payload)) + data + payload
+
+
+def _check_json_size(json_size: int):
+    # every message has at least '{}', anything else means the stream is out of step
+    if json_size == 0:
+        raise ConnectionError('Message without a json body')
+    if json_size > MAX_JSON_BYTES:
+        raise ConnectionError(f'Message of {json_size} bytes is too large')
+
+
+def unpack_messages(buffer: bytearray, object_hook=None) -> list:
+    """
+    Removes every complete message from the front of a receive buffer, for non blocking readers
+
+    :param buffer: bytes received so far, a partial message at the end is left in it
+    :param object_hook: json object hook for values encoded with a custom encoder, such as WeatherJSON.weather_hook
+    :return: list of (message dict, payload bytes)
+    """
+    messages = []
+    offset = 0
+    while len(buffer) - offset >= FRAME_HEADER.size:
+        json_size, payload_size = FRAME_HEADER.unpack_from(buffer, offset)
+        _check_json_size(json_size)
+        end = offset + FRAME_HEADER.size + json_size + payload_size
+        if len(buffer) < end:
+            break
+        start = offset + FRAME_HEADER.size
+        messages.append((json.loads(buffer[start:start + json_size].decode('utf-8'), object_hook=object_hook),
+                         bytes(buffer[start + json_size:end])))
+        offset = end
+    del buffer[:offset]
+    return messages
+
+
+def send_message(sock, message: dict, payload: bytes = b'', cls=None):
+    """
+    Sends one framed message
+
+    :param sock: connected stream socket
+    :param message: json serializable dict
+    :param payload: optional binary data sent after the json, for example a raw RGB frame
+    :param cls: json.JSONEncoder subclass for values json can not encode itself
+    """
+    sock.sendall(pack_message(message, payload, cls))
+
+
+def _recv_exactly(sock, size: int, eof_ok: bool = False) -> bytes:
+    """
+    :param eof_ok: return b'' instead of raising if the socket is closed before any byte arrives
+    :return: size bytes from the socket
+    :raises ConnectionError: if the socket is closed before size bytes arrived
+    """
+    chunks = []
+    remaining = size
+    while remaining:
+        chunk = sock.recv(min(remaining, 1 << 20))
+        if not chunk:
+            if remaining == size and eof_ok:
+                return b''
+            raise ConnectionError('Socket closed in the middle of a message')
+        chunks.append(chunk)
+        remaining -= len(chunk)
+    return b''.join(chunks)
+
+
+def recv_message(sock, object_hook=None) -> tuple:
+    """
+    Receives one framed message
+
+    :param sock: connected stream socket
+    :param object_hook: json object hook for values encoded with a custom encoder, such as WeatherJSON.weather_hook
+    :return: (message dict, payload bytes), or (None, b'') if the other side closed the connection
+    """
+    # a close between messages is the normal end of a connection, anywhere else it is an error
+    header = _recv_exactly(sock, FRAME_HEADER.size, eof_ok=True)
+    if not header:
+        return None, b''
+    json_size, payload_size = FRAME_HEADER.unpack(header)
+    _check_json_size(json_size)
+    message = json.loads(_recv_exactly(sock, json_size).decode('utf-8'), object_hook=object_hook)
+    payload = _recv_exactly(sock, payload_size) if payload_size else b''
+    return message, payload
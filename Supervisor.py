@@ -0,0 +1,335 @@
+import asyncio
+import os
+import signal
+import sys
+import threading
+import time
+
+from FileSettings import BUS_SOCKET, WEATHER_FILE
+
+HEARTBEAT_ENV = 'SMARTMIRROR_HEARTBEAT'  # environment variable holding a child's heartbeat file
+HEARTBEAT_DIR = 'heartbeats'
+
+
+class Heartbeat:
+    """
+    Lets a child process show the Supervisor that its main loop is still running by touching a file.
+    Beats are throttled to one file write per interval however often beat() is called.
+    """
+
+    def __init__(self, path: str = None, interval: float = 5.0):
+        """
+        :param path: file to touch, None to do nothing
+        :param interval: least seconds between touches
+        """
+        self.path = path
+        self.interval = interval
+        self._last = None
+
+    @classmethod
+    def from_environment(cls, interval: float = 5.0):
+        """
+        :return: Heartbeat on the file the Supervisor passed, or one that does nothing when run on its own
+        """
+        return cls(os.environ.get(HEARTBEAT_ENV), interval)
+
+    def beat(self):
+        if self.path is None:
+            return
+        now = time.monotonic()
+        if self._last is None or now - self._last >= self.interval:
+            with open(self.path, 'a'):
+                os.utime(self.path)
+            self._last = now
+
+
+class Backoff:
+    """
+    Delay before restarting something that failed, doubling with each quick failure and
+    starting over once it has run for stable_after seconds
+    """
+
+    def __init__(self, initial: float = 1.0, maximum: float = 60.0, stable_after: float = 60.0):
+        self.initial = initial
+        self.maximum = maximum
+        self.stable_after = stable_after
+        self.delay = initial
+        self._started = time.monotonic()
+
+    def started(self):
+        self._started = time.monotonic()
+
+    def failed(self) -> float:
+        """
+        :return: seconds to wait before the next start
+        """
+        if time.monotonic() - self._started >= self.stable_after:
+            self.delay = self.initial
+        delay = self.delay
+        self.delay = min(self.maximum, self.delay * 2)
+        return delay
+
+
+async def sleep_or_stop(stopping: asyncio.Event, seconds: float) -> bool:
+    """
+    :return: True if stopping was set before the seconds passed
+    """
+    try:
+        await asyncio.wait_for(stopping.wait(), seconds)
+        return True
+    except asyncio.TimeoutError:
+        return False
+
+
+def run_in_thread(function, *args) -> asyncio.Future:
+    """
+    Runs a blocking function on a daemon thread, unlike the default executor nothing waits for it at exit
+
+    :return: future of the function's result
+    """
+    loop = asyncio.get_running_loop()
+    future = loop.create_future()
+
+    def run():
+        try:
+            result = function(*args)
+        except BaseException as e:
+            loop.call_soon_threadsafe(lambda: future.done() or future.set_exception(e))
+        else:
+            loop.call_soon_threadsafe(lambda: future.done() or future.set_result(result))
+
+    threading.Thread(target=run, name=getattr(function, '__name__', 'worker'), daemon=True).start()
+    return future
+
+
+async def supervise_task(name: str, factory, stopping: asyncio.Event, backoff: Backoff = None):
+    """
+    Runs factory() until stopping is set, restarting it with a backoff whenever it fails or returns
+
+    :param name: name for the log
+    :param factory: function returning a new coroutine of the task
+    :param stopping: set when the supervisor shuts down
+    """
+    backoff = Backoff() if backoff is None else backoff
+    while not stopping.is_set():
+        backoff.started()
+        try:
+            await factory()
+            reason = 'stopped'
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            reason = f'failed: {e!r}'
+        if stopping.is_set():
+            return
+        delay = backoff.failed()
+        print(f"{name} {reason}, restarting in {delay:.0f} s")
+        if await sleep_or_stop(stopping, delay):
+            return
+
+
+class ChildProcess:
+    """
+    A CPU heavy part of the mirror run as its own process. It is restarted with a backoff when it
+    exits or stops beating its Heartbeat, and asked to finish with SIGINT on shutdown.
+    """
+
+    def __init__(self, name: str, argv: list, heartbeat_timeout: float = 60.0, startup_timeout: float = 120.0,
+                 stop_grace: float = 10.0):
+        """
+        :param name: name for the log and the heartbeat file
+        :param argv: command line of the process
+        :param heartbeat_timeout: seconds without a heartbeat before the process counts as hung
+        :param startup_timeout: seconds allowed for the first heartbeat, loading models can take a while
+        :param stop_grace: seconds the process gets to exit after SIGINT before it is killed
+        """
+        self.name = name
+        self.argv = argv
+        self.heartbeat_timeout = heartbeat_timeout
+        self.startup_timeout = startup_timeout
+        self.stop_grace = stop_grace
+        self.heartbeat = os.path.abspath(os.path.join(HEARTBEAT_DIR, f'{name}.beat'))
+        self.backoff = Backoff()
+        self.process = None
+        self.restarts = 0
+        self._started = None
+
+    def healthy(self) -> bool:
+        """
+        :return: whether the process has beaten its heartbeat recently enough
+        """
+        try:
+            return time.time() - os.path.getmtime(self.heartbeat) < self.heartbeat_timeout
+        except FileNotFoundError:
+            return time.monotonic() - self._started < self.startup_timeout
+
+    async def run(self, stopping: asyncio.Event):
+        """
+        Keeps the process running until stopping is set
+        """
+        os.makedirs(HEARTBEAT_DIR, exist_ok=True)
+        while not stopping.is_set():
+            if os.path.exists(self.heartbeat):
+                os.remove(self.heartbeat)
+            self.process = await asyncio.create_subprocess_exec(*self.argv,
+                                                                env=dict(os.environ, **{HEARTBEAT_ENV: self.heartbeat}))
+            self._started = time.monotonic()
+            self.backoff.started()
+            print(f"Started {self.name} as process {self.process.pid}")
+            reason = await self._watch(stopping)
+            if reason is None:
+                await self._terminate()
+                return
+            if reason == 'stopped responding':
+                await self._terminate()
+            self.restarts += 1
+            delay = self.backoff.failed()
+            print(f"{self.name} {reason}, restarting in {delay:.0f} s")
+            if await sleep_or_stop(stopping, delay):
+                return
+
+    async def _watch(self, stopping: asyncio.Event):
+        """
+        :return: why the process has to be restarted, or None if the supervisor is stopping
+        """
+        exited = asyncio.ensure_future(self.process.wait())
+        stop = asyncio.ensure_future(stopping.wait())
+        try:
+            while True:
+                done, _ = await asyncio.wait({exited, stop}, timeout=min(5.0, self.heartbeat_timeout / 2),
+                                             return_when=asyncio.FIRST_COMPLETED)
+                if stop in done:
+                    return None
+                if exited in done:
+                    return f'exited with code {self.process.returncode}'
+                if not self.healthy():
+                    return 'stopped responding'
+        finally:
+            exited.cancel()
+            stop.cancel()
+
+    async def _terminate(self):
+        if self.process.returncode is not None:
+            return
+        self.process.send_signal(signal.SIGINT)
+        try:
+            await asyncio.wait_for(self.process.wait(), self.stop_grace)
+        except asyncio.TimeoutError:
+            print(f"{self.name} did not exit within {self.stop_grace:.0f} s, killing it")
+            self.process.kill()
+            await self.process.wait()
+
+
+class Supervisor:
+    """
+    Single entry point for the mirror. The I/O bound parts run in this process and spend their time
+    waiting on sockets and files. Command parsing and greetings are asyncio tasks. The message bus
+    keeps its own selector loop and weather fetching uses blocking HTTP requests, so those two tasks
+    run their work on daemon threads through run_in_thread. Recognition and rendering run as
+    ChildProcesses.
+    """
+
+    def __init__(self, tasks: dict, children: list):
+        """
+        :param tasks: name -> function of the stopping event returning a coroutine
+        :param children: ChildProcesses to keep running
+        """
+        self.tasks = tasks
+        self.children = children
+        self.stopping = None
+
+    def stop(self):
+        if self.stopping is not None:
+            self.stopping.set()
+
+    async def run(self):
+        self.stopping = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(signum, self.stop)
+        tasks = [asyncio.ensure_future(supervise_task(name, lambda factory=factory: factory(self.stopping),
+                                                      self.stopping))
+                 for name, factory in self.tasks.items()]
+        children = [asyncio.ensure_future(child.run(self.stopping)) for child in self.children]
+        await self.stopping.wait()
+        print("Shutting down")
+        # children finish first so their last messages still reach the bus
+        await asyncio.gather(*children, return_exceptions=True)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+
+async def message_bus(stopping: asyncio.Event):
+    from MessageBus import MessageBus
+
+    bus = MessageBus(BUS_SOCKET, persist_dir='bus', mirror_files=True)
+    serving = run_in_thread(bus.serve_forever)
+    try:
+        await asyncio.shield(serving)
+    finally:
+        bus.shutdown()
+
+
+async def wait_for_bus(timeout: float = 5.0):
+    """
+    Waits for the message bus socket so the other tasks connect instead of falling back to files
+    """
+    deadline = time.monotonic() + timeout
+    while not os.path.exists(BUS_SOCKET) and time.monotonic() < deadline:
+        await asyncio.sleep(0.05)
+
+
+async def fetch_weather(stopping: asyncio.Event):
+    from MessageBus import BusClient
+    from WeatherApi import LOCATION, WEATHER_UPDATE_TIME, WeatherAPI
+
+    await wait_for_bus()
+    # creating the api fetches the first forecast, keep the blocking requests off the event loop
+    api = await run_in_thread(WeatherAPI, LOCATION, WEATHER_FILE, BusClient())
+    while True:
+        await run_in_thread(api.update)
+        if await sleep_or_stop(stopping, WEATHER_UPDATE_TIME + 1):
+            return
+
+
+async def parse_commands(stopping: asyncio.Event):
+    import CommandParser
+
+    await wait_for_bus()
+    await CommandParser.listen_async(stopping)
+
+
+async def greet_arrivals(stopping: asyncio.Event):
+    from Greetings import greeting
+    from MessageBus import Topic
+    from Presence import PresenceEvent
+    from SocketMessages import pack_message, unpack_messages
+
+    await wait_for_bus()
+    reader, writer = await asyncio.open_unix_connection(BUS_SOCKET)
+    writer.write(pack_message({'op': 'subscribe', 'topics': [Topic.PRESENCE.value]}))
+    received = bytearray()
+    try:
+        while True:
+            data = await reader.read(1 << 16)
+            if not data:
+                raise ConnectionError('Message bus closed the connection')
+            received += data
+            for message, _ in unpack_messages(received):
+                arrival = message['data']
+                if arrival['event'] == PresenceEvent.ENTERED.name:
+                    writer.write(pack_message({'op': 'publish', 'topic': Topic.SAY.value,
+                                               'data': greeting(arrival['name'])}))
+            await writer.drain()
+    finally:
+        writer.close()
+
+
+if __name__ == "__main__":
+    supervisor = Supervisor(
+        tasks={'message bus': message_bus, 'weather': fetch_weather, 'commands': parse_commands,
+               'greetings': greet_arrivals},
+        children=[ChildProcess('recognition', [sys.executable, 'FacialRecognition.py', '--no-greet']),
+                  ChildProcess('display', [sys.executable, 'PygameMain.py'], heartbeat_timeout=30.0)])
+    asyncio.run(supervisor.run())
@@ -0,0 +1,171 @@
+import os
+
+from FileSettings import TRANSCRIPT_LOG
+
+SEGMENT_BYTES = 64 * 1024  # a new segment is started once the current one reaches this size
+MAX_SEGMENTS = 64  # oldest segments are deleted past this many even if a reader has not got to them
+SEGMENT_SUFFIX = '.log'
+OFFSET_SUFFIX = '.offset'
+
+
+class TranscriptLog:
+    """
+    Append only log of heard lines, split into segment files named after the log offset of their
+    first byte. Nothing is ever truncated or rewritten: the writer only appends whole lines to the
+    newest segment, each reader keeps its own offset in a file next to the segments, and old
+    segments are only deleted once every reader is past them.
+
+    One process writes, any number read.
+    """
+
+    def __init__(self, directory: str = TRANSCRIPT_LOG, segment_bytes: int = SEGMENT_BYTES,
+                 max_segments: int = MAX_SEGMENTS):
+        """
+        :param directory: directory holding the segments and reader offsets
+        :param segment_bytes: size at which the writer starts a new segment
+        :param max_segments: most segments kept, bounding the disk used when a reader stops reading
+        """
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.max_segments = max_segments
+        os.makedirs(directory, exist_ok=True)
+
+    def segments(self) -> list:
+        """
+        :return: sorted list of (offset of the first byte, path) of every segment
+        """
+        return sorted((int(name[:-len(SEGMENT_SUFFIX)]), os.path.join(self.directory, name))
+                      for name in os.listdir(self.directory) if name.endswith(SEGMENT_SUFFIX))
+
+    def _segment_path(self, base: int) -> str:
+        return os.path.join(self.directory, f'{base:020d}{SEGMENT_SUFFIX}')
+
+    def start_offset(self) -> int:
+        segments = self.segments()
+        return segments[0][0] if segments else 0
+
+    def end_offset(self) -> int:
+        segments = self.segments()
+        return segments[-1][0] + os.path.getsize(segments[-1][1]) if segments else 0
+
+    def append(self, line: str) -> int:
+        """
+        Appends one line with a single write, starting a new segment first if the newest one is full
+
+        :param line: text to add, newlines inside it are replaced with spaces
+        :return: log offset of the line
+        """
+        data = (line.replace('\r', ' ').replace('\n', ' ') + '\n').encode('utf-8')
+        segments = self.segments()
+        base, path = segments[-1] if segments else (0, self._segment_path(0))
+        size = os.path.getsize(path) if segments else 0
+        if size >= self.segment_bytes:
+            base, path, size = base + size, self._segment_path(base + size), 0
+            self.compact()
+        fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            os.write(fd, data)
+        finally:
+            os.close(fd)
+        return base + size
+
+    def reader(self, name: str, from_start: bool = False):
+        """
+        :param name: name the reader's offset is kept under
+        :param from_start: a reader seen for the first time starts at the oldest line rather than the newest
+        :return: LogReader
+        """
+        return LogReader(self, name, from_start)
+
+    def reader_offsets(self) -> dict:
+        """
+        :return: name -> committed offset of every reader
+        """
+        offsets = {}
+        for name in os.listdir(self.directory):
+            if name.endswith(OFFSET_SUFFIX):
+                with open(os.path.join(self.directory, name)) as fin:
+                    offsets[name[:-len(OFFSET_SUFFIX)]] = int(fin.read() or 0)
+        return offsets
+
+    def compact(self) -> list:
+        """
+        Deletes the segments every reader has read past, and the oldest ones beyond max_segments.
+        The newest segment is always kept.
+
+        :return: paths of the deleted segments
+        """
+        segments = self.segments()
+        offsets = self.reader_offsets()
+        read_by_all = min(offsets.values()) if offsets else 0
+        deleted = []
+        for i, (base, path) in enumerate(segments[:-1]):
+            next_base = segments[i + 1][0]
+            if next_base <= read_by_all or len(segments) - len(deleted) > self.max_segments:
+                os.remove(path)
+                deleted.append(path)
+        return deleted
+
+
+class LogReader:
+    """
+    Tails a TranscriptLog from its own offset, which is kept in a file so it carries on where it
+    left off after a restart
+    """
+
+    def __init__(self, log: TranscriptLog, name: str, from_start: bool = False):
+        self.log = log
+        self.name = name
+        self.path = os.path.join(log.directory, name + OFFSET_SUFFIX)
+        self._committed = None
+        if os.path.exists(self.path):
+            with open(self.path) as fin:
+                self.offset = self._committed = int(fin.read() or 0)
+        else:
+            self.offset = log.start_offset() if from_start else log.end_offset()
+            self.commit()
+
+    def read(self) -> list:
+        """
+        Reads the whole lines appended since the offset and moves the offset past them. Call commit()
+        once they have been handled.
+
+        :return: list of lines without their newline
+        """
+        lines = []
+        segments = self.log.segments()
+        if segments and self.offset < segments[0][0]:
+            print(f"{self.name} fell behind the transcript log, skipping to its oldest line")
+            self.offset = segments[0][0]
+        for i, (base, path) in enumerate(segments):
+            next_base = segments[i + 1][0] if i + 1 < len(segments) else None
+            if next_base is not None and next_base <= self.offset:
+                continue
+            try:
+                with open(path, 'rb') as fin:
+                    fin.seek(self.offset - base)
+                    data = fin.read()
+            except FileNotFoundError:
+                # compacted away while reading
+                continue
+            # a line without its newline is still being written
+            complete = data[:data.rfind(b'\n') + 1]
+            lines.extend(complete.decode('utf-8').splitlines())
+            self.offset += len(complete)
+            if len(complete) < len(data) or next_base is None:
+                break
+            self.offset = next_base
+        return lines
+
+    def commit(self):
+        """
+        Saves the offset, replacing the file in one rename so it is never seen half written.
+        Nothing is written if the offset has not moved, so watchers of the log directory are not woken for nothing.
+        """
+        if self.offset == self._committed:
+            return
+        temporary = self.path + '.tmp'
+        with open(temporary, 'w') as fout:
+            fout.write(str(self.offset))
+        os.replace(temporary, self.path)
+        self._committed = self.offset
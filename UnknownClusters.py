@@ -0,0 +1,255 @@
+import fcntl
+import os
+import time
+from contextlib import contextmanager
+
+import numpy as np
+
+from FaceGallery import ENCODING_DTYPE, ENCODING_SIZE
+
+UNKNOWN_CLUSTERS_FILE = "unknown_clusters.npz"
+
+
+class UnknownClusters:
+    """
+    Online leader clustering of faces nobody recognized. Each unknown encoding joins the closest
+    cluster within radius, moving its centroid towards the encoding, or starts a new cluster.
+    At most max_clusters are kept, the cluster with the fewest sightings (then the one seen
+    longest ago) makes room for a new one, so memory stays bounded however long it runs.
+
+    Several processes may hold the same clusters, the recognizer adding sightings while the command
+    line enrolls one. save() merges with the file under a lock instead of overwriting it: sightings
+    added by either side are summed, and a cluster removed by either side stays removed.
+    """
+
+    def __init__(self, location: str, radius: float = 0.45, max_clusters: int = 200, save_every: int = 20):
+        """
+        :param location: directory the clusters are saved in, normally the gallery directory
+        :param radius: largest face distance from a centroid for an encoding to join its cluster
+        :param max_clusters: most clusters kept at once
+        :param save_every: number of added encodings between saves, 0 to only save explicitly
+        """
+        self.path = os.path.join(location, UNKNOWN_CLUSTERS_FILE)
+        self.radius = radius
+        self.max_clusters = max_clusters
+        self.save_every = save_every
+        self.centroids = np.empty((0, ENCODING_SIZE), dtype=ENCODING_DTYPE)
+        self.ids = np.empty(0, dtype=np.int64)
+        self.counts = np.empty(0, dtype=np.int64)
+        self.first_seen = np.empty(0, dtype=np.float64)
+        self.last_seen = np.empty(0, dtype=np.float64)
+        self.next_id = 0
+        self._unsaved = 0
+        # cluster id -> (sightings, sum of their encodings) when the file was last read or written
+        self._synced = {}
+        # ids of synced clusters removed here since then
+        self._dropped = set()
+        self.load()
+
+    def __len__(self):
+        return len(self.ids)
+
+    @contextmanager
+    def _locked(self):
+        """
+        Holds an exclusive lock on the clusters file between processes
+        """
+        with open(self.path + '.lock', 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def _read(self):
+        """
+        :return: dict of the saved arrays, or None if nothing has been saved
+        """
+        if not os.path.exists(self.path):
+            return None
+        with np.load(self.path) as saved:
+            return {key: saved[key] for key in saved.files}
+
+    def _sync(self):
+        self._synced = {int(cluster_id): (int(count), centroid * count)
+                        for cluster_id, count, centroid in zip(self.ids, self.counts, self.centroids)}
+        self._dropped = set()
+
+    def load(self):
+        if not os.path.exists(self.path):
+            return
+        with self._locked():
+            saved = self._read()
+        if saved is None:
+            return
+        self.centroids = saved['centroids']
+        self.ids = saved['ids']
+        self.counts = saved['counts']
+        self.first_seen = saved['first_seen']
+        self.last_seen = saved['last_seen']
+        self.next_id = int(saved['next_id'])
+        self._sync()
+
+    def save(self):
+        """
+        Merges the clusters with what other processes saved since they were last read, then writes them
+        to a temporary file and renames it over the old one
+        """
+        with self._locked():
+            saved = self._read()
+            if saved is not None:
+                self._merge(saved)
+            temporary = self.path + '.tmp.npz'
+            np.savez(temporary, centroids=self.centroids, ids=self.ids, counts=self.counts,
+                     first_seen=self.first_seen, last_seen=self.last_seen, next_id=self.next_id)
+            os.replace(temporary, self.path)
+        self._sync()
+        self._unsaved = 0
+
+    def _merge(self, saved: dict):
+        """
+        Replaces the clusters with the saved ones plus the sightings added here since the last sync.
+        Clusters removed here or from the file since then are left out, new clusters get fresh ids.
+
+        :param saved: output of _read()
+        """
+        local = {int(cluster_id): row for row, cluster_id in enumerate(self.ids)}
+        centroids, ids, counts, first_seen, last_seen = [], [], [], [], []
+        for row, cluster_id in enumerate(saved['ids'].tolist()):
+            if cluster_id in self._dropped:
+                continue
+            centroid, count = saved['centroids'][row], int(saved['counts'][row])
+            first, last = saved['first_seen'][row], saved['last_seen'][row]
+            if cluster_id in self._synced and cluster_id in local:
+                mine = local[cluster_id]
+                synced_count, synced_sum = self._synced[cluster_id]
+                added = int(self.counts[mine]) - synced_count
+                if added:
+                    new_sum = self.centroids[mine] * self.counts[mine] - synced_sum
+                    centroid = (centroid * count + new_sum) / (count + added)
+                    count += added
+                    first, last = min(first, self.first_seen[mine]), max(last, self.last_seen[mine])
+            centroids.append(centroid)
+            ids.append(cluster_id)
+            counts.append(count)
+            first_seen.append(first)
+            last_seen.append(last)
+        next_id = max(self.next_id, int(saved['next_id']))
+        for cluster_id, row in local.items():
+            # synced clusters missing from the file were removed by another process
+            if cluster_id not in self._synced:
+                centroids.append(self.centroids[row])
+                ids.append(next_id)
+                counts.append(int(self.counts[row]))
+                first_seen.append(self.first_seen[row])
+                last_seen.append(self.last_seen[row])
+                next_id += 1
+        self.centroids = np.array(centroids, dtype=ENCODING_DTYPE).reshape(-1, ENCODING_SIZE)
+        self.ids = np.array(ids, dtype=np.int64)
+        self.counts = np.array(counts, dtype=np.int64)
+        self.first_seen = np.array(first_seen, dtype=np.float64)
+        self.last_seen = np.array(last_seen, dtype=np.float64)
+        self.next_id = next_id
+        while len(self.ids) > self.max_clusters:
+            self._remove(np.lexsort((self.last_seen, self.counts))[0])
+
+    def add(self, encoding, now: float = None) -> int:
+        """
+        Adds one unrecognized face encoding
+
+        :param encoding: 128 value face encoding
+        :param now: wall clock time of the sighting, defaults to time.time()
+        :return: id of the cluster the encoding joined
+        """
+        now = time.time() if now is None else now
+        encoding = np.asarray(encoding, dtype=ENCODING_DTYPE)
+        if len(self.ids):
+            distances = np.linalg.norm(self.centroids - encoding, axis=1)
+            closest = int(np.argmin(distances))
+            if distances[closest] <= self.radius:
+                self.counts[closest] += 1
+                # running mean, every sighting weighs the same
+                self.centroids[closest] += (encoding - self.centroids[closest]) / self.counts[closest]
+                self.last_seen[closest] = now
+                self._added()
+                return int(self.ids[closest])
+        if len(self.ids) >= self.max_clusters:
+            self._remove(np.lexsort((self.last_seen, self.counts))[0])
+        cluster_id = self.next_id
+        self.next_id += 1
+        self.centroids = np.concatenate([self.centroids, encoding[np.newaxis]])
+        self.ids = np.append(self.ids, cluster_id)
+        self.counts = np.append(self.counts, 1)
+        self.first_seen = np.append(self.first_seen, now)
+        self.last_seen = np.append(self.last_seen, now)
+        self._added()
+        return cluster_id
+
+    def _added(self):
+        self._unsaved += 1
+        if self.save_every and self._unsaved >= self.save_every:
+            self.save()
+
+    def _remove(self, row: int):
+        self._dropped.add(int(self.ids[row]))
+        self.centroids = np.delete(self.centroids, row, axis=0)
+        self.ids = np.delete(self.ids, row)
+        self.counts = np.delete(self.counts, row)
+        self.first_seen = np.delete(self.first_seen, row)
+        self.last_seen = np.delete(self.last_seen, row)
+
+    def _row(self, cluster_id: int) -> int:
+        rows = np.flatnonzero(self.ids == cluster_id)
+        if len(rows) == 0:
+            raise KeyError(f"No unknown face cluster {cluster_id}")
+        return int(rows[0])
+
+    def candidates(self, min_count: int = 10) -> list:
+        """
+        :param min_count: fewest sightings for a cluster to be worth enrolling
+        :return: list of (cluster id, sightings, first seen, last seen), most seen first
+        """
+        rows = np.flatnonzero(self.counts >= min_count)
+        rows = rows[np.argsort(-self.counts[rows], kind='stable')]
+        return [(int(self.ids[i]), int(self.counts[i]), float(self.first_seen[i]), float(self.last_seen[i]))
+                for i in rows]
+
+    def enroll(self, cluster_id: int, name: str, recognizer) -> bool:
+        """
+        Adds a cluster's centroid to the known people and forgets the cluster, also in the file
+        so the recognizer does not bring it back on its next save
+
+        :param cluster_id: id from candidates()
+        :param name: name of the person
+        :param recognizer: FacialRecognition.FaceRecognizer to add the person to
+        :return: boolean as to whether the person was successfully added
+        """
+        row = self._row(cluster_id)
+        if recognizer.create_enc_file(self.centroids[row], name) is None:
+            return False
+        self._remove(row)
+        self.save()
+        return True
+
+
+if __name__ == "__main__":
+    import argparse
+    from datetime import datetime
+
+    parser = argparse.ArgumentParser(description='List unknown faces seen often enough to enroll, or enroll one')
+    parser.add_argument('--known', default='known_faces', help='face gallery directory')
+    parser.add_argument('--min-count', type=int, default=10, help='fewest sightings to list a face')
+    parser.add_argument('--enroll', nargs=2, metavar=('ID', 'NAME'), help='enroll unknown face ID as NAME')
+    args = parser.parse_args()
+
+    clusters = UnknownClusters(args.known)
+    if args.enroll:
+        from FacialRecognition import FaceRecognizer
+
+        recognizer = FaceRecognizer(enc_location=args.known, name_conv_location='pictureNames.conv')
+        if clusters.enroll(int(args.enroll[0]), args.enroll[1], recognizer):
+            print(f"Enrolled unknown face {args.enroll[0]} as {args.enroll[1]}")
+    else:
+        for cluster_id, count, first, last in clusters.candidates(args.min_count):
+            print(f"unknown face {cluster_id} has been seen {count} times, "
+                  f"first {datetime.fromtimestamp(first):%Y-%m-%d %H:%M}, last {datetime.fromtimestamp(last):%Y-%m-%d %H:%M}")
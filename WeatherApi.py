@@ -1,11 +1,13 @@
-import json
 import time
 from datetime import datetime
 
 from FileSettings import WEATHER_FILE
+from MessageBus import BusClient, Topic
 from TimeOfDay import TimeOfDay
 from WeatherJSON import WeatherEncoder
 from WeatherShape import WeatherShape
+from WeatherSnapshot import WeatherSnapshot, weather_hashes
+from WeatherState import WeatherState
 from forecastiopy import *
 from forecastiopy.FIOCurrently import FIOCurrently
 from forecastiopy.FIODaily import FIODaily
@@ -21,6 +23,8 @@ from forecastiopy.FIOHourly import FIOHourly
 RAIN_SNOW_THRESHOLD = 0.10
 CLOUD_COVER_THRESHOLD = 0.3
 WEATHER_UPDATE_TIME = 110
+# location the forecast is fetched for
+LOCATION = {'lat': 39.7555, 'lon': -105.2211}
 
 
 class BaseWeather:
@@ -104,11 +108,22 @@ class WeatherAPI:
     replacement_dict = {'(': '', ')': '', '°F': ' degrees fahrenheit', 'in.': 'inches', '-': 'to', '<': 'less than',
                         '>': 'greater than'}
 
-    def __init__(self, location, writeFile):
+    def __init__(self, location, writeFile, bus: BusClient = None):
         self.location = location
+        # publishes each new forecast on the message bus instead of only writing it to writeFile
+        self.bus = bus
         self.time_since_last_forecast = 0
         self.update_time = WEATHER_UPDATE_TIME
         self.writeFile = writeFile
+        self.snapshot = WeatherSnapshot(writeFile)
+        # typed copy of the forecast in shared memory for readers on this machine
+        try:
+            self.state = WeatherState()
+        except OSError as e:
+            print(f"Weather state not shared: {e}")
+            self.state = None
+        # hash of the last forecast sent, an unchanged forecast is not sent again
+        self.published_hash = None
         self.fio = ForecastIO.ForecastIO('58bd3b25da2aae9c321d6f35183c2a8d',
                                          units=ForecastIO.ForecastIO.UNITS_US,
                                          lang=ForecastIO.ForecastIO.LANG_ENGLISH,
@@ -126,10 +141,17 @@ class WeatherAPI:
                                              lang=ForecastIO.ForecastIO.LANG_ENGLISH, latitude=self.location['lat'],
                                              longitude=self.location['lon'])
             print("Updating Weather information")
-            # Write updated data to a file using json
-            with open(self.writeFile, 'w') as fout:
-                out = self.get_weather()
-                json.dump(out, fout, cls=WeatherEncoder)
+            out = self.get_weather()
+            whole, _ = weather_hashes(out)
+            if whole != self.published_hash:
+                if self.bus is not None:
+                    self.bus.publish(Topic.WEATHER, out, cls=WeatherEncoder)
+                else:
+                    # Write updated data to a file using json
+                    self.snapshot.publish(out)
+                if self.state is not None:
+                    self.state.publish(out)
+                self.published_hash = whole
             # Update time since forecast
             self.time_since_last_forecast = time.time()
 
@@ -324,10 +346,8 @@ class WeatherAPI:
 
 # Testing/example
 if __name__ == "__main__":
-    # Tuple to hold the current location
-    current_location = {'lat': 39.7555, 'lon': -105.2211}
     # Create OWM instance using my api key
-    golden_weather = WeatherAPI(current_location, writeFile=WEATHER_FILE)
+    golden_weather = WeatherAPI(LOCATION, writeFile=WEATHER_FILE, bus=BusClient())
 
     while True:
         golden_weather.update()
@@ -0,0 +1,154 @@
+import hashlib
+import json
+import os
+import time
+
+from FileSettings import WEATHER_FILE
+from WeatherJSON import WeatherEncoder, weather_hook
+
+SECTIONS = ('current', 'hourly', 'forecast', 'week_summary')  # parts of the weather dict hashed separately
+HEADER_KEY = 'snapshot'  # key of the version and hashes inside the published weather file
+META_SUFFIX = '.meta'
+
+
+def section_hash(value, cls=WeatherEncoder) -> str:
+    """
+    :param value: json serializable part of the weather dict
+    :param cls: json.JSONEncoder subclass for the weather enums
+    :return: hash of the value's canonical json, equal for equal values however their dicts are ordered
+    """
+    text = json.dumps(value, cls=cls, sort_keys=True, separators=(',', ':'))
+    return hashlib.blake2b(text.encode('utf-8'), digest_size=8).hexdigest()
+
+
+def weather_hashes(weather: dict, cls=WeatherEncoder) -> tuple:
+    """
+    :param weather: weather dict created by WeatherAPI
+    :return: (hash of the whole snapshot, {section: hash})
+    """
+    sections = {name: section_hash(weather.get(name), cls) for name in SECTIONS}
+    whole = hashlib.blake2b(''.join(sections[name] for name in SECTIONS).encode('ascii'), digest_size=8).hexdigest()
+    return whole, sections
+
+
+def _replace(path: str, text: str):
+    # written beside the file and renamed over it, so a reader sees the old or the new file and never part of one
+    temporary = f'{path}.{os.getpid()}.tmp'
+    with open(temporary, 'w') as fout:
+        fout.write(text)
+    os.replace(temporary, path)
+
+
+def read_header(meta_path: str) -> dict:
+    """
+    :return: {'version', 'hash', 'sections', 'time'} of the published snapshot, None if there is none
+    """
+    try:
+        with open(meta_path) as fin:
+            return json.load(fin)
+    except (FileNotFoundError, ValueError):
+        return None
+
+
+class WeatherSnapshot:
+    """
+    Publishes the weather file. Every snapshot gets a version one higher than the last and a hash of
+    itself and of each section, kept both inside the file under HEADER_KEY and in a small meta file
+    next to it. Readers check the meta file to find out whether, and which part of, the weather changed
+    before parsing the whole file. Snapshots equal to the published one are not written again.
+    """
+
+    def __init__(self, path: str = WEATHER_FILE):
+        """
+        :param path: weather file, its meta file is path + META_SUFFIX
+        """
+        self.path = path
+        self.meta_path = path + META_SUFFIX
+
+    def publish(self, weather: dict, cls=WeatherEncoder) -> bool:
+        """
+        :param weather: weather dict created by WeatherAPI
+        :param cls: json.JSONEncoder subclass for the weather enums, None if they are encoded already
+        :return: whether the snapshot differed from the published one and was written
+        """
+        whole, sections = weather_hashes(weather, cls)
+        # read back on every publish so the version keeps rising across restarts and between writers
+        published = read_header(self.meta_path)
+        if published is not None and published['hash'] == whole:
+            return False
+        version = published['version'] + 1 if published else 1
+        header = {'version': version, 'hash': whole, 'sections': sections, 'time': time.time()}
+        # the file is complete before the meta file announces its version
+        _replace(self.path, json.dumps(dict(weather, **{HEADER_KEY: header}), cls=cls))
+        _replace(self.meta_path, json.dumps(header))
+        return True
+
+
+class SnapshotReader:
+    """
+    Reads the weather file published by WeatherSnapshot, only parsing it again when its version changed
+    """
+
+    def __init__(self, path: str = WEATHER_FILE, object_hook=weather_hook):
+        """
+        :param path: weather file
+        :param object_hook: json object hook applied to the weather, None to keep the enums encoded
+        """
+        self.path = path
+        self.meta_path = path + META_SUFFIX
+        self.object_hook = object_hook
+        self.weather = None
+        self.version = None
+        self.sections = {}
+
+    def changed(self) -> set:
+        """
+        Reads only the meta file
+
+        :return: SECTIONS that differ from the snapshot last read, all of them if no versioned snapshot has been read yet
+        """
+        if self.version is None:
+            return set(SECTIONS)
+        header = read_header(self.meta_path)
+        if header is None or header['version'] == self.version:
+            return set()
+        return {name for name in SECTIONS if header['sections'].get(name) != self.sections.get(name)}
+
+    def read(self) -> dict:
+        """
+        Parses the weather file
+
+        :return: weather dict
+        """
+        with open(self.path) as fin:
+            weather = json.load(fin, object_hook=self.object_hook)
+        header = weather.pop(HEADER_KEY, None)
+        # files written before snapshots were versioned are read again every time
+        self.version = header['version'] if header else None
+        self.sections = header['sections'] if header else {}
+        self.weather = weather
+        return weather
+
+    def latest(self) -> dict:
+        """
+        :return: the current weather dict, parsed again only if it changed since the last read
+        """
+        if self.changed():
+            return self.read()
+        return self.weather
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Show the version and section hashes of the published weather')
+    parser.add_argument('path', nargs='?', default=WEATHER_FILE, help='weather file')
+    args = parser.parse_args()
+
+    header = read_header(args.path + META_SUFFIX)
+    if header is None:
+        raise SystemExit(f'No weather snapshot published at {args.path}')
+    print(f"version {header['version']} hash {header['hash']} "
+          f"published {time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(header['time']))}")
+    for name in SECTIONS:
+        print(f"  {name:12} {header['sections'].get(name)}")
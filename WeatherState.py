@@ -0,0 +1,344 @@
+import mmap
+import os
+import tempfile
+import time
+
+import numpy as np
+
+from FileSettings import WEATHER_STATE
+from WeatherShape import WeatherShape
+
+MAGIC = 0x52485457  # 'WTHR'
+LAYOUT = 1  # raised whenever STATE changes so old readers refuse a new layout
+MAX_HOURS = 8
+MAX_DAYS = 8
+MAX_STRINGS = 64
+TEXT_BYTES = 16 * 1024
+NO_STRING = 0xFFFFFFFF
+
+HEADER = np.dtype([('magic', '<u4'), ('layout', '<u4'),
+                   ('seq', '<u8'),  # seqlock, odd while the writer is changing the state
+                   ('version', '<u8'),  # number of forecasts published, 0 until the first one
+                   ('time', '<f8'),
+                   ('hours', '<u4'), ('days', '<u4'), ('week_summary', '<u4'), ('strings', '<u4')], align=True)
+# one current, hourly or daily forecast, strings are indices into the string table and enums are stored as ints
+RECORD = np.dtype([('shape', '<i4'), ('fill', '<f8'), ('value', '<u4'), ('unit', '<u4'), ('summary', '<u4'),
+                   ('time', '<u4'), ('temperature', '<f8'), ('feels', '<f8'),
+                   ('high_temperature', '<f8'), ('low_temperature', '<f8')], align=True)
+STRING = np.dtype([('offset', '<u4'), ('length', '<u4')])
+STATE = np.dtype([('header', HEADER), ('current', RECORD), ('hourly', RECORD, (MAX_HOURS,)),
+                  ('daily', RECORD, (MAX_DAYS,)), ('strings', STRING, (MAX_STRINGS,)),
+                  ('text', 'u1', (TEXT_BYTES,))], align=True)
+SEQ_OFFSET = HEADER.fields['seq'][1]
+BODY_OFFSET = HEADER.fields['version'][1]  # everything after the seqlock is copied in one go
+
+
+def weather_state_path(name: str = WEATHER_STATE) -> str:
+    """
+    :return: path of the shared memory file, in /dev/shm where there is one so it never touches the disk
+    """
+    return os.path.join('/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir(), name)
+
+
+def _float(value) -> float:
+    return float('nan') if value is None else float(value)
+
+
+class _StringTable:
+    def __init__(self, state: np.ndarray):
+        self.state = state
+        self.used = 0
+        self.count = 0
+
+    def add(self, text) -> int:
+        if text is None:
+            return NO_STRING
+        data = str(text).encode('utf-8')
+        if self.count == MAX_STRINGS or self.used + len(data) > TEXT_BYTES:
+            raise ValueError(f'Weather strings do not fit in {MAX_STRINGS} strings of {TEXT_BYTES} bytes')
+        self.state['text'][self.used:self.used + len(data)] = np.frombuffer(data, dtype=np.uint8)
+        self.state['strings'][self.count] = (self.used, len(data))
+        self.used += len(data)
+        self.count += 1
+        return self.count - 1
+
+
+class WeatherState:
+    """
+    Writer of the processed forecast into a fixed layout shared memory file, so the GUI and the command
+    parser read typed values straight from memory instead of decoding the weather json. Updates are
+    guarded by a seqlock: the sequence number is odd while the state is being written, and readers
+    retry when it was odd or moved while they copied.
+
+    The file outlives the writer so readers keep their mapping when WeatherApi restarts. One writer at a time.
+    """
+
+    def __init__(self, path: str = None):
+        """
+        :param path: shared memory file, defaults to weather_state_path()
+        """
+        self.path = weather_state_path() if path is None else path
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            if os.fstat(fd).st_size != STATE.itemsize:
+                os.ftruncate(fd, STATE.itemsize)
+            self.memory = mmap.mmap(fd, STATE.itemsize)
+        finally:
+            os.close(fd)
+        self.state = np.ndarray((), dtype=STATE, buffer=self.memory)
+        header = self.state['header']
+        if header['magic'] != MAGIC or header['layout'] != LAYOUT:
+            self.memory[:] = bytes(STATE.itemsize)
+            header['magic'], header['layout'] = MAGIC, LAYOUT
+        elif header['seq'] % 2:
+            # a writer died halfway through an update
+            header['seq'] += 1
+
+    @property
+    def version(self) -> int:
+        return int(self.state['header']['version'])
+
+    def publish(self, weather: dict):
+        """
+        :param weather: weather dict created by WeatherAPI
+        """
+        # the new state is built privately, then copied over the shared one under the seqlock
+        update = np.zeros((), dtype=STATE)
+        strings = _StringTable(update)
+        header = update['header']
+        header['version'] = self.version + 1
+        header['time'] = time.time()
+        self._fill(update['current'], weather['current'], strings)
+        hourly, daily = weather['hourly'][:MAX_HOURS], weather['forecast'][:MAX_DAYS]
+        for i, hour in enumerate(hourly):
+            self._fill(update['hourly'][i], hour, strings)
+        for i, day in enumerate(daily):
+            self._fill(update['daily'][i], day, strings)
+        header['hours'], header['days'] = len(hourly), len(daily)
+        header['week_summary'] = strings.add(weather.get('week_summary'))
+        header['strings'] = strings.count
+
+        shared = self.state['header']
+        shared['seq'] += 1
+        self.memory[BODY_OFFSET:] = update.tobytes()[BODY_OFFSET:]
+        shared['seq'] += 1
+
+    @staticmethod
+    def _fill(record: np.ndarray, weather: dict, strings: _StringTable):
+        shape = weather['shape']
+        record['shape'] = shape.value if isinstance(shape, WeatherShape) else int(shape)
+        record['fill'] = _float(weather.get('fill%'))
+        record['value'] = strings.add(weather.get('value'))
+        record['unit'] = strings.add(weather.get('unit'))
+        record['summary'] = strings.add(weather.get('summary'))
+        record['time'] = strings.add(weather.get('time'))
+        record['temperature'] = _float(weather.get('temperature'))
+        record['feels'] = _float(weather.get('feels'))
+        record['high_temperature'] = _float(weather.get('highTemperature'))
+        record['low_temperature'] = _float(weather.get('lowTemperature'))
+
+    def close(self):
+        self.state = None
+        self.memory.close()
+
+
+class WeatherRecord:
+    """
+    Read only view of one current, hourly or daily forecast in a copy of the state
+    """
+    __slots__ = ('_record', '_view')
+
+    def __init__(self, record: np.ndarray, view):
+        self._record = record
+        self._view = view
+
+    @property
+    def shape(self) -> WeatherShape:
+        return WeatherShape(int(self._record['shape']))
+
+    @property
+    def fill(self) -> float:
+        return float(self._record['fill'])
+
+    @property
+    def value(self) -> str:
+        return self._view.string(self._record['value'])
+
+    @property
+    def unit(self) -> str:
+        return self._view.string(self._record['unit'])
+
+    @property
+    def summary(self) -> str:
+        return self._view.string(self._record['summary'])
+
+    @property
+    def time(self) -> str:
+        return self._view.string(self._record['time'])
+
+    @property
+    def temperature(self) -> float:
+        return float(self._record['temperature'])
+
+    @property
+    def feels(self) -> float:
+        return float(self._record['feels'])
+
+    @property
+    def high_temperature(self) -> float:
+        return float(self._record['high_temperature'])
+
+    @property
+    def low_temperature(self) -> float:
+        return float(self._record['low_temperature'])
+
+    def to_dict(self, daily: bool = False) -> dict:
+        """
+        :param daily: give the high and low instead of the temperature, like ForecastWeather.get()
+        :return: the dict WeatherAPI created the record from, with its time as a string
+        """
+        weather = {'shape': self.shape, 'fill%': self.fill, 'value': self.value, 'unit': self.unit,
+                   'summary': self.summary, 'time': self.time}
+        if daily:
+            weather['highTemperature'] = self.high_temperature
+            weather['lowTemperature'] = self.low_temperature
+        else:
+            weather['temperature'] = self.temperature
+            weather['feels'] = self.feels
+        return weather
+
+
+class WeatherView:
+    """
+    Consistent, read only copy of the weather state taken by WeatherStateReader.read()
+    """
+
+    def __init__(self, state: np.ndarray):
+        self._state = state
+        header = state['header']
+        self.version = int(header['version'])
+        self.time = float(header['time'])
+        self.current = WeatherRecord(state['current'], self)
+        self.hourly = [WeatherRecord(state['hourly'][i], self) for i in range(int(header['hours']))]
+        self.forecast = [WeatherRecord(state['daily'][i], self) for i in range(int(header['days']))]
+
+    def string(self, index) -> str:
+        index = int(index)
+        if index == NO_STRING:
+            return None
+        offset, length = self._state['strings'][index]
+        return self._state['text'][offset:offset + length].tobytes().decode('utf-8')
+
+    @property
+    def week_summary(self) -> str:
+        return self.string(self._state['header']['week_summary'])
+
+    def to_dict(self) -> dict:
+        """
+        :return: weather dict in the shape WeatherAPI.get_weather() creates, for GUI.WeatherWidget.set_weather()
+        """
+        return {'current': self.current.to_dict(), 'hourly': [hour.to_dict() for hour in self.hourly],
+                'forecast': [day.to_dict(daily=True) for day in self.forecast], 'week_summary': self.week_summary}
+
+
+class WeatherStateReader:
+    """
+    Maps the weather state read only and takes consistent copies of it under the seqlock
+    """
+
+    def __init__(self, path: str = None):
+        """
+        :param path: shared memory file, defaults to weather_state_path()
+        :raises FileNotFoundError: if no WeatherState has been created yet
+        """
+        self.path = weather_state_path() if path is None else path
+        fd = os.open(self.path, os.O_RDONLY)
+        try:
+            if os.fstat(fd).st_size != STATE.itemsize:
+                raise ValueError(f'{self.path} does not hold a weather state of this layout')
+            self.memory = mmap.mmap(fd, STATE.itemsize, access=mmap.ACCESS_READ)
+        finally:
+            os.close(fd)
+        header = np.ndarray((), dtype=HEADER, buffer=self.memory)
+        if header['magic'] != MAGIC or header['layout'] != LAYOUT:
+            self.memory.close()
+            raise ValueError(f'{self.path} does not hold a weather state of this layout')
+        self._seq = np.ndarray((), dtype='<u8', buffer=self.memory, offset=SEQ_OFFSET)
+        self.seq = None  # seqlock value of the last read()
+        self.version = 0  # forecast version of the last read()
+
+    @classmethod
+    def open(cls, path: str = None):
+        """
+        :return: WeatherStateReader, or None if WeatherApi has not created the state yet
+        """
+        try:
+            return cls(path)
+        except (FileNotFoundError, ValueError):
+            return None
+
+    def changed(self) -> bool:
+        """
+        :return: whether a forecast was published since the last read()
+        """
+        return int(self._seq) != self.seq
+
+    def read(self, attempts: int = 1000) -> WeatherView:
+        """
+        :param attempts: copies to try while the writer keeps changing the state
+        :return: WeatherView of the state, version 0 if nothing has been published yet
+        """
+        for _ in range(attempts):
+            before = int(self._seq)
+            if before % 2 == 0:
+                data = self.memory[:]
+                if int(self._seq) == before:
+                    state = np.frombuffer(data, dtype=STATE)[0]
+                    view = WeatherView(state)
+                    self.seq, self.version = before, view.version
+                    return view
+            time.sleep(0)
+        raise TimeoutError(f'Weather state at {self.path} kept changing while being read')
+
+    def close(self):
+        self._seq = None
+        self.memory.close()
+
+
+if __name__ == "__main__":
+    import argparse
+    import json
+
+    from FileSettings import WEATHER_FILE
+    from WeatherJSON import weather_hook
+
+    parser = argparse.ArgumentParser(description='Publish the weather file into the shared weather state and '
+                                                 'compare reading it back with decoding the json')
+    parser.add_argument('weather', nargs='?', default=WEATHER_FILE, help='weather file to publish')
+    parser.add_argument('--reads', type=int, default=10000, help='reads to time')
+    args = parser.parse_args()
+
+    with open(args.weather) as fin:
+        weather = json.load(fin, object_hook=weather_hook)
+    writer = WeatherState()
+    writer.publish(weather)
+    reader = WeatherStateReader()
+    print(f"Published version {writer.version}, {STATE.itemsize} bytes at {reader.path}")
+
+    start = time.perf_counter()
+    for _ in range(args.reads):
+        with open(args.weather) as fin:
+            json.load(fin, object_hook=weather_hook)['current']['summary']
+    decode = (time.perf_counter() - start) / args.reads
+    start = time.perf_counter()
+    for _ in range(args.reads):
+        reader.read().current.summary
+    shared = (time.perf_counter() - start) / args.reads
+    start = time.perf_counter()
+    for _ in range(args.reads):
+        reader.changed()
+    check = (time.perf_counter() - start) / args.reads
+    print(f"json file {decode * 1e6:.1f} us, shared state {shared * 1e6:.1f} us, "
+          f"changed check {check * 1e6:.2f} us per read")
+    reader.close()
+    writer.close()